@@ -0,0 +1,217 @@
+# Throughput and peak memory of the gridding and SENSE stack on synthetic
+# data, written to JSON to catch regressions between versions.
+#
+# Each case (trajectory, matrix size, coils, oversampling ratio) times
+# grid2D, degrid2D, fft2D, rolloff2D, rolloff2D_analytic, apply_rolloff2D,
+# autocalibrationB1Maps2D (grid, FFT, rolloff and autocalibration from the
+# samples, against lowres_autocalibrationB1Maps2D) and a CG SENSE run, with and
+# without a gridding plan (best of --repeat runs after a warm-up run), then
+# runs each step once more under tracemalloc for its peak memory (numpy
+# allocations, not the internal buffers of compiled code).  Throughput is in
+# samples/s: k-space samples of all coils for gridding, degridding and CG
+# SENSE (per iteration), image pixels of all coils for the image-domain
+# steps.  The data are generated from fixed seeds, see synthetic.py.
+#
+# usage: python gridding_suite.py [--preset quick|full] [--mtx 128 256]
+#            [--coils 8 32] [--osr 1.375] [--trajectory spiral radial]
+#            [--output gridding_suite.json] [--compare baseline.json]
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+
+import bni.gridding.Kaiser2D_utils as kaiser2D
+from synthetic import spiral_coords, radial_coords, density_weights, phantom_and_coils, simulate, adjoint
+
+PRESETS = {
+    'quick': {'mtx': [128], 'coils': [8], 'osr': [1.375], 'trajectory': ['spiral', 'radial']},
+    'full': {'mtx': [128, 256, 512], 'coils': [8, 32, 64], 'osr': [1.25, 1.375, 2.0], 'trajectory': ['spiral', 'radial']},
+}
+
+
+def trajectory(name, mtx):
+    # about Nyquist sampling of the disk for the image matrix mtx
+    if name == 'spiral':
+        nr_arms = 16
+        nr_points = int(np.pi / 4 * mtx * mtx / nr_arms)
+        return spiral_coords(nr_arms, nr_points, mtx / (2.0 * nr_arms))
+    nr_spokes = int(np.pi / 2 * mtx)
+    return radial_coords(nr_spokes, mtx)
+
+def measure(step, nr_samples, repeat):
+    # best time of repeat runs after a warm-up run, then the peak of one
+    # more run under tracemalloc
+    step()
+    seconds = None
+    for r in range(repeat):
+        start = time.time()
+        step()
+        elapsed = time.time() - start
+        seconds = elapsed if (seconds is None) else min(seconds, elapsed)
+
+    tracemalloc.start()
+    step()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': seconds,
+            'samples_per_s': nr_samples / max(seconds, 1e-12),
+            'peak_mb': peak / 2.0**20}
+
+def run_case(traj_name, mtx_original, nr_coils, oversampling_ratio, args):
+    mtx = int(mtx_original * oversampling_ratio)
+    mtx += mtx % 2
+    coords = trajectory(traj_name, mtx_original)
+    [nr_sets, nr_arms, nr_points] = coords.shape[:3]
+    nr_samples = nr_arms * nr_points
+    weights = density_weights(coords)
+
+    backend = kaiser2D.backends.select(mtx, nr_samples, nr_coils, args.threads)
+    kernel = kaiser2D.kaiserbessel_kernel(800, oversampling_ratio)
+    roll = kaiser2D.rolloff2D_analytic(mtx, oversampling_ratio)
+    image, csm = phantom_and_coils(mtx, nr_coils)
+    data = simulate(image, csm, coords, kernel, roll)
+
+    out_dims_grid = [nr_coils, 1, 1, mtx, nr_arms, nr_points]
+    out_dims_degrid = [nr_coils, 1, 1, nr_arms, nr_points]
+    gridded = kaiser2D.grid2D(data, coords, weights, kernel, out_dims_grid, nthreads=args.threads)
+    coil_images = kaiser2D.fft2D(gridded, dir=0)
+
+    def autocal():
+        # the full-resolution path of Sense2 from the samples, to compare
+        # with lowres_autocalibrationB1Maps2D
+        images = kaiser2D.fft2D(kaiser2D.grid2D(data, coords, weights, kernel, out_dims_grid, nthreads=args.threads), dir=0)
+        kaiser2D.apply_rolloff2D(images, roll)
+        return kaiser2D.autocalibrationB1Maps2D(images)
+
+    def sense(use_plan=False):
+        # Sense2 grids and degrids directly unless the plan fits its setup cache
+        plan = kaiser2D.GriddingPlan(coords, weights, kernel, mtx) if use_plan else None
+        operator = kaiser2D.SenseNormalOperator2D(csm, coords, weights, kernel, roll, plan=plan, nthreads=args.threads)
+        cg = kaiser2D.ConjugateGradient(operator, (1, 1, mtx, mtx))
+        cg.start(b=adjoint(data, csm, coords, weights, kernel, roll))
+        for iteration in range(args.iterations):
+            cg.iterate()
+
+    steps = [
+        ('grid2D', nr_coils * nr_samples,
+         lambda: kaiser2D.grid2D(data, coords, weights, kernel, out_dims_grid, nthreads=args.threads)),
+        ('degrid2D', nr_coils * nr_samples,
+         lambda: kaiser2D.degrid2D(gridded, coords, kernel, out_dims_degrid, nthreads=args.threads)),
+        ('fft2D', nr_coils * mtx * mtx,
+         lambda: kaiser2D.fft2D(gridded, dir=0)),
+        ('rolloff2D', mtx * mtx,
+         lambda: kaiser2D.rolloff2D(mtx, kernel)),
+        ('rolloff2D_analytic', mtx * mtx,
+         lambda: kaiser2D.rolloff2D_analytic(mtx, oversampling_ratio)),
+        ('apply_rolloff2D', nr_coils * mtx * mtx,
+         lambda: kaiser2D.apply_rolloff2D(coil_images.copy(), roll)),
+        ('autocalibrationB1Maps2D', nr_coils * mtx * mtx, autocal),
+        ('lowres_autocalibrationB1Maps2D', nr_coils * mtx * mtx,
+         lambda: kaiser2D.lowres_autocalibrationB1Maps2D(data, coords, weights, kernel, mtx, oversampling_ratio, nthreads=args.threads)),
+        ('sense', nr_coils * nr_samples * args.iterations, sense),
+        ('sense_plan', nr_coils * nr_samples * args.iterations, lambda: sense(use_plan=True)),
+    ]
+
+    results = {}
+    for name, samples, step in steps:
+        if args.steps and (name not in args.steps):
+            continue
+        results[name] = measure(step, samples, args.repeat)
+        print("%-8s %5d %4d %6.3f %-24s %10.4f s %12.3g samples/s %9.1f MB" % (
+            traj_name, mtx_original, nr_coils, oversampling_ratio, name,
+            results[name]['seconds'], results[name]['samples_per_s'], results[name]['peak_mb']))
+        sys.stdout.flush()
+
+    case = {'trajectory': traj_name, 'mtx': mtx_original, 'coils': nr_coils, 'osr': oversampling_ratio,
+            'grid_mtx': mtx, 'samples': nr_samples, 'backend': backend}
+    return {'case': case, 'steps': results}
+
+def case_key(case):
+    return '%s mtx %d coils %d osr %g' % (case['trajectory'], case['mtx'], case['coils'], case['osr'])
+
+def compare(results, baseline, tolerance):
+    # steps that take more than tolerance percent longer than in baseline
+    baseline_steps = dict((case_key(r['case']), r['steps']) for r in baseline['results'])
+    regressions = []
+    for r in results['results']:
+        key = case_key(r['case'])
+        for name, m in r['steps'].items():
+            b = baseline_steps.get(key, {}).get(name)
+            if (b is not None) and (m['seconds'] > b['seconds'] * (1 + tolerance / 100.0)):
+                regressions.append((key, name, b['seconds'], m['seconds']))
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    preset = PRESETS[args.preset]
+    cases = [(t, m, c, o) for t in (args.trajectory or preset['trajectory'])
+                          for m in (args.mtx or preset['mtx'])
+                          for c in (args.coils or preset['coils'])
+                          for o in (args.osr or preset['osr'])]
+
+    kaiser2D.backends.configure(args.backend)
+    kaiser2D.fft_plans.configure(args.threads, [None, 'FFTW_ESTIMATE', 'FFTW_MEASURE'][args.fft_planning])
+
+    meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'threads': args.threads,
+            'repeat': args.repeat,
+            'iterations': args.iterations,
+            'backends': kaiser2D.backends.available()}
+
+    print("%-8s %5s %4s %6s %-24s %12s %22s %12s" % ('traj', 'mtx', 'coil', 'osr', 'step', 'time', 'throughput', 'peak'))
+    results = {'meta': meta, 'results': [run_case(t, m, c, o, args) for (t, m, c, o) in cases]}
+    meta['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    print("results written to " + args.output)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for key, name, before, after in regressions:
+            print("slower: %s %s %.4f s -> %.4f s" % (key, name, before, after))
+        if regressions:
+            sys.exit(1)
+        print("no step slower than %g%% of %s" % (args.tolerance, args.compare))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='gridding and SENSE throughput on synthetic data')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick', help='case grid, overridden per parameter below')
+    parser.add_argument('--mtx', type=int, nargs='+')
+    parser.add_argument('--coils', type=int, nargs='+')
+    parser.add_argument('--osr', type=float, nargs='+')
+    parser.add_argument('--trajectory', choices=['spiral', 'radial'], nargs='+')
+    parser.add_argument('--steps', nargs='+', help='only these steps (default: all)')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--backend', choices=['auto', 'pyfi', 'numba', 'numpy'], default='auto')
+    parser.add_argument('--fft-planning', type=int, choices=[0, 1, 2], default=2, help='0: backend FFT, 1: FFTW_ESTIMATE, 2: FFTW_MEASURE plans')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=10, help='CG SENSE iterations')
+    parser.add_argument('--output', default='gridding_suite.json')
+    parser.add_argument('--compare', help='JSON output of a previous run, exits with 1 if a step got slower')
+    parser.add_argument('--tolerance', type=float, default=20.0, help='allowed slowdown against --compare in percent')
+    run(parser.parse_args())
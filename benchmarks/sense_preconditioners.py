@@ -0,0 +1,85 @@
+# Iterations to tolerance of CG SENSE with and without preconditioning.
+#
+# Simulates an undersampled spiral acquisition of a phantom with smooth
+# coil sensitivities and solves it with Kaiser2D_utils.ConjugateGradient
+# for each preconditioner, once with density compensation weights and once
+# with unit weights.  By default the maps are the ones Sense2 uses without
+# a 'coil sensitivity' input: autocalibrated from the gridded samples
+# (default width, taper and mask floor) and so normalized to a unit
+# sum-of-squares inside the object.  --maps input uses the simulated (not
+# normalized) sensitivities instead, as for maps from a separate scan.
+# The error column is the relative difference to the solution without a
+# preconditioner.
+#
+# usage: python sense_preconditioners.py [--mtx 128] [--arms 8] [--tolerance 1e-3]
+#            [--maps autocal|input]
+
+import argparse
+import time
+
+import numpy as np
+
+import bni.gridding.Kaiser2D_utils as kaiser2D
+from synthetic import spiral_coords, density_weights, phantom_and_coils, simulate, adjoint
+
+
+def run(args):
+    oversampling_ratio = 1.375
+    mtx = int(args.mtx * oversampling_ratio)
+    mtx += mtx % 2
+    kernel = kaiser2D.kaiserbessel_kernel(800, oversampling_ratio)
+    roll = kaiser2D.rolloff2D_analytic(mtx, oversampling_ratio)
+
+    coords = spiral_coords(args.arms, args.points, args.mtx / (2.0 * args.arms))
+    image, csm = phantom_and_coils(mtx, args.coils)
+    data = simulate(image, csm, coords, kernel, roll)
+
+    print("matrix %d (grid %d), %d coils, %d arms x %d points, tolerance %g, %s maps" % (args.mtx, mtx, args.coils, args.arms, args.points, args.tolerance,
+                                                                                        args.maps))
+    print("%-12s %-18s %10s %10s %10s" % ('weights', 'preconditioner', 'iterations', 'time [s]', 'error'))
+    for weights_name in ['density', 'unit']:
+        if weights_name == 'density':
+            weights = density_weights(coords)
+        else:
+            weights = np.ones(coords.shape[:3], dtype=np.float32)
+        if args.maps == 'autocal':
+            # grid -> fft -> rolloff -> autocalibration, as in Sense2
+            gridded = kaiser2D.grid2D(data, coords, weights, kernel, [args.coils, 1, 1, mtx, args.arms, args.points])
+            coil_images = kaiser2D.fft2D(gridded, dir=0)
+            kaiser2D.apply_rolloff2D(coil_images, roll)
+            maps = kaiser2D.autocalibrationB1Maps2D(coil_images)
+        else:
+            maps = csm
+        plan = kaiser2D.GriddingPlan(coords, weights, kernel, mtx)
+        operator = kaiser2D.SenseNormalOperator2D(maps, coords, weights, kernel, roll, plan=plan)
+        b = adjoint(data, maps, coords, weights, kernel, roll)
+
+        preconditioners = [
+            ('none', None),
+            ('coil sensitivity', kaiser2D.csm_preconditioner2D(maps)),
+            ('k-space density', kaiser2D.density_preconditioner2D(coords, weights, kernel, mtx))]
+        reference = None
+        for name, preconditioner in preconditioners:
+            cg = kaiser2D.ConjugateGradient(operator, b.shape, tolerance=args.tolerance, preconditioner=preconditioner)
+            start = time.time()
+            cg.start(b=b)
+            iterations = 0
+            while (not cg.converged()) and (iterations < args.max_iterations):
+                cg.iterate()
+                iterations += 1
+            elapsed = time.time() - start
+            if reference is None:
+                reference = cg.x[0, 0].copy()
+            error = np.linalg.norm(cg.x[0, 0] - reference) / np.linalg.norm(reference)
+            print("%-12s %-18s %10d %10.2f %10.4f" % (weights_name, name, iterations, elapsed, error))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CG SENSE iterations to tolerance per preconditioner')
+    parser.add_argument('--mtx', type=int, default=128)
+    parser.add_argument('--coils', type=int, default=8)
+    parser.add_argument('--arms', type=int, default=8)
+    parser.add_argument('--points', type=int, default=2000)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    parser.add_argument('--max-iterations', type=int, default=200)
+    parser.add_argument('--maps', choices=['autocal', 'input'], default='autocal')
+    run(parser.parse_args())
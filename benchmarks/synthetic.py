@@ -0,0 +1,66 @@
+# Synthetic data for the benchmarks: spiral and radial trajectories, their
+# density compensation, a phantom with smooth (not normalized) coil
+# sensitivities and the forward / adjoint model that simulates the samples.
+# Everything is deterministic, the random parts use fixed seeds.
+
+import numpy as np
+
+import bni.gridding.Kaiser2D_utils as kaiser2D
+
+
+def spiral_coords(nr_arms, nr_points, turns):
+    # variable density-free archimedean spiral, coords in [-0.5, 0.5]
+    t = np.linspace(0, 1, nr_points)
+    coords = np.zeros([1, nr_arms, nr_points, 2], dtype=np.float32)
+    for arm in range(nr_arms):
+        phi = 2 * np.pi * (arm / float(nr_arms) + turns * t)
+        coords[0, arm, :, 0] = 0.5 * t * np.cos(phi)
+        coords[0, arm, :, 1] = 0.5 * t * np.sin(phi)
+    return coords
+
+def radial_coords(nr_spokes, nr_points, golden_angle=True):
+    # spokes through the center, coords in [-0.5, 0.5), either in golden
+    # angle order or evenly spaced over 180 degrees
+    r = (np.arange(nr_points) - nr_points // 2) / float(nr_points)
+    if golden_angle:
+        angles = np.arange(nr_spokes) * np.pi * (np.sqrt(5) - 1) / 2
+    else:
+        angles = np.arange(nr_spokes) * np.pi / nr_spokes
+    coords = np.zeros([1, nr_spokes, nr_points, 2], dtype=np.float32)
+    coords[0, :, :, 0] = np.cos(angles)[:, np.newaxis] * r
+    coords[0, :, :, 1] = np.sin(angles)[:, np.newaxis] * r
+    return coords
+
+def density_weights(coords):
+    # density compensation of spiral and radial trajectories ~ |k|
+    kr = np.sqrt(np.sum(coords**2, axis=-1))
+    return np.maximum(kr, 0.5 / coords.shape[-2]).astype(np.float32)
+
+def phantom_and_coils(mtx, nr_coils):
+    u = (np.arange(mtx) - mtx // 2) / float(mtx)
+    y, x = np.meshgrid(u, u, indexing='ij')
+    image = ((x / 0.4)**2 + (y / 0.3)**2 < 1).astype(np.float32)
+    image += 0.5 * (((x - 0.1) / 0.1)**2 + (y / 0.15)**2 < 1)
+    csm = np.zeros([nr_coils, 1, 1, mtx, mtx], dtype=np.complex64)
+    for coil in range(nr_coils):
+        cx = 0.6 * np.cos(2 * np.pi * coil / nr_coils)
+        cy = 0.6 * np.sin(2 * np.pi * coil / nr_coils)
+        csm[coil, 0, 0] = np.exp(-((x - cx)**2 + (y - cy)**2) / 0.2) * np.exp(1j * np.pi * coil / nr_coils)
+    return image.astype(np.complex64), csm
+
+def simulate(image, csm, coords, kernel, roll):
+    # A x: coil images -> rolloff -> fft -> degrid
+    [nr_sets, nr_arms, nr_points] = coords.shape[:3]
+    coil_images = csm * image
+    kaiser2D.apply_rolloff2D(coil_images, roll)
+    kspace = kaiser2D.fft2D(coil_images, dir=1)
+    return kaiser2D.degrid2D(kspace, coords, kernel, [csm.shape[0], 1, 1, nr_arms, nr_points])
+
+def adjoint(data, csm, coords, weights, kernel, roll):
+    # A^H y: grid -> fft -> rolloff -> coil combine
+    [nr_sets, nr_arms, nr_points] = coords.shape[:3]
+    mtx = csm.shape[-1]
+    gridded = kaiser2D.grid2D(data, coords, weights, kernel, [csm.shape[0], 1, 1, mtx, nr_arms, nr_points])
+    coil_images = kaiser2D.fft2D(gridded, dir=0)
+    kaiser2D.apply_rolloff2D(coil_images, roll)
+    return np.sum(np.conj(csm) * coil_images, axis=0)
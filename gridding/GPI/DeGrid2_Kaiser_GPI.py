@@ -37,28 +37,60 @@ class ExternalNode(gpi.NodeAPI):
         First, data are rolloff corrected with the gridding kernel function.
         Second, zeroes are added around the image matrix according to the oversampling factor.
         Third, the data are inverse Fourer transformed and then gridded to the coordinate locations using a Kaiser-Bessel kernel.
+        The setup cache, FFT planning, compute backend and profiling are set for all
+        gridding and SENSE nodes, see Kaiser2D_utils.configure_from_environment().
         
     WIDGET:
         oversampling ratio: Oversampling and Kaiser-Bessel kernel function according to 
             Beatty, Philip J., Dwight G. Nishimura, and John M. Pauly. "Rapid gridding
             reconstruction with a minimal oversampling ratio." Medical Imaging, IEEE
             Transactions on 24.6 (2005): 799-808.
+        dx, dy (pixels): FOV shift as in Grid2, the degridded samples get the opposite
+            linear phase inside the degridding, so that they match the raw data of a
+            shifted acquisition (computed from 'params_in' if connected)
+        threads: number of threads used for degridding (results are independent of this)
+        separable kernel: use the product of two 1D Kaiser-Bessel kernels instead of the
+            radial kernel
+        kernel width: Kaiser-Bessel kernel width in k-space pixels of the oversampled grid
+        kernel table size: number of entries of the tabulated kernel
+        target error: relative gridding error that sets oversampling ratio and kernel (0: off)
+        sort samples: visit the samples sorted by k-space tile, which is faster for large
+            matrices and many coils
 
     INPUT:
         data: data in image domain
         coords: nD array sample locations (scaled between -0.5 and 0.5)
+        sample order: (optional) sample order from a previous execution for the same
+            trajectory and matrix size, saves sorting the samples again
+        params_in: (optional) dictionary data header (BNIspiral) for the FOV shift
     
     OUTPUT:
         out: k-space resampled at coordinate locations
+        sample order: order in which the samples were degridded (if sorted)
+        profile: per-stage calls, seconds, self seconds, samples/s and MB (if profiled)
     """
     def initUI(self):
+        import bni.gridding.Kaiser2D_utils as kaiser2D
+
         # Widgets
         self.addWidget('DoubleSpinBox', 'oversampling ratio', val=1.375, decimals=3, singlestep=0.125, min=1, max=2, collapsed=True)
+        self.addWidget('DoubleSpinBox', 'dx (pixels)', val=0., decimals=3, collapsed=True)
+        self.addWidget('DoubleSpinBox', 'dy (pixels)', val=0., decimals=3, collapsed=True)
+        self.addWidget('SpinBox', 'threads', val=1, min=1, collapsed=True)
+        self.addWidget('PushButton', 'separable kernel', toggle=True, button_title='ON', val=0, collapsed=True)
+        self.addWidget('DoubleSpinBox', 'kernel width', val=5.0, decimals=1, singlestep=0.5, min=2., max=8., collapsed=True)
+        self.addWidget('SpinBox', 'kernel table size', val=800, min=64, max=kaiser2D.MAX_KERNEL_TABLE_SIZE, collapsed=True)
+        self.addWidget('DoubleSpinBox', 'target error', val=0., decimals=5, singlestep=0.0001, min=0., max=0.1, collapsed=True)
+        self.addWidget('PushButton', 'sort samples', toggle=True, button_title='ON', val=0, collapsed=True)
         
         # IO Ports
         self.addInPort('data', 'NPYarray', dtype=np.complex64, obligation=gpi.REQUIRED)
         self.addInPort('coords', 'NPYarray', dtype=[np.float64, np.float32], obligation=gpi.REQUIRED)
+        self.addInPort('sample order', 'NPYarray', dtype=np.int64, obligation=gpi.OPTIONAL)
+        self.addInPort('params_in', 'DICT', obligation=gpi.OPTIONAL)
         self.addOutPort('out', 'NPYarray', dtype=np.complex64)
+        self.addOutPort('sample order', 'NPYarray', dtype=np.int64)
+        self.addOutPort('profile', 'DICT')
 
     def compute(self):
 
@@ -69,18 +101,60 @@ class ExternalNode(gpi.NodeAPI):
         coords = self.getData('coords').astype(np.float32, copy=False)
         data = self.getData('data').astype(np.complex64, copy=False)
         oversampling_ratio = self.getVal('oversampling ratio')
-        
+        nthreads = self.getVal('threads')
+        separable = self.getVal('separable kernel')
+        kernel_width = self.getVal('kernel width')
+        kernel_table_size = self.getVal('kernel table size')
+        target_error = self.getVal('target error')
+        sort_samples = self.getVal('sort samples')
+
+        # process-wide settings shared by the gridding and SENSE nodes (setup
+        # cache, FFT planning, compute backend and profiling)
+        try:
+            kaiser2D.configure_from_environment()
+        except ValueError as e:
+            self.log.warn(str(e))
+            return 1
+
+        # FOV shift from the header, otherwise from the widgets
+        inparam = self.getData('params_in')
+        if inparam is not None:
+            try:
+                [dx, dy, dz] = kaiser2D.header_fov_shift(inparam)
+            except ValueError as e:
+                self.log.warn(str(e))
+                return 1
+            self.setAttr('dx (pixels)', val=dx)
+            self.setAttr('dy (pixels)', val=dy)
+            self.log.debug("off-centers dx=" + str(dx) + " dy=" + str(dy))
+        dx = self.getVal('dx (pixels)')
+        dy = self.getVal('dy (pixels)')
+
+        # setup that only depends on the trajectory and the gridding parameters
+        # is reused from the setup cache (shared with the other gridding and
+        # SENSE nodes)
+        cache = kaiser2D.setup_cache
+
         # Determine matrix size before and after oversampling
         mtx_original = data.shape[-1]
+        # accuracy target: the cheapest kernel that reaches it (the chosen
+        # parameters are shown in the widgets), otherwise check the widget values
+        try:
+            if target_error > 0:
+                [oversampling_ratio, kernel_width, kernel_table_size] = cache.get(
+                    ('kernel parameters', target_error, mtx_original, coords.shape[-3] * coords.shape[-2]),
+                    lambda: kaiser2D.kaiserbessel_parameters(target_error, mtx_original, coords.shape[-3] * coords.shape[-2]))
+                self.setAttr('oversampling ratio', quietval=oversampling_ratio)
+                self.setAttr('kernel width', quietval=kernel_width)
+                self.setAttr('kernel table size', quietval=kernel_table_size)
+            kaiser2D.kaiserbessel_beta(oversampling_ratio, kernel_width)
+        except ValueError as e:
+            self.log.warn(str(e))
+            return 1
+
         mtx = np.int(mtx_original * oversampling_ratio)
         if mtx%2:
             mtx+=1
-        if oversampling_ratio > 1:
-            mtx_min = np.int((mtx-mtx_original)/2)
-            mtx_max = mtx_min + mtx_original
-        else:
-            mtx_min = 0
-            mtx_max = mtx
         
         # data dimensions
         nr_points = coords.shape[-2]
@@ -107,28 +181,56 @@ class ExternalNode(gpi.NodeAPI):
         elif data.ndim > 5:
             self.log.warn("Not implemented yet")
         out_dims_degrid = [nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points]
-        out_dims_fft = [nr_coils, extra_dim2, extra_dim1, mtx, mtx]
 
         # coords dimensions: (add 1 dimension as they could have another dimension for golden angle dynamics
         if coords.ndim == 3:
             coords.shape = [1,nr_arms,nr_points,2]
 
+        # the FFTs run on the same threads
+        kaiser2D.fft_plans.nthreads = nthreads
+
+        # compute backend: the configured one, or the fastest available one
+        # for this problem size
+        with kaiser2D.profiler.stage('backend selection'):
+            backend = kaiser2D.backends.select(mtx, nr_arms * nr_points, nr_coils, nthreads)
+        self.log.debug("compute backend: " + backend)
+
         # pre-calculate Kaiser-Bessel kernel
-        kernel_table_size = 800
-        kernel = kaiser2D.kaiserbessel_kernel( kernel_table_size, oversampling_ratio)
+        kernel = cache.get(('kernel', kernel_table_size, oversampling_ratio, kernel_width),
+                           lambda: kaiser2D.kaiserbessel_kernel( kernel_table_size, oversampling_ratio, kernel_width))
         
         # pre-calculate the rolloff for the spatial domain
-        roll = kaiser2D.rolloff2D(mtx, kernel)
+        # (the separable one as a pair of vectors)
+        broadcast = separable
+        roll = cache.get(('rolloff', mtx, oversampling_ratio, kernel_width, separable, broadcast),
+                         lambda: kaiser2D.rolloff2D_analytic(mtx, oversampling_ratio, separable=separable, broadcast=broadcast,
+                                                             kernel_width=kernel_width))
 
-        # perform rolloff correction
-        rolloff_corrected_data = data * roll[mtx_min:mtx_max,mtx_min:mtx_max]
+        # perform rolloff correction (on the central part of the rolloff)
+        rolloff_corrected_data = kaiser2D.apply_rolloff2D(data.copy(), roll)
     
+        # sample order, reuse the one from the port if it fits the trajectory
+        order = None
+        if sort_samples:
+            order = self.getData('sample order')
+            if (order is None) or (order.shape != (coords.shape[0], nr_arms * nr_points)):
+                self.log.debug("sort samples")
+                order = cache.get(('sample order', mtx, kaiser2D.trajectory_hash(coords)),
+                                  lambda: kaiser2D.sample_order2D(coords, mtx))
+            self.setData('sample order', order)
+
         # inverse-FFT with zero-interpolation to oversampled k-space
-        oversampled_kspace = kaiser2D.fft2D(rolloff_corrected_data, dir=1, out_dims_fft=out_dims_fft)
+        oversampled_kspace = kaiser2D.fft2D_zeropad(rolloff_corrected_data, mtx, dir=1)
    
-        out = kaiser2D.degrid2D(oversampled_kspace, coords, kernel, out_dims_degrid)
+        out = kaiser2D.degrid2D(oversampled_kspace, coords, kernel, out_dims_degrid, nthreads=nthreads, separable=separable, order=order,
+                                kernel_width=kernel_width, dx=dx, dy=dy)
         self.setData('out', out.squeeze())
- 
+        self.log.debug("setup cache: " + str(cache.stats()))
+        if kaiser2D.profiler.enabled:
+            self.setData('profile', kaiser2D.profiler.summary())
+            if kaiser2D.profiler.filename:
+                kaiser2D.profiler.save(kaiser2D.profiler.filename)
+
         return(0)
 
     def execType(self):
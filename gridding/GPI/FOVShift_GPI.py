@@ -57,64 +57,52 @@ class ExternalNode(gpi.NodeAPI):
             self.setAttr('Eff MTX Z', visible=False)
             self.log.node("*** 2D data")
 
-        # GB: if dict given as input compute dx,dy,dz (as in Grid_GPI.py) 
-        if (inparam is not None):                                               
-
-          # header check
-          if 'headerType' in inparam:
-
-            # check if the header is for spiral
-            if inparam['headerType'] != 'BNIspiral':
-                self.log.warn("wrong header type")
+        # GB: if dict given as input compute dx,dy,dz (as in Grid_GPI.py)
+        if (inparam is not None):
+            import bni.gridding.Kaiser2D_utils as kaiser2D
+            stack = (crds.shape[-1] == 3)
+            try:
+                [mtx_xy, mtx_z] = kaiser2D.header_matrix(inparam, stack=stack)
+                [xoff, yoff, zoff] = kaiser2D.header_fov_shift(inparam, stack=stack)
+            except ValueError as e:
+                self.log.warn(str(e))
                 return 1
 
-          else:
-            # if there is no header type, then its also the wrong type
-            self.log.warn("wrong header type")
-            return 1
-
-          # Auto Matrix calculation: extra 25% assumes "true resolution"          
-          mtx_xy = 1.25*float(inparam['spFOVXY'][0])/float(inparam['spRESXY'][0])
-          self.setAttr('Eff MTX XY', val = mtx_xy)                   
-          self.log.node("*** Eff MTX XY "+str(mtx_xy))        
+            # Auto Matrix calculation: extra 25% assumes "true resolution"
+            self.setAttr('Eff MTX XY', val = mtx_xy)
+            self.log.node("*** Eff MTX XY "+str(mtx_xy))
+            if stack:
+                self.setAttr('Eff MTX Z', val = mtx_z)
+                self.log.node("*** Eff MTX Z "+str(mtx_z))
+
+            # Auto offset calculation.  Values reported in mm, change to # pixels
+            self.setAttr('dx (pixels)', val=xoff)
+            self.setAttr('dy (pixels)', val=yoff)
+            self.log.node("*** Computed off-centers dx="+str(xoff)+" dy="+str(yoff))
+            if stack:
+                self.setAttr('dz (pixels)', val=zoff)
+                self.log.node("*** Computed off-center dz="+str(zoff))
 
-          if crds.shape[-1] == 3:                                               
-            mtx_z  = float(inparam['spFOVZ'][0]) /float(inparam['spRESZ'][0])   
-            if int(float(inparam['spSTYPE'][0])) in [2,3]: #SDST, FLORET        
-              mtx_z *= 1.25
-            self.setAttr('Eff MTX Z', val = mtx_z)                   
-            self.log.node("*** Eff MTX Z "+str(mtx_z))                                                         
-
-          # Auto offset calculation.  Values reported in mm, change to # pixels
-          m_off = 0.001*float(inparam['m_offc'][0])
-          p_off = 0.001*float(inparam['p_offc'][0])
-          xoff = m_off*float(mtx_xy)/float(inparam['spFOVXY'][0])
-          yoff = p_off*float(mtx_xy)/float(inparam['spFOVXY'][0])
-          self.setAttr('dx (pixels)', val=xoff)
-          self.setAttr('dy (pixels)', val=yoff)
-          self.log.node("*** Computed off-centers dx="+str(xoff)+" dy="+str(yoff))  
- 
-          if crds.shape[-1] == 3:                                               
-            s_off = 0.001*float(inparam['s_offc'][0])
-            zoff = s_off*float(mtx_z) /float(inparam['spFOVZ'][0])
-            # shift half pixel when the number of slices is even with
-            # distributed spirals. ZQL
-            if (int(float(inparam['spSTYPE'][0])) in [1,2]) and \
-              (int(mtx_z)%2 == 0):
-              zoff = zoff - 0.5
-            self.setAttr('dz (pixels)', val=zoff)
-            self.log.node("*** Computed off-center dz="+str(zoff))   
- 
         dx = self.getVal('dx (pixels)')
         dy = self.getVal('dy (pixels)')
+        # phase in the precision of the data (no complex128 copy of
+        # complex64 data), cos and sin straight into its real and imaginary
+        # parts
+        crds = crds.astype(data.real.dtype, copy=False)
         if crds.shape[-1] == 3:
             dz = self.getVal('dz (pixels)')
-            phase = np.exp(-1j * 2.0 * np.pi * (crds[...,0]*dx + crds[...,1]*dy + crds[...,2]*dz))
+            arg = crds[...,0]*dx + crds[...,1]*dy + crds[...,2]*dz
             self.log.node("*** Computed 3D phase shift")   
         else:
-            phase = np.exp(-1j * 2.0 * np.pi * (crds[...,0]*dx + crds[...,1]*dy))
+            arg = crds[...,0]*dx + crds[...,1]*dy
             self.log.node("*** Computed 2D phase shift")   
-
-        self.setData('adjusted data', data * phase)
+        arg *= -2.0 * np.pi
+        phase = np.empty(arg.shape, dtype=data.dtype)
+        np.cos(arg, out=phase.real)
+        np.sin(arg, out=phase.imag)
+
+        out = data.copy()
+        out *= phase
+        self.setData('adjusted data', out)
 
         return 0
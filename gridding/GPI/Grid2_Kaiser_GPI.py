@@ -34,40 +34,92 @@ import numpy as np
 
 class ExternalNode(gpi.NodeAPI):
     """Gridding module for Post-Cartesian Data - works with 2D data.
+    The setup cache, FFT planning, compute backend and profiling are set for all
+    gridding and SENSE nodes, see Kaiser2D_utils.configure_from_environment().
 
     WIDGET:
         mtx size (n x n): grid matrix size 'n'
         dims per set: dimensions of the sample coordinates (automatically set)
+        mtx z (partitions): number of kz partitions of a stack of spirals (3D coords),
+            the kz spacing is 1/partitions (0: from the kz spacing of the trajectory)
+        dx, dy, dz (pixels): FOV shift of the image, applied as a linear phase of each
+            sample inside the gridding (as FOVShift, without an extra copy of the data),
+            computed from 'params_in' if connected (dz only for a stack of spirals)
         oversampling ratio: Oversampling and Kaiser-Bessel kernel function according to
             Beatty, Philip J., Dwight G. Nishimura, and John M. Pauly. "Rapid gridding
             reconstruction with a minimal oversampling ratio." Medical Imaging, IEEE
             Transactions on 24.6 (2005): 799-808.
         Add FFT and rolloff: push button to perform both FFT and rolloff correction and output the cropped image.
+        threads: number of threads used for gridding (results are independent of this)
+        separable kernel: use the product of two 1D Kaiser-Bessel kernels instead of the
+            radial kernel, the deapodization is then separable as well
+        kernel width: Kaiser-Bessel kernel width in k-space pixels of the oversampled grid
+        kernel table size: number of entries of the tabulated kernel
+        target error: relative gridding error that sets oversampling ratio and kernel (0: off)
+        sort samples: visit the samples sorted by k-space tile, which is faster for large
+            matrices and many coils (results are equal up to the summation order)
+        memory budget (MB): limit of the oversampled grids held at once with FFT and rolloff
+        processes: number of worker processes that grid the slices and dynamics
+            ([extra_dim2, extra_dim1]) in parallel, the threads are divided among them
+        virtual coils: SVD coil compression to at most this many coils (0: no limit)
+        coil compression energy (%): signal energy the virtual coils keep (100: no limit)
 
     INPUT:
         data: nD array of sampled k-space data
-        coords: nD array sample locations (scaled between -0.5 and 0.5)
+        coords: nD array sample locations (scaled between -0.5 and 0.5), 2-vec, or 3-vec
+            for a stack of spirals: every arm in one kz partition and the same in-plane
+            trajectory in all partitions, which are separated by a 1D FFT along kz and
+            then gridded in 2D like slices
         weights: density compensation
+        sample order: (optional) sample order from a previous execution for the same
+            trajectory and matrix size, saves sorting the samples again
+        params_in: (optional) dictionary data header (BNIspiral) for the FOV shift
         
     
     OUTPUT:
-        out: gridded k-space or image cropped to demanded matrix size
+        out: gridded k-space or image cropped to demanded matrix size (virtual coils
+             if compressed), for a stack of spirals [..., z, y, x] with the z partitions
+             after the slices and dynamics (hybrid z-k-space without FFT and rolloff)
         deapodization: grid kernel compensation to be multiplied by gridded
                        data after fft (if desired).
+        coil compression: [virtual coils, coils] matrix of the coil compression
+        sample order: order in which the samples were gridded (if sorted)
+        profile: per-stage calls, seconds, self seconds, samples/s and MB (if profiled)
     """
     def initUI(self):
+        import bni.gridding.Kaiser2D_utils as kaiser2D
+
         # Widgets
         self.addWidget('SpinBox','mtx size (n x n)', min=5, val=240)
         self.addWidget('Slider','dims per set', min=1, val=2)
+        self.addWidget('SpinBox', 'mtx z (partitions)', val=0, min=0, collapsed=True)
+        self.addWidget('DoubleSpinBox', 'dx (pixels)', val=0., decimals=3, collapsed=True)
+        self.addWidget('DoubleSpinBox', 'dy (pixels)', val=0., decimals=3, collapsed=True)
+        self.addWidget('DoubleSpinBox', 'dz (pixels)', val=0., decimals=3, collapsed=True)
         self.addWidget('DoubleSpinBox', 'oversampling ratio', val=1.375, decimals=3, singlestep=0.125, min=1, max=2, collapsed=True)
         self.addWidget('PushButton', 'Add FFT and rolloff', toggle=True, button_title='ON', val=1)
+        self.addWidget('SpinBox', 'threads', val=1, min=1, collapsed=True)
+        self.addWidget('PushButton', 'separable kernel', toggle=True, button_title='ON', val=0, collapsed=True)
+        self.addWidget('DoubleSpinBox', 'kernel width', val=5.0, decimals=1, singlestep=0.5, min=2., max=8., collapsed=True)
+        self.addWidget('SpinBox', 'kernel table size', val=800, min=64, max=kaiser2D.MAX_KERNEL_TABLE_SIZE, collapsed=True)
+        self.addWidget('DoubleSpinBox', 'target error', val=0., decimals=5, singlestep=0.0001, min=0., max=0.1, collapsed=True)
+        self.addWidget('PushButton', 'sort samples', toggle=True, button_title='ON', val=0, collapsed=True)
+        self.addWidget('SpinBox', 'memory budget (MB)', val=0, min=0, max=1000000, collapsed=True)
+        self.addWidget('SpinBox', 'processes', val=1, min=1, collapsed=True)
+        self.addWidget('SpinBox', 'virtual coils', val=0, min=0, collapsed=True)
+        self.addWidget('DoubleSpinBox', 'coil compression energy (%)', val=100., decimals=2, singlestep=0.5, min=50., max=100., collapsed=True)
 
         # IO Ports
         self.addInPort('data', 'NPYarray', dtype=[np.complex64,np.complex128], obligation=gpi.REQUIRED)
         self.addInPort('coords', 'NPYarray', dtype=[np.float64, np.float32], obligation=gpi.REQUIRED)
         self.addInPort('weights', 'NPYarray', dtype=[np.float64, np.float32], obligation=gpi.REQUIRED)
+        self.addInPort('sample order', 'NPYarray', dtype=np.int64, obligation=gpi.OPTIONAL)
+        self.addInPort('params_in', 'DICT', obligation=gpi.OPTIONAL)
         self.addOutPort('out', 'NPYarray', dtype=np.complex64)
         self.addOutPort('deapodization', 'NPYarray')
+        self.addOutPort('sample order', 'NPYarray', dtype=np.int64)
+        self.addOutPort('coil compression', 'NPYarray', dtype=np.complex64)
+        self.addOutPort('profile', 'DICT')
 
     def validate(self):
 
@@ -77,8 +129,8 @@ class ExternalNode(gpi.NodeAPI):
         self.setAttr('dims per set', max=data.ndim)
         
         # check size of data vs. coords
-        if coords.shape[-1] != 2:
-            self.log.warn("Currently only for 2D data")
+        if coords.shape[-1] not in (2, 3):
+            self.log.warn("Currently only for 2D data and stacks of spirals (3D)")
             return 1
         if coords.shape[-2] != data.shape[-1]:
             self.log.warn("data and coords do not agree in the number of sampled points per arm")
@@ -110,6 +162,75 @@ class ExternalNode(gpi.NodeAPI):
         dimsperset = self.getVal('dims per set')
         oversampling_ratio = self.getVal('oversampling ratio')
         fft_and_rolloff = self.getVal('Add FFT and rolloff')
+        nthreads = self.getVal('threads')
+        separable = self.getVal('separable kernel')
+        kernel_width = self.getVal('kernel width')
+        kernel_table_size = self.getVal('kernel table size')
+        target_error = self.getVal('target error')
+        sort_samples = self.getVal('sort samples')
+        memory_mb = self.getVal('memory budget (MB)')
+        nprocs = self.getVal('processes')
+        nr_virtual_coils = self.getVal('virtual coils')
+        compression_energy = self.getVal('coil compression energy (%)')
+
+        # process-wide settings shared by the gridding and SENSE nodes (setup
+        # cache, FFT planning, compute backend and profiling)
+        try:
+            kaiser2D.configure_from_environment()
+        except ValueError as e:
+            self.log.warn(str(e))
+            return 1
+
+        # stack of spirals: the 1D FFT along kz turns it into one 2D problem
+        # per z partition, all with the same in-plane trajectory
+        stack = (coords.shape[-1] == 3)
+        if stack:
+            try:
+                [coords_2D, stack_arms, stack_partitions, mtx_z] = kaiser2D.stack_partitions3D(
+                    coords.reshape((-1,) + coords.shape[-3:]), self.getVal('mtx z (partitions)'))
+            except ValueError as e:
+                self.log.warn(str(e))
+                return 1
+            self.log.debug("stack of " + str(mtx_z) + " partitions, " + str(len(stack_partitions)) + " measured")
+            nr_samples = stack_arms.shape[1] * data.shape[-1]
+        else:
+            nr_samples = data.shape[-2] * data.shape[-1]
+
+        # FOV shift from the header, otherwise from the widgets
+        inparam = self.getData('params_in')
+        if inparam is not None:
+            try:
+                [dx, dy, dz] = kaiser2D.header_fov_shift(inparam, stack=stack)
+            except ValueError as e:
+                self.log.warn(str(e))
+                return 1
+            self.setAttr('dx (pixels)', val=dx)
+            self.setAttr('dy (pixels)', val=dy)
+            self.setAttr('dz (pixels)', val=dz)
+            self.log.debug("off-centers dx=" + str(dx) + " dy=" + str(dy) + " dz=" + str(dz))
+        dx = self.getVal('dx (pixels)')
+        dy = self.getVal('dy (pixels)')
+        dz = self.getVal('dz (pixels)') if stack else 0.
+
+        # setup that only depends on the trajectory and the gridding parameters
+        # is reused from the setup cache (shared with the other gridding and
+        # SENSE nodes)
+        cache = kaiser2D.setup_cache
+
+        # accuracy target: the cheapest kernel that reaches it (the chosen
+        # parameters are shown in the widgets), otherwise check the widget values
+        try:
+            if target_error > 0:
+                [oversampling_ratio, kernel_width, kernel_table_size] = cache.get(
+                    ('kernel parameters', target_error, mtx_original, nr_samples),
+                    lambda: kaiser2D.kaiserbessel_parameters(target_error, mtx_original, nr_samples))
+                self.setAttr('oversampling ratio', quietval=oversampling_ratio)
+                self.setAttr('kernel width', quietval=kernel_width)
+                self.setAttr('kernel table size', quietval=kernel_table_size)
+            kaiser2D.kaiserbessel_beta(oversampling_ratio, kernel_width)
+        except ValueError as e:
+            self.log.warn(str(e))
+            return 1
 
         # Determine matrix size after oversampling
         mtx = np.int(mtx_original * oversampling_ratio)
@@ -123,12 +244,28 @@ class ExternalNode(gpi.NodeAPI):
                 mtx_min = 0
                 mtx_max = mtx
 
+        # the FFTs run on the same threads
+        kaiser2D.fft_plans.nthreads = nthreads
+
+        # compute backend: the configured one, or the fastest available one
+        # for this problem size
+        with kaiser2D.profiler.stage('backend selection'):
+            backend = kaiser2D.backends.select(mtx, nr_samples, data.shape[0] if (data.ndim > 2) else 1, nthreads)
+        self.log.debug("compute backend: " + backend)
+
         # pre-calculate Kaiser-Bessel kernel
-        kernel_table_size = 800
-        kernel = kaiser2D.kaiserbessel_kernel( kernel_table_size, oversampling_ratio)
+        kernel = cache.get(('kernel', kernel_table_size, oversampling_ratio, kernel_width),
+                           lambda: kaiser2D.kaiserbessel_kernel( kernel_table_size, oversampling_ratio, kernel_width))
         # pre-calculate the rolloff for the spatial domain
-        roll = kaiser2D.rolloff2D(mtx, kernel)
-        self.setData('deapodization', roll)
+        # (the separable one as a pair of vectors)
+        broadcast = separable
+        roll = cache.get(('rolloff', mtx, oversampling_ratio, kernel_width, separable, broadcast),
+                         lambda: kaiser2D.rolloff2D_analytic(mtx, oversampling_ratio, separable=separable, broadcast=broadcast,
+                                                             kernel_width=kernel_width))
+        if separable:
+            self.setData('deapodization', roll[0] * roll[1])
+        else:
+            self.setData('deapodization', roll)
         
         # data dimensions
         nr_points = data.shape[-1]
@@ -155,30 +292,87 @@ class ExternalNode(gpi.NodeAPI):
             extra_dim2 = data.shape[-4]
         elif data.ndim > 5:
             self.log.warn("Not implemented yet")
-        out_dims_grid = [nr_coils, extra_dim2, extra_dim1, mtx, nr_arms, nr_points]
-        out_dims_fft = [nr_coils, extra_dim2, extra_dim1, mtx, mtx]
+
+        # coil compression, the cost of gridding and fft scales with the number of coils
+        if (nr_virtual_coils > 0) or (compression_energy < 100):
+            compression = kaiser2D.coil_compression_matrix2D(data, nr_virtual_coils, compression_energy)
+            self.log.debug("compress " + str(nr_coils) + " to " + str(compression.shape[0]) + " coils")
+            data = kaiser2D.compress_coils2D(data, compression)
+            nr_coils = data.shape[0]
+            self.setData('coil compression', compression)
 
         # coords dimensions: (add 1 dimension as they could have another dimension for golden angle dynamics
         if coords.ndim == 3:
-            coords.shape = [1,nr_arms,nr_points,2]
+            coords.shape = [1,nr_arms,nr_points,coords.shape[-1]]
             weights.shape = [1,nr_arms,nr_points]
+
+        # stack of spirals: z partitions as slices [nr_coils, extra_dim2*mtx_z, extra_dim1, ...],
+        # the density weights are applied in the kz transform
+        if stack:
+            data = kaiser2D.kz_transform3D(data, weights, stack_arms, stack_partitions, mtx_z, dz=dz)
+            coords = coords_2D
+            weights = np.ones(coords.shape[:-1], dtype=np.float32)
+            nr_arms = coords.shape[1]
+            extra_dim2 = data.shape[1]
         
-        # grid
-        self.log.debug("before gridding")
-        gridded_kspace = kaiser2D.grid2D(data, coords, weights, kernel, out_dims_grid)
-        self.log.debug("after gridding")
-        if fft_and_rolloff:
-            # FFT
-            image_domain = kaiser2D.fft2D(gridded_kspace, dir=0, out_dims_fft=out_dims_fft)
-            self.log.debug("after fft")
-            # rolloff
-            image_domain *= roll
-            self.log.debug("after roll")
-            self.setData('out', image_domain[...,mtx_min:mtx_max,mtx_min:mtx_max].squeeze())
-        
+        # sample order, reuse the one from the port if it fits the trajectory
+        order = None
+        if sort_samples:
+            order = self.getData('sample order')
+            if (order is None) or (order.shape != (coords.shape[0], nr_arms * nr_points)):
+                self.log.debug("sort samples")
+                order = cache.get(('sample order', mtx, kaiser2D.trajectory_hash(coords)),
+                                  lambda: kaiser2D.sample_order2D(coords, mtx))
+            self.setData('sample order', order)
+
+        def grid(data, coords, weights, order, out, nthreads, memory_mb):
+            # grid (-> fft -> rolloff -> crop) data [nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points] into out
+            kaiser2D.fft_plans.nthreads = nthreads
+            if fft_and_rolloff:
+                kaiser2D.grid_images2D(data, coords, weights, kernel, mtx, roll, mtx_max - mtx_min, out=out, memory_mb=memory_mb,
+                                       nthreads=nthreads, separable=separable, order=order, kernel_width=kernel_width,
+                                       dx=dx, dy=dy)
+            else:
+                out_dims_grid = [nr_coils, data.shape[1], data.shape[2], mtx, nr_arms, nr_points]
+                if out.flags.c_contiguous:
+                    kaiser2D.grid2D(data, coords, weights, kernel, out_dims_grid, out=out, nthreads=nthreads, separable=separable, order=order,
+                                    kernel_width=kernel_width, dx=dx, dy=dy)
+                else:
+                    out[...] = kaiser2D.grid2D(data, coords, weights, kernel, out_dims_grid, nthreads=nthreads, separable=separable, order=order,
+                                               kernel_width=kernel_width, dx=dx, dy=dy)
+
+        mtx_out = mtx_max - mtx_min if fft_and_rolloff else mtx
+        out_dims = [nr_coils, extra_dim2, extra_dim1, mtx_out, mtx_out]
+        if (nprocs > 1) and (extra_dim2 * extra_dim1 > 1):
+            # each slice / dynamic is an independent problem, grid them on
+            # worker processes into shared memory
+            if kaiser2D.threads_running():
+                self.log.warn("threads are already running in this process, gridding the slices serially")
+            else:
+                self.log.debug("grid on " + str(nprocs) + " processes")
+            out = kaiser2D.shared_zeros(out_dims, np.complex64)
+            nthreads_per_proc = max(1, nthreads // nprocs)
+            def grid_slice(e2, e1):
+                crd_set = e1 if (coords.shape[0] > 1) else 0
+                crds = slice(crd_set, crd_set + 1)
+                grid(data[:, e2:e2+1, e1:e1+1], coords[crds], weights[crds], None if order is None else order[crds],
+                     out[:, e2:e2+1, e1:e1+1], nthreads_per_proc, memory_mb / nprocs)
+            kaiser2D.map_slices2D(grid_slice, extra_dim2, extra_dim1, nprocs)
         else:
-            self.setData('out', gridded_kspace.squeeze())
-            
+            self.log.debug("before gridding")
+            out = np.zeros(out_dims, dtype=np.complex64)
+            grid(data, coords, weights, order, out, nthreads, memory_mb)
+            self.log.debug("after gridding")
+        if stack:
+            # [nr_coils, extra_dim2, extra_dim1, mtx_z, mtx_out, mtx_out]
+            out = np.ascontiguousarray(np.moveaxis(out.reshape(nr_coils, -1, mtx_z, extra_dim1, mtx_out, mtx_out), 2, 3))
+        self.setData('out', out.squeeze())
+        self.log.debug("setup cache: " + str(cache.stats()))
+        if kaiser2D.profiler.enabled:
+            self.setData('profile', kaiser2D.profiler.summary())
+            if kaiser2D.profiler.filename:
+                kaiser2D.profiler.save(kaiser2D.profiler.filename)
+
         return 0 
 
     def execType(self):
@@ -0,0 +1,589 @@
+# compute backends for the 2D gridding in Kaiser2D_utils: gridding,
+# degridding, sample order, kernel table and FFT behind one interface, so
+# the gridding also runs where the PyFI build is unavailable (or slower)
+
+import numpy as np
+
+# samples per block of the vectorized kernel evaluation
+_SAMPLE_BLOCK = 2**15
+
+# default and largest Kaiser-Bessel kernel width in k-space pixels
+# (KERNEL_WIDTH and MAX_KERNEL_WIDTH in kaiserbessel.cpp)
+KERNEL_WIDTH = 5.0
+MAX_KERNEL_WIDTH = 8.0
+
+class GriddingBackend(object):
+    # Interface of a compute backend: the functions of the PyFI module
+    # bni.gridding.grid_kaiser (see grid_kaiser_PyMOD.cpp and gridding.cpp
+    # for the array layouts) and the centered FFT of core.math.fft.
+    #   kaiserbessel_kernel(outdim, oversampling_ratio, kernel_width=KERNEL_WIDTH)
+    #   grid(crds, data, weights, kernel, outdim, dx, dy, nthreads=1, separable=0, kernel_width=KERNEL_WIDTH)
+    #   grid_batch(crds, data, weights, kernel, outdata, dx, dy, order, nthreads=1, separable=0, kernel_width=KERNEL_WIDTH)
+    #   degrid_batch(crds, data, kernel, outdata, order, nthreads=1, separable=0, kernel_width=KERNEL_WIDTH, dx=0., dy=0.)
+    #   grid_plan(crds, kernel, outdim, separable=0, kernel_width=KERNEL_WIDTH)
+    #   grid_sort(crds, outdim, tile_width=8)
+    #   fftw(data, outdims, dir=0, dim1=0, dim2=0, dim3=0, dim4=0, dim5=0, nthreads=1)
+    # The results of all backends are equal up to float rounding and the
+    # summation order.
+    name = None
+
+    def available(self):
+        return True
+
+class PyFIBackend(GriddingBackend):
+    # the C++ extension (grid_kaiser_PyMOD.cpp) and core.math.fft, the FFT
+    # threads are up to core.math.fft
+    name = 'pyfi'
+
+    def available(self):
+        try:
+            import bni.gridding.grid_kaiser
+            import core.math.fft
+        except ImportError:
+            return False
+        return True
+
+    def kaiserbessel_kernel(self, outdim, oversampling_ratio, kernel_width=KERNEL_WIDTH):
+        import bni.gridding.grid_kaiser as bni_grid
+        return bni_grid.kaiserbessel_kernel(outdim, np.float64(oversampling_ratio), kernel_width=kernel_width)
+
+    def grid(self, crds, data, weights, kernel, outdim, dx, dy, nthreads=1, separable=0, kernel_width=KERNEL_WIDTH):
+        import bni.gridding.grid_kaiser as bni_grid
+        return bni_grid.grid(crds, data, weights, kernel, outdim, dx, dy, nthreads=nthreads, separable=separable, kernel_width=kernel_width)
+
+    def grid_batch(self, crds, data, weights, kernel, outdata, dx, dy, order, nthreads=1, separable=0, kernel_width=KERNEL_WIDTH):
+        import bni.gridding.grid_kaiser as bni_grid
+        bni_grid.grid_batch(crds, data, weights, kernel, outdata, dx, dy, order, nthreads=nthreads, separable=separable, kernel_width=kernel_width)
+
+    def degrid_batch(self, crds, data, kernel, outdata, order, nthreads=1, separable=0, kernel_width=KERNEL_WIDTH, dx=0., dy=0.):
+        import bni.gridding.grid_kaiser as bni_grid
+        bni_grid.degrid_batch(crds, data, kernel, outdata, order, nthreads=nthreads, separable=separable, kernel_width=kernel_width,
+                              dx=dx, dy=dy)
+
+    def grid_plan(self, crds, kernel, outdim, separable=0, kernel_width=KERNEL_WIDTH):
+        import bni.gridding.grid_kaiser as bni_grid
+        return bni_grid.grid_plan(crds, kernel, outdim, separable=separable, kernel_width=kernel_width)
+
+    def grid_sort(self, crds, outdim, tile_width=8):
+        import bni.gridding.grid_kaiser as bni_grid
+        return bni_grid.grid_sort(crds, outdim, tile_width=tile_width)
+
+    def fftw(self, data, outdims, dir=0, dim1=0, dim2=0, dim3=0, dim4=0, dim5=0, nthreads=1):
+        import core.math.fft as corefft
+        return corefft.fftw(data, outdims, dir=dir, dim1=dim1, dim2=dim2, dim3=dim3, dim4=dim4, dim5=dim5)
+
+def _sample_weights(crds, weights, dx, dy):
+    # density weights times the phase of the (dx, dy) pixel shift
+    #   crds: [nr_samples, 2], weights: [nr_samples]
+    if (dx == 0) and (dy == 0):
+        return weights
+    phase = np.exp(-2j * np.pi * (crds[:, 0] * dx + crds[:, 1] * dy))
+    return (weights * phase).astype(np.complex64)
+
+def _unshift_samples(crds, samples, dx, dy):
+    # undo the (dx, dy) pixel shift of the gridding on degridded samples (in
+    # place), the adjoint of the phase in _sample_weights()
+    #   crds: [nr_samples, 2], samples: [..., nr_samples]
+    if (dx != 0) or (dy != 0):
+        samples *= np.exp(2j * np.pi * (crds[:, 0] * dx + crds[:, 1] * dy)).astype(np.complex64)
+
+class NumpyBackend(GriddingBackend):
+    # NumPy / SciPy: the gridding is a sparse multiply with the interpolation
+    # matrix of the samples (built per call, vectorized), the FFT is
+    # scipy.fft with workers.  The FFT is scaled like core.math.fft, unitary
+    # (norm='ortho': 1/sqrt(N) in both directions), and dir 0 is the forward
+    # transform; test_Kaiser2D_utils compares the two where PyFI is built.
+    # The sample order only changes the summation order and is not used.
+    name = 'numpy'
+
+    def available(self):
+        try:
+            import scipy.fft
+            import scipy.sparse
+        except ImportError:
+            return False
+        return True
+
+    def kaiserbessel_kernel(self, outdim, oversampling_ratio, kernel_width=KERNEL_WIDTH):
+        # kaiserbessel.cpp: the table is indexed by the squared radius
+        from bni.gridding.Kaiser2D_utils import kaiserbessel_beta
+        size = int(outdim[0])
+        beta = kaiserbessel_beta(oversampling_ratio, kernel_width)
+        radius_sqr = np.arange(size) / float(size - 1)
+        table = np.i0(beta * np.sqrt(np.maximum(1.0 - radius_sqr, 0))) / np.i0(beta)
+        table[0] = 1.0
+        table[-1] = 0.0
+        return table.astype(np.float32)
+
+    def _window(self, crds, kernel, width, separable, kernel_width):
+        # kernel weights of the neighborhood of each sample (GridKernel in
+        # gridding.cpp, in single precision like the C++ code)
+        #   crds: np.float32 [nr_samples, 2]
+        #   OUTPUT: flat grid index np.int64 and kernel weight np.float32,
+        #           both [nr_samples, window_width**2], neighbors outside the
+        #           grid or the kernel radius have weight 0
+        f32 = np.float32
+        radius = f32(kernel_width / 2.0)
+        window_width = int(2 * radius) + 1
+        width_div2 = width // 2
+        width_inv = f32(1.0 / width)
+        radius_sqr = f32(kernel_width / 2.0 / width)**2
+        dist_multiplier = f32((kernel.shape[0] - 1) / radius_sqr)
+
+        def axis(u):
+            # grid points and squared distances along one axis
+            center = u * f32(width) + f32(width_div2)
+            lo = np.maximum(np.ceil(center - radius), 0).astype(np.int64)
+            hi = np.minimum(np.floor(center + radius), width - 1).astype(np.int64)
+            points = lo[:, np.newaxis] + np.arange(window_width)
+            inside = points <= hi[:, np.newaxis]
+            dist_sqr = ((points - width_div2).astype(f32) * width_inv - u[:, np.newaxis])**2
+            return points, inside, dist_sqr
+
+        def lookup(dist_sqr):
+            table_index = np.minimum(np.rint(dist_sqr * dist_multiplier), kernel.shape[0] - 1).astype(np.int64)
+            return np.where(dist_sqr < radius_sqr, kernel[table_index], f32(0))
+
+        [i, inside_i, dx2] = axis(crds[:, 0])
+        [j, inside_j, dy2] = axis(crds[:, 1])
+        inside = inside_j[:, :, np.newaxis] & inside_i[:, np.newaxis, :]
+        if separable:
+            values = lookup(dy2)[:, :, np.newaxis] * lookup(dx2)[:, np.newaxis, :]
+        else:
+            values = lookup(dy2[:, :, np.newaxis] + dx2[:, np.newaxis, :])
+        indices = np.where(inside, j[:, :, np.newaxis] * width + i[:, np.newaxis, :], 0)
+        values = np.where(inside, values, f32(0)).astype(f32)
+        nr_neighbors = window_width * window_width
+        return indices.reshape(-1, nr_neighbors), values.reshape(-1, nr_neighbors)
+
+    def _matrix(self, crds, kernel, width, separable, kernel_width):
+        # [nr_samples, width*width] CSR interpolation matrix of the samples
+        import scipy.sparse
+        crds = np.ascontiguousarray(crds, dtype=np.float32).reshape(-1, 2)
+        blocks = []
+        for p in range(0, crds.shape[0], _SAMPLE_BLOCK):
+            [indices, values] = self._window(crds[p:p + _SAMPLE_BLOCK], kernel, width, separable, kernel_width)
+            indptr = np.arange(0, indices.size + 1, indices.shape[1])
+            A = scipy.sparse.csr_matrix((values.ravel(), indices.ravel(), indptr), shape=(indices.shape[0], width * width))
+            A.eliminate_zeros()
+            blocks.append(A)
+        if len(blocks) == 1:
+            return blocks[0]
+        return scipy.sparse.vstack(blocks, format='csr')
+
+    def grid(self, crds, data, weights, kernel, outdim, dx, dy, nthreads=1, separable=0, kernel_width=KERNEL_WIDTH):
+        width = int(outdim[0])
+        out = np.zeros([1, 1, width, width], dtype=np.complex64)
+        self.grid_batch(np.reshape(crds, (1, -1, 2)), np.reshape(data, (1, 1, -1)), np.reshape(weights, (1, -1)),
+                        kernel, out, dx, dy, None, nthreads=nthreads, separable=separable, kernel_width=kernel_width)
+        return out[0, 0]
+
+    def grid_batch(self, crds, data, weights, kernel, outdata, dx, dy, order, nthreads=1, separable=0, kernel_width=KERNEL_WIDTH):
+        # crds [nr_sets, nr_samples, 2], data [nr_batch, extra_dim1, nr_samples],
+        # weights [nr_sets, nr_samples], outdata [nr_batch, extra_dim1, m, m]
+        from bni.gridding.Kaiser2D_utils import sparse_dot
+        [nr_batch, extra_dim1, nr_samples] = data.shape
+        width = outdata.shape[-1]
+        nr_sets = crds.shape[0]
+        for s in range(nr_sets):
+            # a single coordinate set is shared by all of extra_dim1
+            extra = slice(None) if (nr_sets == 1) else slice(s, s + 1)
+            A_adj = self._matrix(crds[s], kernel, width, separable, kernel_width).T.tocsr()
+            d = data[:, extra, :] * _sample_weights(crds[s], weights[s], dx, dy)
+            d = d.reshape(-1, nr_samples).T
+            g = sparse_dot(A_adj, d, nthreads)
+            outdata[:, extra] = g.T.reshape(nr_batch, -1, width, width)
+
+    def degrid_batch(self, crds, data, kernel, outdata, order, nthreads=1, separable=0, kernel_width=KERNEL_WIDTH, dx=0., dy=0.):
+        # crds [nr_sets, nr_samples, 2], data [nr_batch, extra_dim1, m, m],
+        # outdata [nr_batch, extra_dim1, nr_samples]
+        from bni.gridding.Kaiser2D_utils import sparse_dot
+        [nr_batch, extra_dim1, width] = data.shape[:3]
+        nr_samples = outdata.shape[-1]
+        nr_sets = crds.shape[0]
+        for s in range(nr_sets):
+            extra = slice(None) if (nr_sets == 1) else slice(s, s + 1)
+            A = self._matrix(crds[s], kernel, width, separable, kernel_width)
+            g = data[:, extra].reshape(-1, width * width).T
+            d = sparse_dot(A, g, nthreads)
+            outdata[:, extra] = d.T.reshape(nr_batch, -1, nr_samples)
+            _unshift_samples(crds[s], outdata[:, extra], dx, dy)
+
+    def grid_plan(self, crds, kernel, outdim, separable=0, kernel_width=KERNEL_WIDTH):
+        # like gridding.cpp, but the neighbors of a sample keep their place
+        # in the (clipped) window instead of being packed to the front
+        width = int(outdim[0])
+        flat = np.ascontiguousarray(crds, dtype=np.float32).reshape(-1, 2)
+        indices = []
+        values = []
+        for p in range(0, flat.shape[0], _SAMPLE_BLOCK):
+            [i, v] = self._window(flat[p:p + _SAMPLE_BLOCK], kernel, width, separable, kernel_width)
+            indices.append(i)
+            values.append(v)
+        shape = crds.shape[:-1] + (indices[0].shape[-1],)
+        return np.concatenate(indices).reshape(shape), np.concatenate(values).reshape(shape)
+
+    def grid_sort(self, crds, outdim, tile_width=8):
+        # tiles in Morton order, acquisition order within a tile
+        width = int(outdim[0])
+        width_div2 = width // 2
+        tiles = []
+        for u in (crds[..., 0], crds[..., 1]):
+            grid_point = np.rint(u * np.float32(width) + np.float32(width_div2))
+            tiles.append(np.clip(grid_point, 0, width - 1).astype(np.uint64) // np.uint64(tile_width))
+        key = np.zeros(tiles[0].shape, dtype=np.uint64)
+        for bit in range(32):
+            b = np.uint64(bit)
+            key |= ((tiles[0] >> b) & np.uint64(1)) << np.uint64(2 * bit)
+            key |= ((tiles[1] >> b) & np.uint64(1)) << np.uint64(2 * bit + 1)
+        return np.argsort(key, axis=-1, kind='stable').astype(np.int64)
+
+    def fftw(self, data, outdims, dir=0, dim1=0, dim2=0, dim3=0, dim4=0, dim5=0, nthreads=1):
+        # outdims and dim1..dim5 in fortran order (dim1 is the last axis)
+        import scipy.fft
+        shape = tuple(int(n) for n in list(outdims)[::-1])
+        flags = [dim1, dim2, dim3, dim4, dim5]
+        axes = tuple(data.ndim - 1 - d for d in range(min(5, data.ndim)) if flags[d])
+
+        # zero-pad / crop, centered
+        out = np.zeros(shape, dtype=np.complex64)
+        src = []
+        dst = []
+        for n_in, n_out in zip(data.shape, shape):
+            if n_out >= n_in:
+                src.append(slice(None))
+                dst.append(slice(n_out // 2 - n_in // 2, n_out // 2 - n_in // 2 + n_in))
+            else:
+                src.append(slice(n_in // 2 - n_out // 2, n_in // 2 - n_out // 2 + n_out))
+                dst.append(slice(None))
+        out[tuple(dst)] = data[tuple(src)]
+
+        transform = scipy.fft.fftn if (dir == 0) else scipy.fft.ifftn
+        out = np.fft.ifftshift(out, axes=axes)
+        out = transform(out, axes=axes, norm='ortho', workers=nthreads, overwrite_x=True)
+        return np.fft.fftshift(out, axes=axes).astype(np.complex64, copy=False)
+
+def _numba_kernels():
+    # gridding loops compiled with numba (gridding.cpp in numba), compiled
+    # on first use and cached on disk
+    import numba
+
+    @numba.njit(cache=True)
+    def bounds(x, y, width, radius):
+        # grid window of the kernel around (x, y), clipped to the grid
+        width_div2 = width // 2
+        cx = x * width + width_div2
+        cy = y * width + width_div2
+        imin = max(int(np.ceil(cx - radius)), 0)
+        imax = min(int(np.floor(cx + radius)), width - 1)
+        jmin = max(int(np.ceil(cy - radius)), 0)
+        jmax = min(int(np.floor(cy + radius)), width - 1)
+        return imin, imax, jmin, jmax
+
+    @numba.njit(cache=True)
+    def window(x, y, table, width, radius, separable, ker):
+        # kernel weights of the neighborhood of (x, y) into ker (row-major),
+        # returns the window bounds
+        width_div2 = width // 2
+        radius_sqr = (radius / width)**2
+        dist_multiplier = (table.shape[0] - 1) / radius_sqr
+        imin, imax, jmin, jmax = bounds(x, y, width, radius)
+        k = 0
+        for j in range(jmin, jmax + 1):
+            dy2 = ((j - width_div2) / width - y)**2
+            for i in range(imin, imax + 1):
+                dx2 = ((i - width_div2) / width - x)**2
+                if separable:
+                    wx = table[int(np.rint(dx2 * dist_multiplier))] if dx2 < radius_sqr else 0.
+                    wy = table[int(np.rint(dy2 * dist_multiplier))] if dy2 < radius_sqr else 0.
+                    ker[k] = wx * wy
+                else:
+                    d2 = dx2 + dy2
+                    ker[k] = table[int(np.rint(d2 * dist_multiplier))] if d2 < radius_sqr else 0.
+                k += 1
+        return imin, imax, jmin, jmax
+
+    @numba.njit(cache=True)
+    def slab_samples(crds, width, radius, nr_slabs):
+        # the samples of each row slab in one pass over the coordinates
+        # (_grid2_slab_samples in gridding.cpp): a sample is listed for
+        # every slab its kernel overlaps, in acquisition order, samples off
+        # the grid are left out.  Slab t of set s holds the samples
+        # samples[s, offsets[s, t]:offsets[s, t + 1]].
+        nr_sets = crds.shape[0]
+        nr_samples = crds.shape[1]
+        slab_of_row = np.empty(width, dtype=np.int64)
+        for t in range(nr_slabs):
+            slab_of_row[width * t // nr_slabs:width * (t + 1) // nr_slabs] = t
+        first = np.zeros((nr_sets, nr_samples), dtype=np.int64)
+        last = np.full((nr_sets, nr_samples), -1, dtype=np.int64)
+        offsets = np.zeros((nr_sets, nr_slabs + 1), dtype=np.int64)
+        for s in range(nr_sets):
+            for p in range(nr_samples):
+                imin, imax, jmin, jmax = bounds(crds[s, p, 0], crds[s, p, 1], width, radius)
+                if jmin > jmax:
+                    continue
+                first[s, p] = slab_of_row[jmin]
+                last[s, p] = slab_of_row[jmax]
+                for t in range(first[s, p], last[s, p] + 1):
+                    offsets[s, t + 1] += 1
+            for t in range(nr_slabs):
+                offsets[s, t + 1] += offsets[s, t]
+        samples = np.empty((nr_sets, max(1, offsets[:, -1].max())), dtype=np.int64)
+        for s in range(nr_sets):
+            fill = offsets[s, :-1].copy()
+            for p in range(nr_samples):
+                for t in range(first[s, p], last[s, p] + 1):
+                    samples[s, fill[t]] = p
+                    fill[t] += 1
+        return samples, offsets
+
+    @numba.njit(parallel=True, cache=True)
+    def grid(crds, weights, data, out, table, radius, separable, samples, offsets):
+        # each slab of grid rows is accumulated by one thread from its own
+        # samples (slab_samples())
+        nr_sets = crds.shape[0]
+        nr_batch = data.shape[0]
+        extra_dim1 = data.shape[1]
+        width = out.shape[-1]
+        nr_slabs = offsets.shape[1] - 1
+        window_width = int(2 * radius) + 1
+        for t in numba.prange(nr_slabs):
+            jlo = width * t // nr_slabs
+            jhi = width * (t + 1) // nr_slabs
+            ker = np.empty(window_width * window_width, dtype=np.float32)
+            for s in range(nr_sets):
+                e_first = 0 if (nr_sets == 1) else s
+                e_last = extra_dim1 if (nr_sets == 1) else s + 1
+                for q in range(offsets[s, t], offsets[s, t + 1]):
+                    p = samples[s, q]
+                    imin, imax, jmin, jmax = window(crds[s, p, 0], crds[s, p, 1], table, width, radius, separable, ker)
+                    row_len = imax - imin + 1
+                    for e in range(e_first, e_last):
+                        for b in range(nr_batch):
+                            d = data[b, e, p] * weights[s, p]
+                            for j in range(max(jmin, jlo), min(jmax, jhi - 1) + 1):
+                                k = (j - jmin) * row_len
+                                for i in range(imin, imax + 1):
+                                    out[b, e, j, i] += ker[k] * d
+                                    k += 1
+
+    @numba.njit(parallel=True, cache=True)
+    def degrid(crds, data, out, table, radius, separable, nr_ranges):
+        # each range of samples is degridded by one thread
+        nr_sets = crds.shape[0]
+        nr_samples = crds.shape[1]
+        nr_batch = data.shape[0]
+        extra_dim1 = data.shape[1]
+        width = data.shape[-1]
+        window_width = int(2 * radius) + 1
+        for t in numba.prange(nr_ranges):
+            plo = nr_samples * t // nr_ranges
+            phi = nr_samples * (t + 1) // nr_ranges
+            ker = np.empty(window_width * window_width, dtype=np.float32)
+            for s in range(nr_sets):
+                e_first = 0 if (nr_sets == 1) else s
+                e_last = extra_dim1 if (nr_sets == 1) else s + 1
+                for p in range(plo, phi):
+                    imin, imax, jmin, jmax = window(crds[s, p, 0], crds[s, p, 1], table, width, radius, separable, ker)
+                    for e in range(e_first, e_last):
+                        for b in range(nr_batch):
+                            d = 0j
+                            k = 0
+                            for j in range(jmin, jmax + 1):
+                                for i in range(imin, imax + 1):
+                                    d += data[b, e, j, i] * ker[k]
+                                    k += 1
+                            out[b, e, p] = d
+
+    return slab_samples, grid, degrid
+
+class NumbaBackend(NumpyBackend):
+    # gridding and degridding loops compiled with numba, threaded like the
+    # C++ code (row slabs with their own samples for gridding, sample ranges
+    # for degridding), the rest from NumpyBackend.  The loops are compiled
+    # on first use, the compiled code is cached next to this module.
+    name = 'numba'
+
+    def __init__(self):
+        self._kernels = None
+
+    def available(self):
+        try:
+            import numba
+        except ImportError:
+            return False
+        return NumpyBackend.available(self)
+
+    def _compiled(self, nthreads):
+        import numba
+        if self._kernels is None:
+            self._kernels = _numba_kernels()
+        numba.set_num_threads(max(1, min(nthreads, numba.config.NUMBA_NUM_THREADS)))
+        return self._kernels
+
+    def grid_batch(self, crds, data, weights, kernel, outdata, dx, dy, order, nthreads=1, separable=0, kernel_width=KERNEL_WIDTH):
+        [slab_samples, grid, degrid] = self._compiled(nthreads)
+        nr_sets = crds.shape[0]
+        crds = np.ascontiguousarray(crds, dtype=np.float32)
+        sample_weights = np.stack([_sample_weights(crds[s], weights[s], dx, dy) for s in range(nr_sets)]).astype(np.complex64)
+        [samples, offsets] = slab_samples(crds, outdata.shape[-1], kernel_width / 2.0, max(1, min(nthreads, outdata.shape[-1])))
+        outdata[...] = 0
+        grid(crds, sample_weights, np.ascontiguousarray(data), outdata,
+             kernel.astype(np.float32, copy=False), kernel_width / 2.0, bool(separable), samples, offsets)
+
+    def degrid_batch(self, crds, data, kernel, outdata, order, nthreads=1, separable=0, kernel_width=KERNEL_WIDTH, dx=0., dy=0.):
+        [slab_samples, grid, degrid] = self._compiled(nthreads)
+        degrid(np.ascontiguousarray(crds, dtype=np.float32), np.ascontiguousarray(data), outdata,
+               kernel.astype(np.float32, copy=False), kernel_width / 2.0, bool(separable), max(1, min(nthreads, outdata.shape[-1])))
+        for s in range(crds.shape[0]):
+            extra = slice(None) if (crds.shape[0] == 1) else slice(s, s + 1)
+            _unshift_samples(crds[s], outdata[:, extra], dx, dy)
+
+class BackendRegistry(object):
+    # The compute backends in order of preference and the one in use
+    # (current), by default the first available one.  With the name 'auto',
+    # select() picks the fastest available backend for a problem size with a
+    # short benchmark (grid, degrid and two FFTs of random samples).  The
+    # choice is kept per problem size and, with a selection_file, across
+    # processes (GPI forks one per execution).
+    #
+    # backends: list of GriddingBackend
+
+    def __init__(self, backends):
+        self.backends = list(backends)
+        self.selections = {}
+        self._current = None
+        self._available = None
+        self._selections_loaded = False
+        self.configure()
+
+    @property
+    def current(self):
+        # the selected backend, before any selection the first available one
+        if self._current is None:
+            if not self.available():
+                raise ValueError("no compute backend is available")
+            self._current = self.get(self.available()[0])
+        return self._current
+
+    def names(self):
+        return [b.name for b in self.backends]
+
+    def available(self):
+        if self._available is None:
+            self._available = [b.name for b in self.backends if b.available()]
+        return self._available
+
+    def get(self, name):
+        if name not in self.available():
+            raise ValueError("compute backend '" + str(name) + "' is not available, available: " + str(self.available()))
+        return self.backends[self.names().index(name)]
+
+    def configure(self, name=None, selection_file=None):
+        # name: a backend name, 'auto', or None for the first available one
+        #       (pyfi where PyFI is built)
+        # selection_file: path of the stored 'auto' choices (optional)
+        if selection_file != getattr(self, 'selection_file', None):
+            self._selections_loaded = False
+        self.name = name
+        self.selection_file = selection_file
+        if name is None:
+            self._current = None
+        elif name != 'auto':
+            self._current = self.get(name)
+
+    def select(self, mtx_xy, nr_samples, nr_batch=1, nthreads=1):
+        # backend for gridding nr_batch images of mtx_xy^2 (oversampled)
+        # from nr_samples samples with nthreads, made current, returns its name
+        if self.name != 'auto':
+            return self.current.name
+        self._load_selections()
+
+        # problem sizes that are benchmarked the same share the choice
+        [nr_samples, nr_batch] = self._benchmark_size(nr_samples, nr_batch)
+        key = '%d %d %d %d' % (mtx_xy, nr_samples, nr_batch, nthreads)
+        if self.selections.get(key) not in self.available():
+            timings = self.benchmark(mtx_xy, nr_samples, nr_batch, nthreads)
+            self.selections[key] = min(timings, key=timings.get)
+            self._save_selections()
+        self._current = self.get(self.selections[key])
+        return self._current.name
+
+    def _benchmark_size(self, nr_samples, nr_batch):
+        # samples rounded up to a power of 2, both limited to keep the
+        # benchmark short
+        nr_samples = 2**int(np.ceil(np.log2(max(1, min(nr_samples, 2**16)))))
+        return nr_samples, min(nr_batch, 8)
+
+    def benchmark(self, mtx_xy, nr_samples, nr_batch=1, nthreads=1, repeat=3):
+        # seconds of grid + degrid + 2 FFTs for each available backend (the
+        # best of repeat runs after a warm-up run, fewer runs for a backend
+        # that is already several times slower than the fastest so far),
+        # backends that fail are left out
+        import time
+        [nr_samples, nr_batch] = self._benchmark_size(nr_samples, nr_batch)
+        rng = np.random.RandomState(0)
+        crds = (rng.uniform(-0.5, 0.5, (1, nr_samples, 2))).astype(np.float32)
+        weights = np.ones((1, nr_samples), dtype=np.float32)
+        data = (rng.standard_normal((nr_batch, 1, nr_samples)) + 1j * rng.standard_normal((nr_batch, 1, nr_samples))).astype(np.complex64)
+        grid = np.zeros((nr_batch, 1, mtx_xy, mtx_xy), dtype=np.complex64)
+        samples = np.zeros((nr_batch, 1, nr_samples), dtype=np.complex64)
+        outdims = np.array([mtx_xy, mtx_xy, 1, nr_batch], dtype=np.int64)
+        no_order = np.array([-1], dtype=np.int64)
+
+        timings = {}
+        for name in self.available():
+            backend = self.get(name)
+            try:
+                kernel = backend.kaiserbessel_kernel(np.array([800], dtype=np.int64), 1.375)
+                best = None
+                for r in range(repeat + 1):
+                    t = time.time()
+                    backend.grid_batch(crds, data, weights, kernel, grid, 0., 0., no_order, nthreads=nthreads)
+                    image = backend.fftw(grid, outdims, dir=0, dim1=1, dim2=1, nthreads=nthreads)
+                    kspace = backend.fftw(image, outdims, dir=1, dim1=1, dim2=1, nthreads=nthreads)
+                    backend.degrid_batch(crds, np.ascontiguousarray(kspace), kernel, samples, no_order, nthreads=nthreads)
+                    if r > 0:
+                        best = min(best, time.time() - t) if (best is not None) else time.time() - t
+                        if timings and (best > 4 * min(timings.values())):
+                            break
+                timings[name] = best
+            except Exception:
+                continue
+        return timings
+
+    def _load_selections(self):
+        import json
+        import os
+        from bni.gridding.Kaiser2D_cache import _private_directory
+        if self._selections_loaded or (self.selection_file is None):
+            return
+        self._selections_loaded = True
+        if not _private_directory(os.path.dirname(self.selection_file)):
+            return
+        try:
+            with open(self.selection_file, 'r') as f:
+                stored = json.load(f)
+        except Exception:
+            return
+        if isinstance(stored, dict):
+            stored.update(self.selections)
+            self.selections = stored
+
+    def _save_selections(self):
+        import json
+        from bni.gridding.Kaiser2D_cache import _atomic_write
+        if self.selection_file is None:
+            return
+        _atomic_write(self.selection_file, lambda f: json.dump(self.selections, f, indent=1, sort_keys=True), mode='w')
+
+def default_backend_selection_file():
+    # backends chosen by backends.select() per problem size, next to the
+    # setup cache
+    import os
+    from bni.gridding.Kaiser2D_cache import default_setup_cache_directory
+    return os.path.join(default_setup_cache_directory(), 'backend_selection.json')
+
+# compute backends of this process, see BackendRegistry.configure()
+backends = BackendRegistry([PyFIBackend(), NumbaBackend(), NumpyBackend()])
@@ -0,0 +1,238 @@
+# setup cache of the gridding and SENSE nodes: the setup that only depends
+# on the trajectory and the gridding parameters (kernel tables, rolloffs,
+# gridding plans, ...) kept in memory and in a private disk store, so GPI's
+# forked node processes can reuse it
+
+import numpy as np
+
+def _private_directory(directory):
+    # Create directory accessible only by this user (mode 0700), or check
+    # that an existing one is safe to read cached setup from: a directory
+    # (not a symlink) owned by this user that others can't write to.
+    # False if it can't be used.
+    import os
+    import stat
+    directory = directory or os.curdir
+    try:
+        if not os.path.lexists(directory):
+            os.makedirs(directory, mode=0o700)
+        st = os.lstat(directory)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(st.st_mode):
+        return False
+    if hasattr(os, 'getuid'):
+        return (st.st_uid == os.getuid()) and not (st.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+    return True
+
+def _read_arrays(path):
+    # dict of the arrays of an .npz file of _atomic_write() (read without
+    # pickle), None if the file is missing, unreadable, or in a directory
+    # that isn't private (see _private_directory())
+    import os
+    if not (os.path.exists(path) and _private_directory(os.path.dirname(path))):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as f:
+            return dict((name, f[name]) for name in f.files)
+    except Exception:
+        return None
+
+def _atomic_write(path, writer, mode='wb'):
+    # Write a file of the setup cache directory with writer(f) under a
+    # temporary name and rename it, so concurrent readers (other GPI
+    # processes) never see a partial file.  Only writes into a private
+    # directory (see _private_directory()).  The stores are only caches,
+    # failures are ignored.
+    #   writer: callable(f), f the file opened with mode
+    import os
+    if not _private_directory(os.path.dirname(path)):
+        return
+    tmp_path = path + '.' + str(os.getpid())
+    try:
+        with open(tmp_path, mode) as f:
+            writer(f)
+        os.rename(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+def default_setup_cache_directory():
+    # disk store of the setup cache shared by the gridding and SENSE nodes,
+    # one per user (created private, see _private_directory())
+    import os
+    import tempfile
+    name = 'bni_gridding_setup_cache'
+    if hasattr(os, 'getuid'):
+        name += '_' + str(os.getuid())
+    return os.path.join(tempfile.gettempdir(), name)
+
+def _nbytes(value):
+    # approximate memory footprint of a cached value
+    import sys
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    return sys.getsizeof(value)
+
+class SetupCache(object):
+    # LRU cache for the setup that only depends on the trajectory and the
+    # gridding parameters: kernel tables, rolloffs, gridding plans, sample
+    # orders and Toeplitz kernels.  Keys are tuples such as
+    # ('plan', mtx, oversampling ratio, table size, separable,
+    # trajectory_hash(coords, weights)).  The least recently used entries
+    # are evicted once the cache holds more than max_mb.  Cached values are
+    # shared by all callers and must not be modified.
+    #
+    # GPI runs nodes in forked processes, whose memory is gone after the
+    # execution, so entries are also saved into a disk store (optional)
+    # that is capped and evicted (by modification time) the same way.  The
+    # store holds .npz files that are read without pickle, so only arrays,
+    # tuples of arrays and numbers, and GriddingPlans are saved, other values
+    # are only cached in memory.  It is only used in a directory private to
+    # the user (see _private_directory()), a file that can't be read is a
+    # miss.
+    #
+    # max_mb: size limit in MB of the memory and of the disk store
+    #         (0: no caching)
+    # directory: path of the disk store (optional)
+    #
+    # hits, disk_hits, misses: counters of get()
+
+    def __init__(self, max_mb=0, directory=None):
+        import collections
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.configure(max_mb, directory)
+
+    def configure(self, max_mb, directory=None):
+        self.max_mb = max_mb
+        self.directory = directory
+        self._evict()
+
+    def get(self, key, compute):
+        # cached value for key, compute() on a miss
+        if self.max_mb <= 0:
+            return compute()
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+        value = self._load(key)
+        if value is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            value = compute()
+            self._save(key, value)
+        nbytes = _nbytes(value)
+        self.entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        self._evict()
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'disk hits': self.disk_hits, 'misses': self.misses,
+                'entries': len(self.entries), 'MB': self.nbytes / 2.0**20}
+
+    def _evict(self):
+        # a disabled cache (max_mb 0) is bypassed, not emptied
+        if self.max_mb <= 0:
+            return
+        max_bytes = self.max_mb * 2**20
+        while self.entries and (self.nbytes > max_bytes):
+            key, (value, nbytes) = self.entries.popitem(last=False)
+            self.nbytes -= nbytes
+        if (self.directory is not None) and _private_directory(self.directory):
+            import os
+            import glob
+            files = sorted(glob.glob(os.path.join(self.directory, 'setup_*.npz')), key=os.path.getmtime)
+            sizes = [os.path.getsize(f) for f in files]
+            while files and (sum(sizes) > max_bytes):
+                os.remove(files.pop(0))
+                sizes.pop(0)
+
+    def _path(self, key):
+        import os
+        import hashlib
+        return os.path.join(self.directory, 'setup_' + hashlib.sha1(repr(key).encode()).hexdigest() + '.npz')
+
+    def _load(self, key):
+        import os
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        arrays = _read_arrays(path)
+        if arrays is None:
+            return None
+        try:
+            value = _cache_value(arrays)
+            os.utime(path, None)
+        except Exception:
+            return None
+        return value
+
+    def _save(self, key, value):
+        if self.directory is None:
+            return
+        arrays = _cache_arrays(value)
+        if arrays is not None:
+            _atomic_write(self._path(key), lambda f: np.savez(f, **arrays))
+
+def _cache_arrays(value):
+    # the arrays of a SetupCache value for the disk store, see _cache_value()
+    # (None for values that are only cached in memory)
+    from bni.gridding.Kaiser2D_utils import GriddingPlan
+    if isinstance(value, GriddingPlan):
+        arrays = value.to_arrays()
+        arrays['type'] = np.array('plan')
+        return arrays
+    if isinstance(value, (tuple, list)):
+        items = [np.asarray(v) for v in value]
+        if any(item.dtype == object for item in items):
+            return None
+        arrays = dict(('item%d' % i, item) for i, item in enumerate(items))
+        arrays['type'] = np.array('tuple')
+        return arrays
+    if isinstance(value, np.ndarray) and (value.dtype != object):
+        return {'type': np.array('array'), 'value': value}
+    return None
+
+def _cache_value(arrays):
+    # value from the arrays of _cache_arrays(), 0-d items of tuples are numbers
+    from bni.gridding.Kaiser2D_utils import GriddingPlan
+    kind = str(arrays['type'])
+    if kind == 'plan':
+        return GriddingPlan.from_arrays(arrays)
+    if kind == 'tuple':
+        items = [arrays['item%d' % i] for i in range(len(arrays) - 1)]
+        return tuple(item.item() if item.ndim == 0 else item for item in items)
+    if kind == 'array':
+        return arrays['value']
+    raise ValueError("unknown setup cache entry: " + kind)
+
+# setup cache of this process, see SetupCache.configure()
+setup_cache = SetupCache()
+
+def trajectory_hash(*arrays):
+    # digest of the trajectory (coords, weights, ...) for SetupCache keys
+    import hashlib
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype.str, a.shape)).encode())
+        h.update(a.data)
+    return h.hexdigest()
@@ -0,0 +1,176 @@
+# planned pyFFTW transforms for the FFTs of Kaiser2D_utils, with the FFTW
+# wisdom kept next to the setup cache
+
+import numpy as np
+
+from bni.gridding.Kaiser2D_backends import backends
+from bni.gridding.Kaiser2D_cache import default_setup_cache_directory, _read_arrays, _atomic_write
+
+def default_fft_wisdom_file():
+    # FFTW wisdom of the FFT plans, next to the setup cache
+    import os
+    return os.path.join(default_setup_cache_directory(), 'fftw_wisdom.npz')
+
+def _resize_roll_slices(n_in, n_out, roll):
+    # (source, destination) slice pairs of one dimension that copy the
+    # centered zero-padding / cropping of n_in to n_out elements (the center
+    # element n//2 stays the center) rolled by roll as in np.roll, at most
+    # two contiguous pieces
+    offset = n_out // 2 - n_in // 2
+    start = max(0, -offset)
+    stop = min(n_in, n_out - offset)
+    dst_start = (start + offset + roll) % n_out
+    first = min(stop - start, n_out - dst_start)
+    pairs = [(slice(start, start + first), slice(dst_start, dst_start + first))]
+    if start + first < stop:
+        pairs.append((slice(start + first, stop), slice(0, stop - start - first)))
+    return pairs
+
+class FFTPlanCache(object):
+    # Planned pyFFTW transforms for Kaiser2D_utils.fft2D(), cached per
+    # (image shape, output image shape, direction, axes, threads, backend)
+    # with an aligned in-place buffer of one image.  The images of a batch (coils, slices, dynamics) are
+    # transformed one after the other with the same plan, so repeated
+    # transforms (e.g. in the CG loop) don't plan again and can afford
+    # FFTW_MEASURE plans with several threads, without buffers the size of
+    # the batch.  The planner results (FFTW wisdom) are stored in
+    # wisdom_file and loaded before the first plan, so a new process (GPI
+    # forks one per execution) doesn't have to measure again.
+    #
+    # Each plan is checked once against the FFT of the current compute
+    # backend (core.math.fft for PyFI) on random data, which fixes the
+    # direction and scale of the transform.  Shapes that don't match, other
+    # dtypes than complex64, or a missing pyfftw fall back to the backend FFT.
+    #
+    # nthreads: int, threads of the planned transforms (and of the backend
+    #   FFT)
+    # effort: FFTW planner flag ('FFTW_ESTIMATE', 'FFTW_MEASURE', ...), None
+    #   (default) to always use the backend FFT
+    # wisdom_file: path of the stored wisdom (optional)
+
+    def __init__(self, nthreads=1, effort=None, wisdom_file=None):
+        self.plans = {}
+        self._copies = {}
+        self._wisdom_loaded = False
+        # FFTW starts its thread pool with the first multithreaded plan and
+        # keeps it for the life of the process
+        self.threads_started = False
+        self.configure(nthreads, effort, wisdom_file)
+
+    def configure(self, nthreads=1, effort=None, wisdom_file=None):
+        if effort != getattr(self, 'effort', effort):
+            self.plans.clear()
+        self.nthreads = nthreads
+        self.effort = effort
+        if wisdom_file != getattr(self, 'wisdom_file', None):
+            self._wisdom_loaded = False
+        self.wisdom_file = wisdom_file
+
+    def clear(self):
+        self.plans.clear()
+        self._copies.clear()
+
+    def transform(self, data, dir, out_shape, axes):
+        # centered transform along axes (of the last two) of data
+        # zero-padded / cropped to out_shape, None if there is no plan for it
+        if self.effort is None:
+            return None
+        try:
+            import pyfftw
+        except ImportError:
+            return None
+        out_shape = tuple(int(n) for n in out_shape)
+        if (data.dtype != np.complex64) or (data.ndim < 2) or (out_shape[:-2] != data.shape[:-2]):
+            return None
+
+        key = (data.shape[-2:], out_shape[-2:], dir, axes, self.nthreads, backends.current.name)
+        if key not in self.plans:
+            self.plans[key] = self._plan(pyfftw, key)
+        if self.plans[key] is None:
+            return None
+        fftw, scale = self.plans[key]
+
+        out = np.empty(out_shape, dtype=np.complex64)
+        images = data.reshape((-1,) + data.shape[-2:])
+        images_out = out.reshape((-1,) + out_shape[-2:])
+        for i in range(images.shape[0]):
+            self._execute(fftw, scale, images[i], key, images_out[i])
+        return out
+
+    def _execute(self, fftw, scale, image, key, out):
+        # resize and ifftshift image into the aligned buffer, transform, and
+        # fftshift the buffer into out, as block copies without temporaries
+        if key not in self._copies:
+            self._copies[key] = self._copy_slices(key)
+        into_buffer, from_buffer, padded = self._copies[key]
+        buf = fftw.input_array
+        if padded:
+            buf[...] = 0
+        for src, dst in into_buffer:
+            buf[dst] = image[src]
+        fftw.execute()
+        for src, dst in from_buffer:
+            out[dst] = buf[src]
+        out *= scale
+
+    def _copy_slices(self, key):
+        # block copies of _execute() for the image shapes of a plan
+        import itertools
+        [shape, out_shape, dir, axes, nthreads, backend] = key
+        into_buffer = []
+        from_buffer = []
+        for d, (n_in, n_out) in enumerate(zip(shape, out_shape)):
+            shift = (n_out // 2) if (d - len(shape)) in axes else 0
+            into_buffer.append(_resize_roll_slices(n_in, n_out, -shift))
+            from_buffer.append(_resize_roll_slices(n_out, n_out, shift))
+        copies = lambda dims: [tuple(zip(*pairs)) for pairs in itertools.product(*dims)]
+        padded = any(n_out > n_in for n_in, n_out in zip(shape, out_shape))
+        return copies(into_buffer), copies(from_buffer), padded
+
+    def _plan(self, pyfftw, key):
+        [shape, out_shape, dir, axes, nthreads, backend] = key
+        self._load_wisdom(pyfftw)
+
+        # the FFT of the compute backend on random data as the reference
+        rng = np.random.RandomState(0)
+        x = (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(np.complex64)
+        outdims = np.array(out_shape[::-1], dtype=np.int64)
+        ref = backends.current.fftw(x, outdims, dir=dir, dim1=int(-1 in axes), dim2=int(-2 in axes), dim3=0, dim4=0, dim5=0)
+
+        buf = pyfftw.empty_aligned(out_shape, dtype=np.complex64)
+        out = np.empty(out_shape, dtype=np.complex64)
+        if nthreads > 1:
+            self.threads_started = True
+        for direction in ('FFTW_FORWARD', 'FFTW_BACKWARD'):
+            fftw = pyfftw.FFTW(buf, buf, axes=axes, direction=direction, flags=(self.effort,), threads=nthreads)
+            self._execute(fftw, 1.0, x, key, out)
+            scale = np.vdot(out, ref) / max(np.vdot(out, out).real, np.finfo(np.float32).tiny)
+            if (abs(scale.imag) <= 1e-4 * abs(scale)) and (np.linalg.norm(ref - scale.real * out) <= 1e-4 * np.linalg.norm(ref)):
+                self._save_wisdom(pyfftw)
+                return (fftw, np.float32(scale.real))
+        return None
+
+    def _load_wisdom(self, pyfftw):
+        # the wisdom strings (double, single, long double) are stored as
+        # uint8 arrays, read without pickle; a file that can't be read is
+        # ignored
+        if self._wisdom_loaded or (self.wisdom_file is None):
+            return
+        self._wisdom_loaded = True
+        arrays = _read_arrays(self.wisdom_file)
+        if arrays is None:
+            return
+        try:
+            pyfftw.import_wisdom(tuple(arrays['wisdom%d' % i].tobytes() for i in range(3)))
+        except Exception:
+            pass
+
+    def _save_wisdom(self, pyfftw):
+        if self.wisdom_file is None:
+            return
+        wisdom = pyfftw.export_wisdom()
+        arrays = dict(('wisdom%d' % i, np.frombuffer(w, dtype=np.uint8)) for i, w in enumerate(wisdom))
+        _atomic_write(self.wisdom_file, lambda f: np.savez(f, **arrays))
+
+# FFT plans of this process, see FFTPlanCache.configure()
+fft_plans = FFTPlanCache()
@@ -0,0 +1,170 @@
+# per-stage wall time, memory and throughput of the gridding and SENSE
+# functions in Kaiser2D_utils, for the 'profile' outputs of the nodes
+
+class _NoStage(object):
+    # stage of a disabled Profiler
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_STAGE = _NoStage()
+
+class _ProfilerStage(object):
+    def __init__(self, profiler, name, samples):
+        self.profiler = profiler
+        self.name = name
+        self.samples = samples
+
+    def __enter__(self):
+        self.profiler._begin(self.name, self.samples)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler._end()
+        return False
+
+class Profiler(object):
+    # Wall time, allocated memory and processed samples per stage of the
+    # gridding and SENSE functions of Kaiser2D_utils (kernel, rolloff, grid,
+    # degrid, fft, csm, cg iteration, ...), which time themselves with
+    #     with profiler.stage('grid', samples=data.size):
+    # Stages nest: seconds include the stages inside, self seconds don't.
+    # A disabled profiler (the default) records nothing and costs one call
+    # per stage.  Stages are recorded from one thread only.
+    #
+    # With memory=True the peak of the memory traced by tracemalloc during
+    # a stage, above the traced memory at its start, is recorded as well.
+    # These are the arrays that numpy allocates, not the internal buffers of
+    # compiled code, and tracing slows every allocation down.
+    #
+    # The stages of Kaiser2D_utils.map_slices2D() workers are sent back to
+    # the parent process and keep the pid of the worker.
+    #
+    # events: list of dict(name, pid, depth, start, seconds, self seconds,
+    #         bytes, samples) in the order the stages finished, start in
+    #         seconds since configure()
+    # filename: path of the save() trace the nodes write after each
+    #           execution (None: no trace)
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.filename = None
+        self.events = []
+        self._stack = []
+        self._epoch = 0.
+        self._tracemalloc_started = False
+
+    def configure(self, enabled, memory=False, filename=None):
+        # (re)start profiling, the recorded events are cleared
+        import time
+        import tracemalloc
+        self.enabled = bool(enabled)
+        self.memory = self.enabled and bool(memory)
+        self.filename = filename
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracemalloc_started = True
+        elif (not self.memory) and self._tracemalloc_started:
+            tracemalloc.stop()
+            self._tracemalloc_started = False
+        self.events = []
+        self._stack = []
+        self._epoch = time.perf_counter()
+
+    def stage(self, name, samples=0):
+        # context manager that records one stage
+        #   samples: number of samples (or pixels) the stage processes
+        if not self.enabled:
+            return _NO_STAGE
+        return _ProfilerStage(self, name, samples)
+
+    def _begin(self, name, samples):
+        import time
+        import tracemalloc
+        frame = {'name': name, 'samples': int(samples), 'children': 0., 'memory': 0, 'peak': 0}
+        if self.memory:
+            # the peak of the enclosing stage so far, before it is reset
+            frame['memory'], peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+        self._stack.append(frame)
+        frame['start'] = time.perf_counter()
+
+    def _end(self):
+        import os
+        import time
+        import tracemalloc
+        end = time.perf_counter()
+        frame = self._stack.pop()
+        seconds = end - frame['start']
+        nbytes = 0
+        if self.memory:
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            nbytes = max(0, peak - frame['memory'])
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+        if self._stack:
+            self._stack[-1]['children'] += seconds
+        self.events.append({'name': frame['name'], 'pid': os.getpid(), 'depth': len(self._stack),
+                            'start': frame['start'] - self._epoch, 'seconds': seconds,
+                            'self seconds': seconds - frame['children'],
+                            'bytes': nbytes, 'samples': frame['samples']})
+
+    def summary(self):
+        # per stage name: calls, seconds, self seconds, samples, samples/s
+        # and MB (the largest peak of one call), the seconds of map_slices2D()
+        # workers add up over the workers
+        import os
+        import time
+        stages = {}
+        for e in self.events:
+            s = stages.setdefault(e['name'], {'calls': 0, 'seconds': 0., 'self seconds': 0., 'samples': 0, 'MB': 0.})
+            s['calls'] += 1
+            s['seconds'] += e['seconds']
+            s['self seconds'] += e['self seconds']
+            s['samples'] += e['samples']
+            s['MB'] = max(s['MB'], e['bytes'] / 2.0**20)
+        for s in stages.values():
+            s['samples/s'] = s['samples'] / s['seconds'] if (s['seconds'] > 0) else 0.
+        return {'seconds': time.perf_counter() - self._epoch,
+                'processes': len(set(e['pid'] for e in self.events)) or 1,
+                'memory': self.memory,
+                'stages': stages}
+
+    def save(self, filename):
+        # JSON trace in the Chrome trace event format (chrome://tracing,
+        # Perfetto) with the summary() under 'summary'
+        import json
+        events = [{'name': e['name'], 'cat': 'bni', 'ph': 'X', 'pid': e['pid'], 'tid': e['pid'],
+                   'ts': e['start'] * 1e6, 'dur': e['seconds'] * 1e6,
+                   'args': {'samples': e['samples'], 'MB': e['bytes'] / 2.0**20, 'self seconds': e['self seconds']}}
+                  for e in self.events]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'summary': self.summary()}, f, indent=1)
+
+    def _send(self, fd, first):
+        # write the events from index first on to the pipe fd (of a worker
+        # process to its parent) and close it
+        import json
+        import os
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.events[first:], f)
+
+    def _receive(self, fd):
+        # add the events of a worker process from the pipe fd, see _send()
+        import json
+        import os
+        with os.fdopen(fd, 'r') as f:
+            text = f.read()
+        try:
+            self.events.extend(json.loads(text))
+        except ValueError:
+            # nothing (or not all) sent by a worker that failed
+            pass
+
+# profiler of this process, see Profiler.configure()
+profiler = Profiler()
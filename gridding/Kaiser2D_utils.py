@@ -5,6 +5,92 @@
 
 import numpy as np
 
+# compute backends of this process (PyFI, NumPy / SciPy, numba), the
+# gridding and FFTs below run on backends.current
+from bni.gridding.Kaiser2D_backends import backends, default_backend_selection_file
+
+# setup cache shared by the gridding and SENSE nodes, see Kaiser2D_cache
+from bni.gridding.Kaiser2D_cache import setup_cache, trajectory_hash, default_setup_cache_directory
+
+# planned FFTs of this process (pyFFTW), fft2D() falls back to the FFT of
+# backends.current, see Kaiser2D_fft
+from bni.gridding.Kaiser2D_fft import fft_plans, default_fft_wisdom_file
+
+# stage timing of the functions below, see Kaiser2D_profile
+from bni.gridding.Kaiser2D_profile import profiler
+
+# default and largest Kaiser-Bessel kernel width in k-space pixels
+# (KERNEL_WIDTH and MAX_KERNEL_WIDTH in kaiserbessel.cpp)
+from bni.gridding.Kaiser2D_backends import KERNEL_WIDTH, MAX_KERNEL_WIDTH
+
+# largest kernel table of kaiserbessel_parameters() and the 'kernel table
+# size' widgets
+MAX_KERNEL_TABLE_SIZE = 2**24
+
+# error that kaiserbessel_parameters() reaches for all matrix sizes with a
+# table of a few MB, the smallest nonzero value of the 'target error'
+# widgets (5 decimals, 0 switches the target off)
+MIN_TARGET_ERROR = 1e-5
+
+# sample order that tells grid_batch/degrid_batch to keep the acquisition order
+ACQUISITION_ORDER = np.array([-1], dtype=np.int64)
+
+def configure_from_environment(environ=None):
+    # Process-wide settings of the gridding and SENSE nodes, the same for
+    # all of them, from the environment GPI was started in.  The nodes call
+    # this at the start of each execution.
+    #   BNI_GRIDDING_SETUP_CACHE_MB: size in MB of the setup cache (kernel,
+    #       rolloff, sample order, gridding plan and Toeplitz kernel), kept in
+    #       memory and in default_setup_cache_directory() across executions,
+    #       Sense2 only uses a gridding plan if it fits (default 0: no cache)
+    #   BNI_GRIDDING_FFT_PLANNING: planned pyFFTW transforms (if installed)
+    #       for fft2D(), with the planner results (FFTW wisdom) stored in
+    #       default_fft_wisdom_file(): core (default, always the FFT of the
+    #       compute backend), estimate (quick plans) or measure (faster
+    #       plans, measured once per matrix size)
+    #   BNI_GRIDDING_BACKEND: implementation of gridding, degridding and FFT,
+    #       pyfi (the C++ extension and core.math.fft), numba (gridding loops
+    #       compiled with numba, FFT from scipy), numpy (sparse interpolation
+    #       matrices and scipy.fft) or auto (the fastest one per problem
+    #       size from a short benchmark, the choices are stored in
+    #       default_backend_selection_file()), default: the first available
+    #       one of pyfi, numba and numpy
+    #   BNI_GRIDDING_PROFILE: per-stage timing of each execution (kernel,
+    #       rolloff, grid, fft, csm, cg iteration, ...) on the 'profile'
+    #       outputs, off (default), time (calls, wall time and samples/s per
+    #       stage) or memory (also the peak memory that numpy allocates in
+    #       each stage, tracemalloc slows the execution down)
+    #   BNI_GRIDDING_PROFILE_FILE: JSON trace of the stages in the Chrome
+    #       trace event format (chrome://tracing, Perfetto), written after
+    #       each profiled execution (default: none)
+    #   environ: dict of the settings (default: os.environ)
+    # raises ValueError for a setting that can't be used
+    import os
+    if environ is None:
+        environ = os.environ
+    setup_cache.configure(_environment_setting(environ, 'BNI_GRIDDING_SETUP_CACHE_MB', int, 0), default_setup_cache_directory())
+    fft_effort = _environment_setting(environ, 'BNI_GRIDDING_FFT_PLANNING', {'core': None, 'estimate': 'FFTW_ESTIMATE', 'measure': 'FFTW_MEASURE'}, None)
+    fft_plans.configure(fft_plans.nthreads, fft_effort, default_fft_wisdom_file())
+    backend = _environment_setting(environ, 'BNI_GRIDDING_BACKEND', dict((name, name) for name in backends.names() + ['auto']), None)
+    backends.configure(backend, default_backend_selection_file())
+    profile = _environment_setting(environ, 'BNI_GRIDDING_PROFILE', {'off': 0, 'time': 1, 'memory': 2}, 0)
+    profiler.configure(profile > 0, memory=(profile == 2), filename=environ.get('BNI_GRIDDING_PROFILE_FILE') or None)
+
+def _environment_setting(environ, name, convert, default):
+    # environ[name] converted with convert, a callable or a dict of the
+    # allowed values, default if it isn't set
+    value = environ.get(name, '').strip()
+    if not value:
+        return default
+    if isinstance(convert, dict):
+        if value not in convert:
+            raise ValueError(name + " has to be one of " + ", ".join(sorted(convert)) + ", not '" + value + "'")
+        return convert[value]
+    try:
+        return convert(value)
+    except ValueError:
+        raise ValueError(name + " has to be a number, not '" + value + "'")
+
 def window2(shape, windowpct=100.0, widthpct=100.0, stopVal=0, passVal=1):
     # 2D hanning window just like shapes
     #   OUTPUT: 2D float32 circularly symmetric hanning
@@ -34,174 +120,1423 @@ def window2(shape, windowpct=100.0, widthpct=100.0, stopVal=0, passVal=1):
 
     return out
 
-def rolloff2D(mtx_xy, kernel, clamp_min_percent=5):
+def rolloff2D(mtx_xy, kernel, clamp_min_percent=5, kernel_width=KERNEL_WIDTH):
     # mtx_xy: int
+    # kernel_width: width of the kernel table in k-space pixels
     import numpy as np
-    import bni.gridding.grid_kaiser as gd
 
-    # grid one point at k_0
-    dx = dy = 0.0
-    coords = np.array([0,0], dtype='float32')
-    data = np.array([1.0], dtype='complex64')
-    weights = np.array([1.0], dtype='float32')
-    outdim = np.array([mtx_xy, mtx_xy],dtype=np.int64)
+    with profiler.stage('rolloff', samples=mtx_xy * mtx_xy):
+        # grid one point at k_0
+        dx = dy = 0.0
+        coords = np.array([0,0], dtype='float32')
+        data = np.array([1.0], dtype='complex64')
+        weights = np.array([1.0], dtype='float32')
+        outdim = np.array([mtx_xy, mtx_xy],dtype=np.int64)
+
+        # grid -> fft -> |x|
+        out = np.abs(fft2D(backends.current.grid(coords, data, weights, kernel, outdim, dx, dy, kernel_width=kernel_width)))
+
+        # clamp the lowest values to a percentage of the max
+        clamp = out.max() * clamp_min_percent/100.0
+        out[out < clamp] = clamp
+
+        # invert
+        return 1.0/out
+
+def rolloff2D_analytic(mtx_xy, oversampling_ratio, clamp_min_percent=5, separable=False, broadcast=False, kernel_width=KERNEL_WIDTH):
+    # Deapodization from the closed-form Fourier transform of the
+    # Kaiser-Bessel kernel, equivalent to rolloff2D() without gridding a
+    # delta and transforming the full matrix.
+    #   mtx_xy: int
+    #   separable: rolloff for the separable instead of the radial kernel
+    #   broadcast: (separable only) return the pair of vectors
+    #              (roll_y [mtx_xy, 1], roll_x [1, mtx_xy]) whose product is
+    #              the rolloff instead of the full matrix, see apply_rolloff2D()
+    #   kernel_width: kernel width in k-space pixels
+    #   OUTPUT: 2D float32 [mtx_xy, mtx_xy]
+    import scipy.special
+
+    with profiler.stage('rolloff', samples=mtx_xy * mtx_xy):
+        radius = kernel_width / 2.0
+        beta = kaiserbessel_beta(oversampling_ratio, kernel_width)
+
+        # image coordinates in cycles per grid pixel
+        nu = (np.arange(mtx_xy) - mtx_xy // 2) / float(mtx_xy)
+        u2 = (2.0 * np.pi * radius * nu)**2
+
+        if separable:
+            ft = _kaiserbessel_ft1D(nu, beta, kernel_width)
+
+            # same scale as the transform of the gridded delta, per dimension
+            out = np.abs(ft) * np.sqrt(_fft2D_delta_scale(mtx_xy))
+
+            # clamp the lowest values to a percentage of the max (per dimension)
+            clamp = out.max() * clamp_min_percent/100.0
+            out[out < clamp] = clamp
+            out = (1.0/out).astype(np.float32)
+
+            if broadcast:
+                return (out[:, np.newaxis], out[np.newaxis, :])
+            return np.outer(out, out)
+
+        # 2D transform of I0(beta sqrt(1-(r/radius)^2)):
+        #   2 pi radius^2 I1(z)/z, z = sqrt(beta^2 - (2 pi radius |nu|)^2)
+        # where z becomes imaginary I1(z)/z turns into J1(|z|)/|z|
+        z2 = beta**2 - (u2[:, np.newaxis] + u2[np.newaxis, :])
+        z = np.sqrt(np.abs(z2))
+        z[z == 0] = np.finfo(np.float64).tiny
+        ft = np.where(z2 > 0, scipy.special.i1(z), scipy.special.j1(z)) / z
+        ft *= 2.0 * np.pi * radius**2 / np.i0(beta)
 
-    # grid -> fft -> |x|
-    out = np.abs(fft2D(gd.grid(coords, data, weights, kernel, outdim, dx, dy)))
+        # same scale as the transform of the gridded delta
+        out = np.abs(ft) * _fft2D_delta_scale(mtx_xy)
 
-    # clamp the lowest values to a percentage of the max
-    clamp = out.max() * clamp_min_percent/100.0
-    out[out < clamp] = clamp
+        # clamp the lowest values to a percentage of the max
+        clamp = out.max() * clamp_min_percent/100.0
+        out[out < clamp] = clamp
 
-    # invert
-    return 1.0/out
+        # invert
+        return (1.0/out).astype(np.float32)
 
-def kaiserbessel_kernel(kernel_table_size, oversampling_ratio):
+def apply_rolloff2D(data, roll):
+    # multiply data (in place) with the rolloff from rolloff2D() or
+    # rolloff2D_analytic(), either a 2D array or a broadcast pair of vectors.
+    # If data is smaller than the rolloff (i.e. cropped) the center of the
+    # rolloff is used.
+    #   data: np.complex64 [..., mtx, mtx]
+    with profiler.stage('apply rolloff', samples=data.size):
+        if isinstance(roll, tuple):
+            factors = roll
+        else:
+            factors = (roll,)
+
+        mtx = data.shape[-1]
+        for f in factors:
+            if max(f.shape[-2:]) > mtx:
+                y_min = (f.shape[-2] - mtx) // 2 if (f.shape[-2] > 1) else 0
+                x_min = (f.shape[-1] - mtx) // 2 if (f.shape[-1] > 1) else 0
+                f = f[..., y_min:y_min + min(f.shape[-2], mtx), x_min:x_min + min(f.shape[-1], mtx)]
+            data *= f
+        return data
+
+def _fft2D_delta_scale(mtx_xy):
+    # magnitude of fft2D() of a unit delta, i.e. the normalization of the
+    # transform, measured with a 1D transform of each dimension
+    delta = np.zeros([mtx_xy], dtype=np.complex64)
+    delta[mtx_xy // 2] = 1.0
+    scale_1D = np.abs(backends.current.fftw(delta, np.array([mtx_xy], dtype=np.int64), dir=0, dim1=1)).max()
+    return float(scale_1D)**2
+
+def kaiserbessel_beta(oversampling_ratio, kernel_width=KERNEL_WIDTH):
+    # Kaiser-Bessel shape parameter (Beatty et al. 2005, eq. 5), as used by
+    # kaiserbessel_kernel()
+    beta_sqr = (kernel_width / oversampling_ratio * (oversampling_ratio - 0.5))**2 - 0.8
+    if (beta_sqr <= 0) or (kernel_width > MAX_KERNEL_WIDTH):
+        raise ValueError("no Kaiser-Bessel kernel of width " + str(kernel_width) + " for the oversampling ratio " +
+                         str(oversampling_ratio) + " (the width is at most " + str(MAX_KERNEL_WIDTH) + ")")
+    return np.pi * np.sqrt(beta_sqr)
+
+def _kaiserbessel_ft1D(nu, beta, kernel_width):
+    # Fourier transform of the 1D kernel I0(beta sqrt(1-(x/radius)^2)):
+    #   2 radius sinh(z)/z, z = sqrt(beta^2 - (2 pi radius nu)^2)
+    # where z becomes imaginary sinh(z)/z turns into sin(|z|)/|z|, for the
+    # kernel table (peak 1)
+    #   nu: image coordinates in cycles per grid pixel
+    radius = kernel_width / 2.0
+    z2 = beta**2 - (2.0 * np.pi * radius * np.asarray(nu, dtype=np.float64))**2
+    z = np.sqrt(np.abs(z2))
+    z[z == 0] = np.finfo(np.float64).tiny
+    ft = np.where(z2 > 0, np.sinh(z), np.sin(z)) / z
+    return ft * (2.0 * radius / np.i0(beta))
+
+def kaiserbessel_kernel(kernel_table_size, oversampling_ratio, kernel_width=KERNEL_WIDTH):
     #   Generate a Kaiser-Bessel kernel function
+    #   kernel_width: in k-space pixels, pass the same width to the
+    #                 gridding functions that use the table
     #   OUTPUT: 1D kernel table for radius squared
 
-    import bni.gridding.grid_kaiser as dg
-    kernel_dim = np.array([kernel_table_size],dtype=np.int64)
-    return dg.kaiserbessel_kernel(kernel_dim, np.float64(oversampling_ratio))
+    with profiler.stage('kernel', samples=kernel_table_size):
+        kaiserbessel_beta(oversampling_ratio, kernel_width)
+        kernel_dim = np.array([kernel_table_size],dtype=np.int64)
+        return backends.current.kaiserbessel_kernel(kernel_dim, np.float64(oversampling_ratio), kernel_width=float(kernel_width))
+
+def kaiserbessel_aliasing_error(oversampling_ratio, kernel_width=KERNEL_WIDTH):
+    # Largest aliasing amplitude inside the field of view (Beatty et al.
+    # 2005, eq. 3): the replicas of the kernel transform at nu + p (p != 0)
+    # relative to the transform at nu, for |nu| <= 1/(2 oversampling_ratio)
+    # cycles per grid pixel.  From the 1D (separable) kernel, the radial
+    # kernel aliases about the same.
+    #   OUTPUT: float, relative error
+    beta = kaiserbessel_beta(oversampling_ratio, kernel_width)
+    nu = np.linspace(0, 0.5 / oversampling_ratio, 65)
+    replicas = np.concatenate([np.arange(-16, 0), np.arange(1, 17)])
+    aliases = _kaiserbessel_ft1D(nu[:, np.newaxis] + replicas, beta, kernel_width)
+    aliasing = np.sqrt(np.sum(aliases**2, axis=1)) / np.abs(_kaiserbessel_ft1D(nu, beta, kernel_width))
+    return float(aliasing.max())
+
+def kaiserbessel_table_error(kernel_table_size, oversampling_ratio, kernel_width=KERNEL_WIDTH):
+    # Largest error of a kernel weight looked up in a table of
+    # kernel_table_size entries (the nearest entry for the squared radius,
+    # see kaiserbessel_kernel()), relative to the kernel peak, measured at 16
+    # points per entry (in blocks of entries to bound the memory).  The last
+    # entry is 0, the truncation of the kernel at its edge, which is part of
+    # the aliasing error rather than of the table.
+    #   OUTPUT: float
+    beta = kaiserbessel_beta(oversampling_ratio, kernel_width)
+    def kernel(radius_sqr):
+        return np.i0(beta * np.sqrt(np.maximum(1.0 - radius_sqr, 0))) / np.i0(beta)
+    table = kernel(np.arange(kernel_table_size) / float(kernel_table_size - 1))
+    table[0] = 1.0
+    table[-1] = 0.0
+    error = 0.
+    block = 2**16
+    for first in range(0, kernel_table_size - 1, block):
+        entries = np.arange(16 * first, 16 * min(first + block, kernel_table_size - 1))
+        radius_sqr = entries / (16.0 * kernel_table_size)
+        nearest = np.rint(radius_sqr * (kernel_table_size - 1)).astype(np.int64)
+        inside = nearest < kernel_table_size - 1
+        if inside.any():
+            error = max(error, float(np.abs(kernel(radius_sqr[inside]) - table[nearest[inside]]).max()))
+    return error
+
+def kaiserbessel_table_size(max_error, oversampling_ratio, kernel_width=KERNEL_WIDTH):
+    # Smallest kernel table with kaiserbessel_table_error() below max_error,
+    # from the bound of the nearest-entry lookup: the entry is at most half
+    # an entry, 1/(2 (size - 1)) in the squared radius, away and the kernel
+    # is steepest in the squared radius at its center, where the slope is
+    # beta I1(beta) / (2 I0(beta)) (I1 = I0').  ValueError if the table
+    # would have more than MAX_KERNEL_TABLE_SIZE entries.
+    #   OUTPUT: int
+    beta = kaiserbessel_beta(oversampling_ratio, kernel_width)
+    step = 1e-4 * beta
+    i1 = (np.i0(beta + step) - np.i0(beta - step)) / (2 * step)
+    slope = beta * i1 / (2 * np.i0(beta))
+    size = int(np.ceil(slope / (2 * max_error))) + 1
+    if size > MAX_KERNEL_TABLE_SIZE:
+        raise ValueError("no kernel table of at most " + str(MAX_KERNEL_TABLE_SIZE) + " entries is accurate to " + str(max_error))
+    return max(64, size)
+
+def kaiserbessel_parameters(max_error, mtx_xy, nr_samples, oversampling_ratios=None, kernel_widths=None):
+    # The cheapest oversampling ratio, kernel width and kernel table size
+    # for gridding to mtx_xy with an error below max_error.  The budget is
+    # split between the aliasing (kaiserbessel_aliasing_error()) and the
+    # table lookup (kaiserbessel_table_size(), half of max_error) so that
+    # their root sum of squares stays below max_error.  The cost is that of
+    # the convolution, nr_samples * width^2, plus that of the FFT of the
+    # oversampled grid G, G^2 log2(G^2).  ValueError if no candidate
+    # reaches max_error (MIN_TARGET_ERROR is reached by all matrix sizes).
+    #   mtx_xy: int, image matrix size (before oversampling)
+    #   nr_samples: int, number of samples per image
+    #   oversampling_ratios, kernel_widths: candidates (default: 1.125 to 2
+    #                                       in steps of 0.125, 2 to
+    #                                       MAX_KERNEL_WIDTH in steps of 0.5)
+    #   OUTPUT: (oversampling_ratio, kernel_width, kernel_table_size)
+    if oversampling_ratios is None:
+        oversampling_ratios = np.arange(1.125, 2.0 + 1e-9, 0.125)
+    if kernel_widths is None:
+        kernel_widths = np.arange(2.0, MAX_KERNEL_WIDTH + 1e-9, 0.5)
+    table_error = 0.5 * max_error
+    aliasing_error = np.sqrt(max_error**2 - table_error**2)
+
+    best = None
+    for oversampling_ratio in oversampling_ratios:
+        mtx = int(mtx_xy * oversampling_ratio)
+        mtx += mtx % 2
+        fft_cost = mtx * mtx * np.log2(max(mtx * mtx, 2))
+        for kernel_width in kernel_widths:
+            cost = nr_samples * kernel_width**2 + fft_cost
+            if (best is not None) and (cost >= best[0]):
+                continue
+            try:
+                if kaiserbessel_aliasing_error(oversampling_ratio, kernel_width) <= aliasing_error:
+                    best = (cost, float(oversampling_ratio), float(kernel_width))
+            except ValueError:
+                continue
+    if best is None:
+        raise ValueError("no Kaiser-Bessel kernel aliases less than " + str(aliasing_error))
+    [cost, oversampling_ratio, kernel_width] = best
+    return oversampling_ratio, kernel_width, kaiserbessel_table_size(table_error, oversampling_ratio, kernel_width)
 
 def fft2D(data, dir=0, out_dims_fft=[]):
     # data: np.complex64
     # dir: int (0 or 1)
     # outdims = [nr_coils, extra_dim2, extra_dim1, mtx, mtx]
 
-    import core.math.fft as corefft
-
-    # generate output dim size array
-    # fortran dimension ordering
-    if len(out_dims_fft):
-        outdims = out_dims_fft.copy()
-    else:
-        outdims = list(data.shape)
+    with profiler.stage('fft', samples=data.size):
+        # generate output dim size array
+        # fortran dimension ordering
+        if len(out_dims_fft):
+            outdims = out_dims_fft.copy()
+        else:
+            outdims = list(data.shape)
     
-    outdims.reverse()
-    outdims = np.array(outdims, dtype=np.int64)
+        outdims.reverse()
+        outdims = np.array(outdims, dtype=np.int64)
+
+        # planned transform (pyFFTW), if available for this shape
+        out = fft_plans.transform(data, dir, outdims[::-1], (-2, -1))
+        if out is not None:
+            return out
+
+        # load fft arguments
+        kwargs = {}
+        kwargs['dir'] = dir
+
+        # transform
+        kwargs['dim1'] = 1
+        kwargs['dim2'] = 1
+        kwargs['dim3'] = 0
+        kwargs['dim4'] = 0
+        kwargs['dim5'] = 0
+
+        # same threads as the planned transforms
+        kwargs['nthreads'] = fft_plans.nthreads
+
+        return backends.current.fftw(data, outdims, **kwargs)
+
+def _fft1D(data, dir, axis, out_dims_fft):
+    # fft2D() of only one of the two image axes, -1 (x) or -2 (y)
+    with profiler.stage('fft', samples=data.size):
+        out = fft_plans.transform(data, dir, out_dims_fft, (axis,))
+        if out is not None:
+            return out
+
+        outdims = list(out_dims_fft)
+        outdims.reverse()
+        outdims = np.array(outdims, dtype=np.int64)
+        return backends.current.fftw(np.ascontiguousarray(data), outdims, dir=dir, dim1=int(axis == -1), dim2=int(axis == -2), dim3=0, dim4=0, dim5=0,
+                                     nthreads=fft_plans.nthreads)
 
-    # load fft arguments
-    kwargs = {}
-    kwargs['dir'] = dir
+def fft2D_zeropad(data, mtx_xy, dir=1):
+    # fft2D(data, dir, out_dims_fft=[..., mtx_xy, mtx_xy]), i.e. centered
+    # zero-padding followed by the 2D transform, without transforming the
+    # rows that are known to be zero: the x pass only transforms the rows
+    # of data, zero-padded to mtx_xy, then the y pass zero-pads and
+    # transforms all columns.
+    #   data: np.complex64 [..., mtx, mtx], mtx <= mtx_xy
+    #   OUTPUT: np.complex64 [..., mtx_xy, mtx_xy]
+    lead = list(data.shape[:-2])
+    rows = _fft1D(data, dir, -1, lead + [data.shape[-2], mtx_xy])
+    return _fft1D(rows, dir, -2, lead + [mtx_xy, mtx_xy])
 
-    # transform
-    kwargs['dim1'] = 1
-    kwargs['dim2'] = 1
-    kwargs['dim3'] = 0
-    kwargs['dim4'] = 0
-    kwargs['dim5'] = 0
+def fft2D_crop(data, crop_xy, dir=0):
+    # fft2D(data, dir) cropped to the central [crop_xy, crop_xy], without
+    # transforming the rows that are cropped: the y pass transforms all
+    # columns, and the x pass only the crop_xy rows that are kept.
+    #   data: np.complex64 [..., mtx, mtx], crop_xy <= mtx
+    #   OUTPUT: np.complex64 [..., crop_xy, crop_xy]
+    lead = list(data.shape[:-2])
+    mtx = data.shape[-1]
+    crop_min = (mtx - crop_xy) // 2
+    columns = _fft1D(data, dir, -2, lead + [mtx, mtx])
+    rows = _fft1D(columns[..., crop_min:crop_min + crop_xy, :], dir, -1, lead + [crop_xy, mtx])
+    return rows[..., crop_min:crop_min + crop_xy]
 
-    return corefft.fftw(data, outdims, **kwargs)
+def shared_zeros(shape, dtype):
+    # Zero-filled array in anonymous shared memory.  Allocated before
+    # map_slices2D(), writes of the worker processes show up in the caller.
+    import mmap
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    buf = mmap.mmap(-1, max(count * dtype.itemsize, 1))
+    return np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
 
-def grid2D(data, coords, weights, kernel, out_dims):
+def map_slices2D(func, extra_dim2, extra_dim1, nprocs):
+    # Call func(extra2, extra1) for every slice/dynamic on nprocs forked
+    # worker processes.  The workers inherit all inputs (coords, weights,
+    # kernel, plans, ...) copy-on-write, so they are shared read-only
+    # without pickling, and return results by writing into shared_zeros()
+    # arrays.  Plain os.fork() is used since GPI nodes run in daemonic
+    # processes, which can't start multiprocessing children.  Runs in this
+    # process for nprocs <= 1, where fork() isn't available, or once this
+    # process has other threads (see threads_running()).  The profiler
+    # stages of the workers are piped back to this process.
+    #   func: callable(extra2, extra1)
+    #   nprocs: int, number of worker processes
+    import os
+
+    problems = [(e2, e1) for e2 in range(extra_dim2) for e1 in range(extra_dim1)]
+    nprocs = min(nprocs, len(problems))
+    if (nprocs <= 1) or not hasattr(os, 'fork') or threads_running():
+        for e2, e1 in problems:
+            func(e2, e1)
+        return
+
+    # static round-robin assignment, the problems have the same size
+    pids = []
+    pipes = []
+    first_event = len(profiler.events)
+    try:
+        for w in range(nprocs):
+            if profiler.enabled:
+                read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    for e2, e1 in problems[w::nprocs]:
+                        func(e2, e1)
+                    status = 0
+                except BaseException:
+                    import traceback
+                    traceback.print_exc()
+                finally:
+                    if profiler.enabled:
+                        try:
+                            profiler._send(write_fd, first_event)
+                        except BaseException:
+                            pass
+                    os._exit(status)
+            pids.append(pid)
+            if profiler.enabled:
+                os.close(write_fd)
+                pipes.append(read_fd)
+    finally:
+        # read the pipes before waiting, a worker blocks until its events are read
+        for fd in pipes:
+            profiler._receive(fd)
+        failed = [pid for pid in pids if os.waitpid(pid, 0)[1] != 0]
+    if failed:
+        raise RuntimeError("map_slices2D: " + str(len(failed)) + " of " + str(nprocs) + " worker processes failed")
+
+def threads_running():
+    # True if this process has threads besides the calling one: other Python
+    # threads, the worker threads FFTW keeps after a multithreaded plan, or
+    # the thread pool of numba's parallel kernels (numba backend).  fork()
+    # only copies the calling thread, so a child could inherit a lock held
+    # by one of them and hang.
+    import sys
+    import threading
+    if (threading.active_count() > 1) or fft_plans.threads_started:
+        return True
+    numba = sys.modules.get('numba')
+    if numba is not None:
+        try:
+            numba.threading_layer()  # ValueError until a parallel kernel ran
+            return True
+        except ValueError:
+            pass
+    return False
+
+def header_matrix(params, stack=False):
+    # Effective matrix size (mtx_xy, mtx_z) of the BNIspiral header of the
+    # scanner ('params_in' of the nodes): FOV / resolution with an extra 25%
+    # for the "true resolution" in-plane, and along z for SDST and FLORET.
+    #   params: dict header
+    #   stack: bool, also mtx_z for 3D (stack of spirals) trajectories
+    #   OUTPUT: (mtx_xy, mtx_z) as floats, mtx_z is 0 for 2D
+    if params.get('headerType') != 'BNIspiral':
+        raise ValueError("wrong header type")
+    def value(key):
+        return float(params[key][0])
+
+    mtx_xy = 1.25 * value('spFOVXY') / value('spRESXY')
+    mtx_z = 0.
+    if stack:
+        mtx_z = value('spFOVZ') / value('spRESZ')
+        if int(value('spSTYPE')) in [2, 3]:  # SDST, FLORET
+            mtx_z *= 1.25
+    return mtx_xy, mtx_z
+
+def header_fov_shift(params, stack=False):
+    # Off-center in pixels (dx, dy, dz) from the BNIspiral header, the
+    # off-centers in mm in pixels of header_matrix() (FOVShift_GPI, Grid2
+    # and DeGrid2 use this).
+    #   params: dict header
+    #   stack: bool, also dz for 3D (stack of spirals) trajectories
+    #   OUTPUT: (dx, dy, dz), dz is 0 for 2D
+    [mtx_xy, mtx_z] = header_matrix(params, stack)
+    def value(key):
+        return float(params[key][0])
+
+    dx = 0.001 * value('m_offc') * mtx_xy / value('spFOVXY')
+    dy = 0.001 * value('p_offc') * mtx_xy / value('spFOVXY')
+    dz = 0.
+    if stack:
+        dz = 0.001 * value('s_offc') * mtx_z / value('spFOVZ')
+        # shift half pixel when the number of slices is even with
+        # distributed spirals
+        if (int(value('spSTYPE')) in [1, 2]) and (int(mtx_z) % 2 == 0):
+            dz -= 0.5
+    return dx, dy, dz
+
+def sparse_row_blocks(A, nthreads):
+    # the blocks of rows of the sparse matrix A that sparse_dot() multiplies
+    # on nthreads threads, (bounds, [A[bounds[t]:bounds[t + 1]], ...])
+    nthreads = max(1, min(nthreads, A.shape[0]))
+    bounds = np.linspace(0, A.shape[0], nthreads + 1).astype(np.int64)
+    return bounds, [A[bounds[t]:bounds[t + 1]] for t in range(nthreads)]
+
+def sparse_dot(A, x, nthreads=1, row_blocks=None):
+    # A.dot(x) for the sparse matrix A, in parallel over blocks of output
+    # rows (scipy's sparse kernels release the GIL)
+    #   x: 2D array
+    #   row_blocks: sparse_row_blocks(A, nthreads) to reuse (optional)
+    nthreads = min(nthreads, A.shape[0])
+    if nthreads <= 1:
+        return A.dot(x)
+
+    from concurrent.futures import ThreadPoolExecutor
+    bounds, blocks = row_blocks if (row_blocks is not None) else sparse_row_blocks(A, nthreads)
+    out = np.empty((A.shape[0], x.shape[1]), dtype=np.result_type(A.dtype, x.dtype))
+    def multiply(t):
+        out[bounds[t]:bounds[t + 1]] = blocks[t].dot(x)
+    with ThreadPoolExecutor(max_workers=len(blocks)) as pool:
+        list(pool.map(multiply, range(len(blocks))))
+    return out
+
+class GriddingPlan(object):
+    # Sparse interpolation matrix between the samples of a fixed trajectory
+    # and the cartesian grid.  The kernel is evaluated once when the plan is
+    # built; gridding and degridding are then a sparse multiply with the
+    # matrix (degrid) or its transpose (grid), which can be reused for all
+    # coils, slices and CG iterations.
+    #
+    # coords: np.float32 [nr_sets, nr_arms, nr_points, 2]
+    # weights: np.float32 [nr_sets, nr_arms, nr_points]
+    # kernel: np.float32 kernel table
+    # mtx_xy: int
+    # separable: bool, use the separable instead of the radial kernel
+    # kernel_width: kernel width in k-space pixels
+
+    def __init__(self, coords, weights, kernel, mtx_xy, separable=False, kernel_width=KERNEL_WIDTH):
+        import scipy.sparse
+
+        with profiler.stage('gridding plan', samples=weights.size):
+            self.mtx_xy = mtx_xy
+            self.weights = weights.reshape(weights.shape[0], -1)
+            outdim = np.array([mtx_xy, mtx_xy], dtype=np.int64)
+
+            # one interpolation matrix per set of coordinates
+            #   interp: [nr_samples, mtx_xy*mtx_xy] (CSR) for degridding
+            #   interp_adj: [mtx_xy*mtx_xy, nr_samples] (CSR) for gridding
+            self.interp = []
+            self.interp_adj = []
+            for crds in coords:
+                indices, values = backends.current.grid_plan(crds, kernel, outdim, separable=int(separable), kernel_width=kernel_width)
+                nr_samples = self.weights.shape[-1]
+                nr_neighbors = indices.shape[-1]
+                indptr = np.arange(0, nr_samples * nr_neighbors + 1, nr_neighbors)
+                A = scipy.sparse.csr_matrix((values.ravel(), indices.ravel(), indptr), shape=(nr_samples, mtx_xy * mtx_xy))
+                A.eliminate_zeros()
+                self.interp.append(A)
+                self.interp_adj.append(A.T.tocsr())
+
+            # row blocks of the matrices for threaded multiplies
+            self._blocks = {}
+
+    def __getstate__(self):
+        # the row blocks are rebuilt when needed
+        state = self.__dict__.copy()
+        state['_blocks'] = {}
+        return state
+
+    def to_arrays(self):
+        # the plan as a dict of arrays (the disk store of SetupCache), see
+        # from_arrays()
+        arrays = {'mtx_xy': np.array(self.mtx_xy), 'weights': self.weights}
+        for name, matrices in [('interp', self.interp), ('interp_adj', self.interp_adj)]:
+            for s, A in enumerate(matrices):
+                arrays['%s%d_data' % (name, s)] = A.data
+                arrays['%s%d_indices' % (name, s)] = A.indices
+                arrays['%s%d_indptr' % (name, s)] = A.indptr
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        import scipy.sparse
+        plan = cls.__new__(cls)
+        plan.mtx_xy = int(arrays['mtx_xy'])
+        plan.weights = arrays['weights']
+        [nr_sets, nr_samples] = plan.weights.shape
+        nr_pixels = plan.mtx_xy * plan.mtx_xy
+        for name, shape in [('interp', (nr_samples, nr_pixels)), ('interp_adj', (nr_pixels, nr_samples))]:
+            setattr(plan, name, [scipy.sparse.csr_matrix((arrays['%s%d_data' % (name, s)], arrays['%s%d_indices' % (name, s)],
+                                                           arrays['%s%d_indptr' % (name, s)]), shape=shape) for s in range(nr_sets)])
+        plan._blocks = {}
+        return plan
+
+    @property
+    def nbytes(self):
+        matrices = self.interp + self.interp_adj
+        return self.weights.nbytes + sum(A.data.nbytes + A.indices.nbytes + A.indptr.nbytes for A in matrices)
+
+    @staticmethod
+    def estimate_nbytes(nr_samples, separable=False, kernel_width=KERNEL_WIDTH):
+        # about the nbytes of a plan for nr_samples samples (of all sets),
+        # before building it: the grid points inside the kernel of each
+        # sample, pi (w/2)^2 (w^2 if separable), with a float32 value and an
+        # int32 index in the matrix and in its transpose
+        neighbors = kernel_width**2 if separable else np.pi * (kernel_width / 2.0)**2
+        return int(nr_samples * neighbors * 8 * 2)
+
+    def subset(self, crd_set):
+        # plan for a single set of coordinates, shares the matrices
+        import copy
+        plan = copy.copy(self)
+        plan.weights = self.weights[crd_set:crd_set + 1]
+        plan.interp = self.interp[crd_set:crd_set + 1]
+        plan.interp_adj = self.interp_adj[crd_set:crd_set + 1]
+        plan._blocks = {}
+        return plan
+
+    def _dot(self, matrices, crd_set, x, nthreads):
+        # sparse_dot() with the row blocks of the matrix kept for the next
+        # call
+        A = matrices[crd_set]
+        key = (id(matrices), crd_set, nthreads)
+        if (nthreads > 1) and (key not in self._blocks):
+            self._blocks[key] = sparse_row_blocks(A, nthreads)
+        return sparse_dot(A, x, nthreads, self._blocks.get(key))
+
+    def grid(self, data, out, nthreads=1):
+        # data: np.complex64 [nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points]
+        # out: np.complex64 [nr_coils, extra_dim2, extra_dim1, mtx_xy, mtx_xy]
+        nr_batch = data.shape[0] * data.shape[1]
+        for extra1 in range(data.shape[2]):
+            crd_set = extra1 if (len(self.interp) > 1) else 0
+            d = data[:, :, extra1, ...].reshape(nr_batch, -1) * self.weights[crd_set]
+            g = self._dot(self.interp_adj, crd_set, d.T, nthreads)
+            out[:, :, extra1, ...] = g.T.reshape(data.shape[0], data.shape[1], self.mtx_xy, self.mtx_xy)
+        return out
+
+    def degrid(self, data, out, nthreads=1):
+        # data: np.complex64 [nr_coils, extra_dim2, extra_dim1, mtx_xy, mtx_xy]
+        # out: np.complex64 [nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points]
+        nr_batch = data.shape[0] * data.shape[1]
+        for extra1 in range(data.shape[2]):
+            crd_set = extra1 if (len(self.interp) > 1) else 0
+            g = data[:, :, extra1, ...].reshape(nr_batch, -1)
+            d = self._dot(self.interp, crd_set, g.T, nthreads)
+            out[:, :, extra1, ...] = d.T.reshape(out.shape[0], out.shape[1], out.shape[3], out.shape[4])
+        return out
+
+def sample_order2D(coords, mtx_xy, tile_width=8):
+    # Order in which grid2D() and degrid2D() visit the samples: sorted by
+    # k-space tile so consecutive samples touch the same part of the grid.
+    # The order only depends on the trajectory and the grid size, compute
+    # it once and pass it to every call for that trajectory.
+    #   coords: np.float32 [nr_sets, nr_arms, nr_points, 2]
+    #   mtx_xy: int, (oversampled) grid matrix size
+    #   tile_width: int, tile size in grid points
+    #   OUTPUT: np.int64 [nr_sets, nr_arms*nr_points]
+
+    with profiler.stage('sample order', samples=coords.size // 2):
+        nr_sets = coords.shape[0]
+        crds = np.ascontiguousarray(coords, dtype=np.float32).reshape(nr_sets, -1, 2)
+        outdim = np.array([mtx_xy, mtx_xy], dtype=np.int64)
+        return backends.current.grid_sort(crds, outdim, tile_width=tile_width)
+
+def grid2D(data, coords, weights, kernel, out_dims, plan=None, out=None, nthreads=1, separable=False, order=None, kernel_width=KERNEL_WIDTH,
+           dx=0., dy=0.):
     # data: np.float32
     # coords: np.complex64
     # weights: np.float32
     # kernel: np.float64
     # outdims = [nr_coils, extra_dim2, extra_dim1, mtx_xy, mtx_xy]: int
-    import bni.gridding.grid_kaiser as bni_grid
+    # plan: GriddingPlan for these coords and weights (optional)
+    # out: C-contiguous np.complex64 array to grid into (optional)
+    # nthreads: int, number of threads
+    # separable: bool, use the separable instead of the radial kernel
+    #            (ignored with a plan, which has its own kernel mode)
+    # order: sample order from sample_order2D() (optional)
+    # kernel_width: kernel width in k-space pixels (see kaiserbessel_kernel())
+    # dx, dy: off-center in pixels, applied as a linear phase of the samples
+    #         inside the gridding (not with a plan)
     
-    [nr_coils, extra_dim2, extra_dim1, mtx_xy, nr_arms, nr_points] = out_dims
-    
-    # off-center in pixels.
-    dx = dy = 0.
+    with profiler.stage('grid', samples=data.size):
+        [nr_coils, extra_dim2, extra_dim1, mtx_xy, nr_arms, nr_points] = out_dims
 
-    # gridded kspace
-    gridded_kspace = np.zeros([nr_coils, extra_dim2, extra_dim1, mtx_xy, mtx_xy], dtype=data.dtype)
-    
-    # tell the grid routine what shape to produce
-    outdim = np.array([mtx_xy,mtx_xy], dtype=np.int64)
-
-    # coordinate dimensions
-    if coords.shape[0] == 1:
-        same_coords_for_all_slices_and_dynamics = True
-    else:
-        same_coords_for_all_slices_and_dynamics = False
-
-    # grid all slices
-    dx = dy = 0.
-    for extra1 in range(extra_dim1):
-        if same_coords_for_all_slices_and_dynamics:
-            extra1_coords = 0
+        # gridded kspace
+        if out is None:
+            out = np.zeros([nr_coils, extra_dim2, extra_dim1, mtx_xy, mtx_xy], dtype=data.dtype)
+        elif not out.flags.c_contiguous:
+            # the backends write through a reshape of out, which would be a copy
+            raise ValueError("grid2D: out must be C-contiguous")
+        if plan is not None:
+            if dx or dy:
+                raise ValueError("grid2D: no off-center shift with a gridding plan")
+            return plan.grid(data, out, nthreads=nthreads)
+
+        # grid all coils, slices and dynamics in one call, the coordinate sets
+        # are either shared by all dynamics or one per dynamic
+        nr_sets = coords.shape[0]
+        backends.current.grid_batch(
+            np.ascontiguousarray(coords).reshape(nr_sets, nr_arms * nr_points, 2),
+            np.ascontiguousarray(data).reshape(nr_coils * extra_dim2, extra_dim1, nr_arms * nr_points),
+            np.ascontiguousarray(weights).reshape(nr_sets, nr_arms * nr_points),
+            kernel,
+            out.reshape(nr_coils * extra_dim2, extra_dim1, mtx_xy, mtx_xy),
+            dx, dy,
+            ACQUISITION_ORDER if order is None else order,
+            nthreads=nthreads, separable=int(separable), kernel_width=kernel_width)
+
+        return out
+
+def grid_images2D(data, coords, weights, kernel, mtx_xy, roll, crop_xy, out=None, memory_mb=0, nthreads=1, separable=False, order=None,
+                  kernel_width=KERNEL_WIDTH, dx=0., dy=0.):
+    # Grid -> fft -> rolloff -> crop, streamed over chunks of coils, slices
+    # and dynamics so that the oversampled grid is never allocated for the
+    # whole data set.  Only the cropped images are written to out.
+    #   data: np.complex64 [nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points]
+    #   coords, weights, kernel, nthreads, separable, order, kernel_width, dx, dy: see grid2D()
+    #   mtx_xy: int, oversampled grid matrix size
+    #   roll: rolloff for mtx_xy from rolloff2D_analytic()
+    #   crop_xy: int, matrix size of the (centered) output images
+    #   out: np.complex64 [nr_coils, extra_dim2, extra_dim1, crop_xy, crop_xy]
+    #        to write into (optional)
+    #   memory_mb: bound on the oversampled grids and their transforms
+    #              held at once (0: all in one chunk)
+    with profiler.stage('grid images', samples=data.size):
+        [nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points] = data.shape
+        if out is None:
+            out = np.zeros([nr_coils, extra_dim2, extra_dim1, crop_xy, crop_xy], dtype=np.complex64)
+
+        # number of images per chunk, the gridded k-space and its transform
+        # are alive at the same time
+        image_bytes = 2 * mtx_xy * mtx_xy * np.dtype(np.complex64).itemsize
+        if memory_mb > 0:
+            nr_images = max(1, int(memory_mb * 2**20) // image_bytes)
         else:
-            extra1_coords = extra1
-        for extra2 in range(extra_dim2):
-            for coil in range(nr_coils):
-                gridded_kspace[coil,extra2,extra1,:,:] = bni_grid.grid(coords[extra1_coords,:,:,:], data[coil,extra2,extra1,:,:], weights[extra1_coords,:,:], kernel, outdim, dx, dy)
+            nr_images = nr_coils * extra_dim2 * extra_dim1
+
+        # keep coils together (one pass over the samples grids all of them),
+        # then slices, then dynamics
+        coil_chunk = min(nr_coils, nr_images)
+        extra2_chunk = min(extra_dim2, max(1, nr_images // coil_chunk))
+        extra1_chunk = min(extra_dim1, max(1, nr_images // (coil_chunk * extra2_chunk)))
+
+        nr_sets = coords.shape[0]
+        for c0 in range(0, nr_coils, coil_chunk):
+            coils = slice(c0, min(c0 + coil_chunk, nr_coils))
+            for e2 in range(0, extra_dim2, extra2_chunk):
+                extra2 = slice(e2, min(e2 + extra2_chunk, extra_dim2))
+                for e1 in range(0, extra_dim1, extra1_chunk):
+                    extra1 = slice(e1, min(e1 + extra1_chunk, extra_dim1))
+                    chunk = data[coils, extra2, extra1]
+                    crds = extra1 if (nr_sets > 1) else slice(None)
+                    out_dims_grid = list(chunk.shape[:3]) + [mtx_xy, nr_arms, nr_points]
+                    gridded_kspace = grid2D(chunk, coords[crds], weights[crds], kernel, out_dims_grid, nthreads=nthreads,
+                                            separable=separable, order=None if order is None else order[crds],
+                                            kernel_width=kernel_width, dx=dx, dy=dy)
+                    images = out[coils, extra2, extra1]
+                    images[...] = fft2D_crop(gridded_kspace, crop_xy, dir=0)
+                    del gridded_kspace
+                    apply_rolloff2D(images, roll)
+        return out
+
+def stack_partitions3D(coords, mtx_z=0):
+    # Split a stack-of-spirals trajectory into its kz partitions.  Each arm
+    # lies in one partition (kz = p/mtx_z), and every partition has the same
+    # in-plane trajectory, so the 3D problem separates into a 1D FFT along
+    # kz (kz_transform3D()) and one 2D gridding problem per z partition with
+    # the shared 2D trajectory.
+    #   coords: np.float32 [nr_sets, nr_arms, nr_points, 3], kz in the last
+    #           component, scaled between -0.5 and 0.5 like kx and ky
+    #   mtx_z: int, number of partitions (0: from the kz spacing)
+    #   OUTPUT: (coords2D: np.float32 [nr_sets, arms per partition, nr_points, 2],
+    #            arms: np.int64 [nr_partitions, arms per partition], the arms of
+    #                  each measured partition (in acquisition order),
+    #            partitions: np.int64 [nr_partitions], their index on the kz
+    #                  grid (mtx_z//2 is kz = 0),
+    #            mtx_z)
+    with profiler.stage('stack partitions', samples=coords.size // 3):
+        kz = coords[..., 2].astype(np.float64)
+        if mtx_z <= 0:
+            steps = np.diff(np.unique(np.round(kz, 6)))
+            steps = steps[steps > 1e-6]
+            mtx_z = int(np.rint(1.0 / steps.min())) if steps.size else 1
+
+        index = np.rint(kz * mtx_z)
+        if (np.abs(kz * mtx_z - index).max() > 0.01) or (np.ptp(index, axis=-1).max() > 0) or (np.ptp(index, axis=0).max() > 0):
+            raise ValueError("not a stack of spirals: the arms are not on a grid of " + str(mtx_z) + " kz partitions")
+        index = index[0, :, 0].astype(np.int64) + mtx_z // 2
+        if (index.min() < 0) or (index.max() >= mtx_z):
+            raise ValueError("kz is outside of the " + str(mtx_z) + " partitions")
+
+        partitions = np.unique(index)
+        arms = [np.flatnonzero(index == p) for p in partitions]
+        if len(set(a.size for a in arms)) > 1:
+            raise ValueError("not a stack of spirals: the partitions have different numbers of arms")
+        arms = np.array(arms, dtype=np.int64)
+
+        coords2D = np.ascontiguousarray(coords[:, arms[0], :, :2], dtype=np.float32)
+        for a in arms[1:]:
+            if np.abs(coords[:, a, :, :2] - coords2D).max() > 1e-5:
+                raise ValueError("not a stack of spirals: the partitions have different in-plane trajectories")
+        return coords2D, arms, partitions, mtx_z
 
-    return gridded_kspace
+def kz_transform3D(data, weights, arms, partitions, mtx_z, dz=0.):
+    # The 1D FFT along kz of a stack-of-spirals data set, each z partition
+    # is then an independent 2D gridding problem for the shared in-plane
+    # trajectory (see stack_partitions3D()).  Partitions that were not
+    # measured are zero.  The samples are multiplied by their (3D) density
+    # weights here, grid the result with unit weights.
+    #   data: np.complex64 [nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points]
+    #   weights: np.float32 [nr_sets, nr_arms, nr_points]
+    #   arms, partitions, mtx_z: from stack_partitions3D()
+    #   dz: off-center in partitions, a linear phase along kz (see grid2D()
+    #       for dx, dy)
+    #   OUTPUT: np.complex64 [nr_coils, extra_dim2*mtx_z, extra_dim1, arms per partition, nr_points],
+    #           z partitions are the fastest index of the second dimension
+    with profiler.stage('kz fft', samples=data.size):
+        [nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points] = data.shape
+        [nr_partitions, nr_arms_2D] = arms.shape
+
+        # [nr_coils * extra_dim2, mtx_z, extra_dim1, nr_arms_2D, nr_points]
+        kspace = np.zeros([nr_coils * extra_dim2, mtx_z, extra_dim1, nr_arms_2D, nr_points], dtype=np.complex64)
+        d = data.reshape(nr_coils * extra_dim2, extra_dim1, nr_arms, nr_points)
+        for p, partition in enumerate(partitions):
+            kspace[:, partition] = d[:, :, arms[p], :] * weights[:, arms[p], :]
+            if dz:
+                kz = (partition - mtx_z // 2) / float(mtx_z)
+                kspace[:, partition] *= np.complex64(np.exp(-2j * np.pi * kz * dz))
+
+        outdims = np.array(kspace.shape[::-1], dtype=np.int64)
+        out = backends.current.fftw(kspace, outdims, dir=0, dim1=0, dim2=0, dim3=0, dim4=1, dim5=0, nthreads=fft_plans.nthreads)
+        return out.reshape(nr_coils, extra_dim2 * mtx_z, extra_dim1, nr_arms_2D, nr_points)
 
 def autocalibrationB1Maps2D(images, taper=50, width=10, mask_floor=1, average_csm=0):
-    # dimensions
-    mtx        = images.shape[-1]
-    extra_dim1 = images.shape[-3]
-    extra_dim2 = images.shape[-4]
-    nr_coils   = images.shape[-5]
-
-    # Dynamic data - average all dynamics for csm
-    if ( (extra_dim1 > 1) and (average_csm) ):
-        images_for_csm = images.sum(axis=-3)
-        images_for_csm.shape = [nr_coils,extra_dim2,1,mtx,mtx]
-    else:
-        images_for_csm = images
-
-    # generate window function for blurring image data
-    win = window2(images_for_csm.shape[-2:], windowpct=taper, widthpct=width)
-
-    # apply kspace filter
-    kspace = fft2D(images_for_csm, dir=1)
-    kspace *= win
-
-    # transform back into image space and normalize
-    csm = fft2D(kspace, dir=0)
-    rms = np.sqrt(np.sum(np.abs(csm)**2, axis=0))
-    csm = csm / rms
-
-    # zero out points that are below the mask threshold
-    thresh = mask_floor/100.0 * rms.max()
-    csm *= rms > thresh
+    with profiler.stage('csm', samples=images.size):
+        # dimensions
+        mtx        = images.shape[-1]
+        extra_dim1 = images.shape[-3]
+        extra_dim2 = images.shape[-4]
+        nr_coils   = images.shape[-5]
+
+        # Dynamic data - average all dynamics for csm
+        if ( (extra_dim1 > 1) and (average_csm) ):
+            images_for_csm = images.sum(axis=-3)
+            images_for_csm.shape = [nr_coils,extra_dim2,1,mtx,mtx]
+        else:
+            images_for_csm = images
+
+        # generate window function for blurring image data
+        win = window2(images_for_csm.shape[-2:], windowpct=taper, widthpct=width)
+
+        # apply kspace filter
+        kspace = fft2D(images_for_csm, dir=1)
+        kspace *= win
+
+        # transform back into image space and normalize
+        csm = _normalize_b1maps2D(fft2D(kspace, dir=0), mask_floor)
     
-    # Dynamic data - average all dynamics for csm - asign the average to all dynamics
-    if ( (extra_dim1 > 1) and (average_csm) ):
-        out = np.zeros(images.shape, np.complex64)
-        for coil in range(nr_coils):
-            for extra2 in range(extra_dim2):
-                for extra1 in range(extra_dim1):
-                    out[coil,extra2,extra1,:,:] = csm[coil,extra2,0,:,:]
-    else:
-        out=csm
+        # Dynamic data - average all dynamics for csm - asign the average to all dynamics
+        if ( (extra_dim1 > 1) and (average_csm) ):
+            return np.repeat(csm, extra_dim1, axis=-3)
+        return csm
 
-    return out
+def _normalize_b1maps2D(csm, mask_floor):
+    # coil images -> maps with unit sum-of-squares (in place), zero where
+    # the sum-of-squares is below mask_floor percent of its maximum
+    sos = np.zeros(csm.shape[1:], dtype=np.float32)
+    for coil in csm:
+        sos += coil.real**2
+        sos += coil.imag**2
+    rms = np.sqrt(sos)
+
+    # zero out points that are below the mask threshold, one multiply with
+    # the masked 1 / rms
+    thresh = mask_floor/100.0 * rms.max()
+    scale = np.zeros_like(rms)
+    np.divide(1.0, rms, out=scale, where=(rms > thresh))
+    csm *= scale
+    return csm
+
+def calibration_matrix2D(mtx_xy, width=10, kernel_width=KERNEL_WIDTH):
+    # Smallest even matrix with the k-space pixels of the mtx_xy grid that
+    # holds the central width percent of k-space (the support of the window
+    # of autocalibrationB1Maps2D()) with the calibration samples up to two
+    # kernel widths around it, and their kernel without wrapping onto it.
+    mtx_cal = int(np.ceil(mtx_xy * width / 100.0 + 5 * kernel_width)) + 1
+    mtx_cal += mtx_cal % 2
+    return min(mtx_cal, mtx_xy)
+
+def lowres_autocalibrationB1Maps2D(data, coords, weights, kernel, mtx_xy, oversampling_ratio, taper=50, width=10, mask_floor=1, average_csm=0,
+                                   nthreads=1, separable=False, kernel_width=KERNEL_WIDTH):
+    # autocalibrationB1Maps2D() from the samples: only the central k-space
+    # samples that reach the window are gridded onto a small matrix
+    # (calibration_matrix2D()) with the k-space pixels of the mtx_xy grid,
+    # the window is applied there and the smoothed coil images are
+    # zero-padded to mtx_xy in k-space before the normalization.  This
+    # replaces the forward and inverse FFT of the oversampled coil images.
+    #   data: np.complex64 [nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points]
+    #   coords, weights, kernel, nthreads, separable, kernel_width: see grid2D()
+    #   mtx_xy, oversampling_ratio: the oversampled grid of the maps
+    #   taper, width, mask_floor, average_csm: see autocalibrationB1Maps2D()
+    #   OUTPUT: np.complex64 [nr_coils, extra_dim2, extra_dim1, mtx_xy, mtx_xy]
+    with profiler.stage('csm', samples=int(np.prod(data.shape[:3])) * mtx_xy * mtx_xy):
+        [nr_coils, extra_dim2, extra_dim1] = data.shape[:3]
+        nr_sets = coords.shape[0]
+        mtx_cal = calibration_matrix2D(mtx_xy, width, kernel_width)
+
+        # samples within the window radius plus two kernel widths, per set
+        # (padded with zero weights to the same number), the rolloff
+        # correction spreads every gridded sample over all of k-space
+        with profiler.stage('calibration samples'):
+            set_coords = coords.reshape(nr_sets, -1, 2)
+            set_weights = weights.reshape(nr_sets, -1)
+            k_max = (width / 200.0 * mtx_xy + 2 * kernel_width) / mtx_xy
+            inside = [np.flatnonzero(np.sum(c**2, axis=-1) <= k_max**2) for c in set_coords]
+            nr_inside = max(1, max(len(i) for i in inside))
+            cal_coords = np.zeros([nr_sets, 1, nr_inside, 2], dtype=np.float32)
+            cal_weights = np.zeros([nr_sets, 1, nr_inside], dtype=np.float32)
+            cal_data = np.zeros([nr_coils, extra_dim2, extra_dim1, 1, nr_inside], dtype=np.complex64)
+            samples = data.reshape(nr_coils, extra_dim2, extra_dim1, -1)
+            for crd_set, i in enumerate(inside):
+                cal_coords[crd_set, 0, :len(i)] = set_coords[crd_set, i] * (mtx_xy / float(mtx_cal))
+                cal_weights[crd_set, 0, :len(i)] = set_weights[crd_set, i]
+                if nr_sets > 1:
+                    cal_data[:, :, crd_set, 0, :len(i)] = samples[:, :, crd_set, i]
+                else:
+                    cal_data[..., 0, :len(i)] = samples[..., i]
+
+        # Dynamic data - average all dynamics for csm, the sum of the
+        # gridded dynamics (all share one trajectory: sum the samples)
+        average = (extra_dim1 > 1) and average_csm
+        if average and (nr_sets == 1):
+            cal_data = cal_data.sum(axis=2, keepdims=True)
+        kspace = grid2D(cal_data, cal_coords, cal_weights, kernel, [nr_coils, extra_dim2, cal_data.shape[2], mtx_cal, 1, nr_inside],
+                        nthreads=nthreads, separable=separable, kernel_width=kernel_width)
+        if average and (nr_sets > 1):
+            kspace = kspace.sum(axis=2, keepdims=True)
+
+        # rolloff correction and window on the small matrix (the window has
+        # the same k-space pixels as on the mtx_xy grid)
+        roll = rolloff2D_analytic(mtx_cal, oversampling_ratio, separable=separable, broadcast=separable, kernel_width=kernel_width)
+        images = apply_rolloff2D(fft2D(kspace, dir=0), roll)
+        kspace = fft2D(images, dir=1)
+        kspace *= window2(kspace.shape[-2:], windowpct=taper, widthpct=width * mtx_xy / float(mtx_cal))
+
+        # zero-filled to the oversampled matrix and normalized
+        csm = _normalize_b1maps2D(fft2D_zeropad(kspace, mtx_xy, dir=0), mask_floor)
+        if average:
+            return np.repeat(csm, extra_dim1, axis=-3)
+        return csm
+
+def coil_compression_matrix2D(data, nr_virtual_coils=0, energy_percent=100.0):
+    # SVD (PCA) coil compression: the dominant left singular vectors of the
+    # [nr_coils, nr_samples] data matrix, from the eigendecomposition of the
+    # coil covariance.  All slices and dynamics in data share one matrix, so
+    # a dynamic series is compressed into the same virtual coils.
+    #   data: np.complex64 [nr_coils, ...] k-space (or image) data
+    #   nr_virtual_coils: int, maximum number of virtual coils (0: no limit)
+    #   energy_percent: keep the fewest virtual coils that hold this
+    #                   percentage of the signal energy
+    #   OUTPUT: np.complex64 [nr_virtual_coils, nr_coils], see compress_coils2D()
+    with profiler.stage('coil compression', samples=data.size):
+        nr_coils = data.shape[0]
+        samples = np.ascontiguousarray(data).reshape(nr_coils, -1)
+        covariance = np.dot(samples, samples.conj().T).astype(np.complex128)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+
+        # strongest virtual coil first
+        eigenvalues = np.maximum(eigenvalues[::-1], 0)
+        eigenvectors = eigenvectors[:, ::-1]
+
+        energy = np.cumsum(eigenvalues) / max(eigenvalues.sum(), np.finfo(np.float64).tiny)
+        nr_virtual = int(np.searchsorted(energy, energy_percent/100.0 * (1.0 - 1e-9))) + 1
+        nr_virtual = min(nr_virtual, nr_coils)
+        if nr_virtual_coils > 0:
+            nr_virtual = min(nr_virtual, nr_virtual_coils)
+        return eigenvectors[:, :nr_virtual].conj().T.astype(np.complex64)
+
+def compress_coils2D(data, compression):
+    # Combine the coils of data (k-space data or coil sensitivities) into
+    # virtual coils.
+    #   data: np.complex64 [nr_coils, ...]
+    #   compression: output of coil_compression_matrix2D()
+    #   OUTPUT: np.complex64 [nr_virtual_coils, ...]
+    with profiler.stage('coil compression', samples=data.size):
+        out = np.dot(compression, np.ascontiguousarray(data).reshape(data.shape[0], -1))
+        return out.reshape((compression.shape[0],) + data.shape[1:]).astype(np.complex64, copy=False)
 
-def degrid2D(data, coords, kernel, outdims):
+def degrid2D(data, coords, kernel, outdims, plan=None, out=None, nthreads=1, separable=False, order=None, kernel_width=KERNEL_WIDTH,
+             dx=0., dy=0.):
     # data: np.float32
     # coords: np.complex64
     # weights: np.float32
     # kernel: np.float64
     # outdims = [nr_coils, extra_dim2, extra_dim1, mtx_xy, mtx_xy]: int
-    import bni.gridding.grid_kaiser as bni_grid
+    # plan: GriddingPlan for these coords (optional)
+    # out: C-contiguous np.complex64 array to degrid into (optional)
+    # nthreads: int, number of threads
+    # separable: bool, use the separable instead of the radial kernel
+    #            (ignored with a plan, which has its own kernel mode)
+    # order: sample order from sample_order2D() (optional), the output is
+    #        in acquisition order regardless
+    # kernel_width: kernel width in k-space pixels (see kaiserbessel_kernel())
+    # dx, dy: off-center in pixels of grid2D(), the samples get the opposite
+    #         phase (adjoint) inside the degridding (not with a plan)
     
-    [nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points] = outdims
-    
-    # coordinate dimensions
-    if coords.shape[0] == 1:
-        same_coords_for_all_slices_and_dynamics = True
-    else:
-        same_coords_for_all_slices_and_dynamics = False
-
-    # gridded kspace
-    degridded_kspace = np.zeros([nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points], dtype=data.dtype)
-
-    # degrid all slices
-    for extra1 in range(extra_dim1):
-        if same_coords_for_all_slices_and_dynamics:
-            extra1_coords = 0
+    with profiler.stage('degrid', samples=int(np.prod(outdims))):
+        [nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points] = outdims
+        mtx_xy = data.shape[-1]
+
+        # degridded kspace
+        if out is None:
+            out = np.zeros([nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points], dtype=data.dtype)
+        elif not out.flags.c_contiguous:
+            # the backends write through a reshape of out, which would be a copy
+            raise ValueError("degrid2D: out must be C-contiguous")
+        if plan is not None:
+            if dx or dy:
+                raise ValueError("degrid2D: no off-center shift with a gridding plan")
+            return plan.degrid(data, out, nthreads=nthreads)
+
+        # degrid all coils, slices and dynamics in one pass over the samples
+        nr_sets = coords.shape[0]
+        backends.current.degrid_batch(
+            np.ascontiguousarray(coords).reshape(nr_sets, nr_arms * nr_points, 2),
+            np.ascontiguousarray(data).reshape(nr_coils * extra_dim2, extra_dim1, mtx_xy, mtx_xy),
+            kernel,
+            out.reshape(nr_coils * extra_dim2, extra_dim1, nr_arms * nr_points),
+            ACQUISITION_ORDER if order is None else order,
+            nthreads=nthreads, separable=int(separable), kernel_width=kernel_width, dx=dx, dy=dy)
+
+        return out
+
+
+def toeplitz_kernel2D(coords, weights, kernel, mtx_xy, oversampling_ratio, nthreads=1, separable=False, kernel_width=KERNEL_WIDTH):
+    # Transfer function of the gridding normal operator (degrid -> grid) for
+    # a fixed trajectory, see toeplitz2D().  The point-spread function is
+    # gridded from the weights onto an oversampled grid that is twice the
+    # image size, so the circular convolution in toeplitz2D() doesn't wrap.
+    #   coords: np.float32 [nr_sets, nr_arms, nr_points, 2]
+    #   weights: np.float32 [nr_sets, nr_arms, nr_points]
+    #   kernel: np.float32 kernel table for oversampling_ratio
+    #   mtx_xy: int, (even) image matrix the operator is applied to
+    #   separable: bool, kernel mode of the direct operator
+    #   kernel_width: kernel width of the kernel table in k-space pixels
+    #   OUTPUT: np.complex64 [1, 1, nr_sets, 2*mtx_xy, 2*mtx_xy]
+    with profiler.stage('toeplitz kernel', samples=weights.size):
+        [nr_sets, nr_arms, nr_points] = weights.shape
+        mtx_psf = 2 * mtx_xy
+
+        # grid the weights (i.e. a delta in image space after degridding)
+        mtx_grid = int(mtx_psf * oversampling_ratio)
+        if mtx_grid % 2:
+            mtx_grid += 1
+        ones = np.ones([1, 1, nr_sets, nr_arms, nr_points], dtype=np.complex64)
+        psf = grid2D(ones, coords, weights, kernel, [1, 1, nr_sets, mtx_grid, nr_arms, nr_points], nthreads=nthreads, separable=separable,
+                     kernel_width=kernel_width)
+        psf = fft2D_crop(psf, mtx_psf, dir=0)
+        apply_rolloff2D(psf, rolloff2D_analytic(mtx_grid, oversampling_ratio, separable=separable, broadcast=separable, kernel_width=kernel_width))
+        psf_kernel = fft2D(np.ascontiguousarray(psf), dir=1)
+
+        # scale to match the direct operator, this takes care of the fft and
+        # rolloff normalization
+        delta = np.zeros([1, 1, 1, mtx_xy, mtx_xy], dtype=np.complex64)
+        delta[..., mtx_xy // 2, mtx_xy // 2] = 1.
+        roll = rolloff2D_analytic(mtx_xy, oversampling_ratio, separable=separable, kernel_width=kernel_width)
+        direct = fft2D(delta * roll, dir=1)
+        direct = degrid2D(direct, coords[:1], kernel, [1, 1, 1, nr_arms, nr_points], nthreads=nthreads, separable=separable,
+                          kernel_width=kernel_width)
+        direct = grid2D(direct, coords[:1], weights[:1], kernel, [1, 1, 1, mtx_xy, nr_arms, nr_points], nthreads=nthreads, separable=separable,
+                        kernel_width=kernel_width)
+        direct = fft2D(direct, dir=0) * roll
+        toeplitz = toeplitz2D(delta, psf_kernel[:, :, :1])
+        center = (Ellipsis, mtx_xy // 2, mtx_xy // 2)
+        psf_kernel *= (direct[center] / toeplitz[center]).real
+
+        return psf_kernel
+
+def toeplitz2D(data, psf_kernel):
+    # Apply the gridding normal operator (rolloff -> fft -> degrid -> grid ->
+    # fft -> rolloff) as a zero-padded convolution with the point-spread
+    # function.  Only FFTs are needed once the kernel is known.
+    #   data: np.complex64 [nr_coils, extra_dim2, extra_dim1, mtx_xy, mtx_xy]
+    #   psf_kernel: output of toeplitz_kernel2D()
+    with profiler.stage('toeplitz', samples=data.size):
+        mtx_xy = data.shape[-1]
+
+        out = fft2D_zeropad(data, 2 * mtx_xy, dir=1)
+        out *= psf_kernel
+        return fft2D_crop(out, mtx_xy, dir=0)
+
+class SenseNormalOperator2D(object):
+    # The CG SENSE normal operator A^H A (coil phase -> rolloff -> fft ->
+    # degrid -> grid -> fft -> rolloff -> remove coil phase -> coil sum)
+    # with preallocated buffers for the coil images and the degridded
+    # samples.  Only the FFTs allocate.
+    #
+    # csm: np.complex64 [nr_coils, extra_dim2, extra_dim1, mtx_xy, mtx_xy]
+    # coords: np.float32 [nr_sets, nr_arms, nr_points, 2]
+    # weights: np.float32 [nr_sets, nr_arms, nr_points]
+    # kernel: np.float32 kernel table
+    # roll: rolloff from rolloff2D_analytic()
+    # plan: GriddingPlan (optional)
+    # psf_kernel: output of toeplitz_kernel2D() to apply degrid -> grid as a
+    #             convolution instead (optional)
+    # fov_mask: np.float32 [mtx_xy, mtx_xy] support of the solution for the
+    #           Toeplitz operator
+    # nthreads, separable, order, kernel_width: see grid2D() and degrid2D()
+
+    def __init__(self, csm, coords, weights, kernel, roll, plan=None, psf_kernel=None, fov_mask=None, nthreads=1, separable=False, order=None,
+                 kernel_width=KERNEL_WIDTH):
+        self.csm = csm
+        self.csm_conj = np.conj(csm)
+        self.coords = coords
+        self.weights = weights
+        self.kernel = kernel
+        self.roll = roll
+        self.plan = plan
+        self.psf_kernel = psf_kernel
+        self.fov_mask = fov_mask
+        self.nthreads = nthreads
+        self.separable = separable
+        self.order = order
+        self.kernel_width = kernel_width
+
+        # buffers, allocated for the image size of the first call
+        self._coil_images = None
+        self._samples = None
+
+    def _allocate(self, d):
+        [extra_dim2, extra_dim1, mtx_xy] = d.shape[:3]
+        [nr_arms, nr_points] = self.coords.shape[1:3]
+        nr_coils = self.csm.shape[0]
+        self.out_dims_grid = [nr_coils, extra_dim2, extra_dim1, mtx_xy, nr_arms, nr_points]
+        self.out_dims_degrid = [nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points]
+
+        self._coil_images = np.empty([nr_coils] + list(d.shape), dtype=np.complex64)
+        if self.psf_kernel is None:
+            self._samples = np.empty(self.out_dims_degrid, dtype=np.complex64)
+        self._nr_samples = int(np.prod(self.out_dims_degrid))
+
+    def __call__(self, d, out):
+        # d: np.complex64 [extra_dim2, extra_dim1, mtx_xy, mtx_xy]
+        # out: np.complex64 like d, A^H A d
+        if (self._coil_images is None) or (self._coil_images.shape[1:] != d.shape):
+            self._allocate(d)
+
+        # samples: k-space samples of all coils
+        with profiler.stage('normal operator', samples=self._nr_samples):
+            Ad = np.multiply(self.csm, d, out=self._coil_images)  # add coil phase
+            if self.psf_kernel is not None:
+                #   degrid -> grid as a convolution with the psf
+                Ad *= self.fov_mask
+                Ad = toeplitz2D(Ad, self.psf_kernel)
+                Ad *= self.fov_mask
+            else:
+                #   degrid -> grid (all coils at once)
+                apply_rolloff2D(Ad, self.roll)  # pre-rolloff for degrid convolution
+                kspace = fft2D(Ad, dir=1)
+                degrid2D(kspace, self.coords, self.kernel, self.out_dims_degrid, plan=self.plan, out=self._samples,
+                         nthreads=self.nthreads, separable=self.separable, order=self.order, kernel_width=self.kernel_width)
+                grid2D(self._samples, self.coords, self.weights, self.kernel, self.out_dims_grid, plan=self.plan, out=self._coil_images,
+                       nthreads=self.nthreads, separable=self.separable, order=self.order, kernel_width=self.kernel_width)
+                Ad = fft2D(self._coil_images, dir=0)
+                apply_rolloff2D(Ad, self.roll)
+            Ad *= self.csm_conj  # remove coil phase
+            return np.sum(Ad, axis=0, out=out)  # assume the coil dim is the first
+
+def csm_preconditioner2D(csm, floor_percent=1):
+    # Diagonal (image space) preconditioner for CG SENSE, the inverse of the
+    # coil sum-of-squares sum_c |csm_c|^2 which is the diagonal of A^H A up
+    # to the peak of the point-spread function.
+    #   csm: np.complex64 [nr_coils, extra_dim2, extra_dim1, mtx_xy, mtx_xy]
+    #   floor_percent: the sum-of-squares is clamped to this percentage of
+    #                  its maximum
+    #   OUTPUT: callable(r, out) for ConjugateGradient
+    sos = np.sum(np.abs(csm)**2, axis=0)
+    sos = np.maximum(sos, sos.max() * floor_percent/100.0)
+    inv_sos = (1.0/sos).astype(np.float32)
+
+    def precondition(r, out):
+        return np.multiply(r, inv_sos, out=out)
+    return precondition
+
+def density_preconditioner2D(coords, weights, kernel, mtx_xy, floor_percent=5, nthreads=1, separable=False, kernel_width=KERNEL_WIDTH):
+    # Circulant (k-space) preconditioner for CG SENSE: the inverse of the
+    # k-space sample density, i.e. the weights gridded onto the Cartesian
+    # grid, applied to the Fourier transform of the residual.  This is the
+    # diagonal of A^H A in k-space.  It compensates for the part of the
+    # density that the weights don't take out.
+    #   coords: np.float32 [nr_sets, nr_arms, nr_points, 2]
+    #   weights: np.float32 [nr_sets, nr_arms, nr_points]
+    #   mtx_xy: int, (oversampled) matrix the CG runs on
+    #   floor_percent: the density is clamped to this percentage of its
+    #                  maximum (unsampled k-space), per set of coordinates
+    #   OUTPUT: callable(r, out) for ConjugateGradient
+    [nr_sets, nr_arms, nr_points] = weights.shape
+    ones = np.ones([1, 1, nr_sets, nr_arms, nr_points], dtype=np.complex64)
+    density = grid2D(ones, coords, weights, kernel, [1, 1, nr_sets, mtx_xy, nr_arms, nr_points], nthreads=nthreads, separable=separable,
+                     kernel_width=kernel_width)
+    density = np.abs(density[0, 0])
+    density = np.maximum(density, density.max(axis=(-2, -1), keepdims=True) * floor_percent/100.0)
+    inv_density = (1.0/density).astype(np.float32)
+
+    def precondition(r, out):
+        kspace = fft2D(r, dir=1)
+        kspace *= inv_density
+        out[...] = fft2D(kspace, dir=0)
+        return out
+    return precondition
+
+class ConjugateGradient(object):
+    # (Preconditioned) conjugate gradient iterations for A^H A x = A^H b
+    # (Shewchuk 1994) on preallocated vectors.  The updates are done in
+    # place, so an iteration doesn't allocate beyond what the normal
+    # operator and the preconditioner themselves need.
+    #
+    # normal_operator: callable(d, out) that writes A^H A d into out
+    # shape: shape of the solution
+    # system_ndim: number of trailing axes that make up one linear system,
+    #              the leading axes (e.g. slices and dynamics) index
+    #              independent systems, |r| is reported per system
+    # tolerance: relative residual |r|/|r0| at which a system has converged
+    #            and is no longer updated, the systems then get their own
+    #            step sizes.  0: one joint step size for all systems as a
+    #            single CG on the whole stack, until exact convergence
+    # preconditioner: callable(r, out) that writes M^-1 r into out, M
+    #                 Hermitian positive definite (optional), see
+    #                 csm_preconditioner2D() and density_preconditioner2D()
+    #
+    # The state (x, r, d) can be seeded from a previous run with start() to
+    # continue the iterations.
+
+    def __init__(self, normal_operator, shape, dtype=np.complex64, system_ndim=2, tolerance=0., preconditioner=None):
+        self.normal_operator = normal_operator
+        self.preconditioner = preconditioner
+        self.tolerance = tolerance
+        self.joint = (tolerance == 0)
+        self.x = np.zeros(shape, dtype=dtype)
+        self.r = np.zeros(shape, dtype=dtype)
+        self.d = np.zeros(shape, dtype=dtype)
+        self.Ad = np.zeros(shape, dtype=dtype)
+        self._tmp = np.zeros(shape, dtype=dtype)
+
+        # preconditioned residual z = M^-1 r
+        if preconditioner is None:
+            self.z = self.r
         else:
-            extra1_coords = extra1
-        for extra2 in range(extra_dim2):
-            for coil in range(nr_coils):
-                degridded_kspace[coil,extra2,extra1,:,:] = bni_grid.degrid(coords[extra1_coords,:,:,:], data[coil,extra2,extra1,:,:], kernel)
+            self.z = np.zeros(shape, dtype=dtype)
+
+        # per system: r^H r, r^H z, |r0| and whether it is still iterated
+        systems_shape = tuple(shape[:len(shape) - system_ndim])
+        self._systems = list(np.ndindex(systems_shape))
+        self.rHr = np.zeros(systems_shape, dtype=np.float64)
+        self.rHz = np.zeros(systems_shape, dtype=np.float64)
+        self.r0_norm = np.zeros(systems_shape, dtype=np.float64)
+        self.active = np.ones(systems_shape, dtype=bool)
+
+    def start(self, b=None, x=None, r=None, d=None, r0_norm=None):
+        # b: A^H b, starts from x = 0 with r = b and d = M^-1 b
+        # x, r, d: state of previous iterations (instead of b)
+        # r0_norm: |r0| per system of the previous iterations (defaults to
+        #          |r| of the given state)
+        if b is not None:
+            self.x[...] = 0.
+            self.r[...] = b
+        else:
+            self.x[...] = x
+            self.r[...] = r
+        self._precondition()
+        if b is not None:
+            self.d[...] = self.z
+        else:
+            self.d[...] = d
+        for s in self._systems:
+            self.rHr[s] = np.vdot(self.r[s], self.r[s]).real
+            self.rHz[s] = self.rHr[s] if (self.z is self.r) else np.vdot(self.r[s], self.z[s]).real
+        if r0_norm is None:
+            self.r0_norm[...] = np.sqrt(self.rHr)
+        else:
+            self.r0_norm[...] = r0_norm
+        self._update_active()
+
+    def _precondition(self):
+        if self.preconditioner is not None:
+            with profiler.stage('preconditioner', samples=self.r.size):
+                self.preconditioner(self.r, out=self.z)
+
+    def _update_active(self):
+        if self.joint:
+            self.active[...] = self.rHr.sum() > 0
+        else:
+            self.active[...] = self.residual_norm() > self.tolerance * self.r0_norm
+
+    def residual_norm(self):
+        # |r| per system
+        return np.sqrt(self.rHr)
+
+    def converged(self):
+        return not self.active.any()
+
+    def iterate(self):
+        with profiler.stage('cg iteration', samples=self.x.size):
+            self.normal_operator(self.d, out=self.Ad)
+            if self.joint:
+                return self._iterate_joint()
+
+            for s in self._systems:
+                if not self.active[s]:
+                    continue
+                x, r, d, Ad, tmp = self.x[s], self.r[s], self.d[s], self.Ad[s], self._tmp[s]
+
+                # alpha = r^H z / (d^H Ad)
+                alpha = self.rHz[s] / np.vdot(d, Ad)
+
+                # x(i+1) = x(i) + alpha d(i)
+                np.multiply(d, alpha, out=tmp)
+                x += tmp
+
+                # r(i+1) = r(i) - alpha Ad(i)
+                np.multiply(Ad, alpha, out=tmp)
+                r -= tmp
+
+            # z(i+1) = M^-1 r(i+1)
+            self._precondition()
+
+            for s in self._systems:
+                if not self.active[s]:
+                    continue
+                r, z, d = self.r[s], self.z[s], self.d[s]
+
+                # beta = r(i+1)^H z(i+1) / (r(i)^H z(i))
+                self.rHr[s] = np.vdot(r, r).real
+                r1Hz1 = self.rHr[s] if (self.z is self.r) else np.vdot(r, z).real
+                beta = r1Hz1 / self.rHz[s]
+                self.rHz[s] = r1Hz1
+
+                # d(i+1) = z(i+1) + beta d(i)
+                d *= beta
+                d += z
+
+            self._update_active()
+            return self.x
+
+    def _iterate_joint(self):
+        # the same steps with the inner products over all systems
+        if not self.active.any():
+            return self.x
+        alpha = self.rHz.sum() / np.vdot(self.d, self.Ad)
+        np.multiply(self.d, alpha, out=self._tmp)
+        self.x += self._tmp
+        np.multiply(self.Ad, alpha, out=self._tmp)
+        self.r -= self._tmp
+
+        self._precondition()
+
+        rHz = self.rHz.sum()
+        for s in self._systems:
+            self.rHr[s] = np.vdot(self.r[s], self.r[s]).real
+            self.rHz[s] = self.rHr[s] if (self.z is self.r) else np.vdot(self.r[s], self.z[s]).real
+        beta = self.rHz.sum() / rHz
+        self.d *= beta
+        self.d += self.z
+
+        self._update_active()
+        return self.x
+
+HISTORY_FILE_PREFIX = 'x_iterations_'
+_removed_at_exit = set()
+
+def temporary_history_file():
+    # new empty file in the temporary directory for a memory-mapped
+    # IterationHistory2D, see remove_temporary_history_file()
+    import os
+    import tempfile
+    fd, filename = tempfile.mkstemp(prefix=HISTORY_FILE_PREFIX, suffix='.raw')
+    os.close(fd)
+    return filename
+
+def is_temporary_history_file(filename):
+    import os
+    import tempfile
+    return ((os.path.dirname(os.path.abspath(filename)) == os.path.abspath(tempfile.gettempdir()))
+            and os.path.basename(filename).startswith(HISTORY_FILE_PREFIX))
+
+def remove_temporary_history_file(filename, at_exit=False):
+    # remove a file of temporary_history_file() now or when this process
+    # exits (the forked GPI_PROCESS children exit without atexit handlers)
+    import os
+    if not is_temporary_history_file(filename):
+        return
+    if at_exit:
+        if not _removed_at_exit:
+            import atexit
+            atexit.register(lambda: [remove_temporary_history_file(f) for f in list(_removed_at_exit)])
+        _removed_at_exit.add(filename)
+        return
+    _removed_at_exit.discard(filename)
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+class IterationHistory2D(object):
+    # Every interval-th (cropped) CG iterate for the 'x iterations' output.
+    # The iterates are kept in memory, in shared memory for map_slices2D()
+    # workers, or in a raw complex64 file that is memory-mapped (np.memmap).
+    # A continued run appends to the file instead of reloading and copying
+    # the previous iterates.
+    #
+    # frame_shape: shape of one iterate, e.g. [extra_dim2, extra_dim1, mtx, mtx]
+    # nr_previous: int, number of iterations done by a previous run
+    # nr_new: int, maximum number of iterations of this run
+    # interval: int, keep iterations interval, 2*interval, ...
+    # previous: kept iterates of the previous run (in memory only)
+    # filename: raw file of the memory-mapped history (optional), the kept
+    #           iterates of the previous run are already in it
+    # shared: bool, allocate the in-memory history in shared memory
+
+    def __init__(self, frame_shape, nr_previous, nr_new, interval=1, previous=None, filename=None, shared=False):
+        import os
+
+        self.frame_shape = tuple(frame_shape)
+        self.nr_previous = nr_previous
+        self.interval = interval
+        self.filename = filename
+        self._frame_bytes = int(np.prod(frame_shape)) * np.dtype(np.complex64).itemsize
+
+        # iterates kept by the previous run
+        self.nr_kept_previous = 0
+        if nr_previous and (filename is not None) and os.path.exists(filename):
+            self.nr_kept_previous = os.path.getsize(filename) // self._frame_bytes
+        elif nr_previous and (filename is None) and (previous is not None):
+            self.nr_kept_previous = previous.shape[0]
+
+        nr_kept = self.kept(nr_previous + nr_new)
+        if filename is not None:
+            with open(filename, 'r+b' if self.nr_kept_previous else 'wb') as f:
+                f.truncate(nr_kept * self._frame_bytes)
+            self.iterates = self._map(nr_kept, 'r+')
+        elif shared:
+            self.iterates = shared_zeros((nr_kept,) + self.frame_shape, np.complex64)
+        else:
+            self.iterates = np.zeros((nr_kept,) + self.frame_shape, dtype=np.complex64)
+        if (filename is None) and self.nr_kept_previous:
+            self.iterates[:self.nr_kept_previous] = previous
+
+    def _map(self, nr_kept, mode):
+        if nr_kept == 0:
+            # an empty file can't be mapped
+            return np.zeros((0,) + self.frame_shape, dtype=np.complex64)
+        return np.memmap(self.filename, dtype=np.complex64, mode=mode, shape=(nr_kept,) + self.frame_shape)
+
+    def kept(self, iteration):
+        # number of iterates kept through iteration (counted from the
+        # start of the first run), the last one is at index kept() - 1 if
+        # iteration is a multiple of the interval
+        return self.nr_kept_previous + iteration // self.interval - self.nr_previous // self.interval
 
-    return degridded_kspace
+    def keep(self, iterates, iteration, x):
+        # store x as iteration into iterates (self.iterates or a view of it
+        # for a subset of the frame)
+        if iteration % self.interval == 0:
+            iterates[self.kept(iteration) - 1] = x
 
+    def finish(self, iteration):
+        # the kept iterates through the last iteration done, the file is
+        # truncated to them
+        nr_kept = self.kept(iteration)
+        if self.filename is None:
+            return self.iterates[:nr_kept]
+        if isinstance(self.iterates, np.memmap):
+            self.iterates.flush()
+        self.iterates = None
+        with open(self.filename, 'r+b') as f:
+            f.truncate(nr_kept * self._frame_bytes)
+        return self._map(nr_kept, 'r')
@@ -40,6 +40,15 @@ using namespace std;
 
 #include "bni/gridding/gridding.cpp"
 
+/* The kernel window of gridding.cpp holds kernels of at most
+ * MAX_KERNEL_WIDTH, a wider kernel is an error rather than gridding with
+ * another kernel than the table was made for. */
+#define CHECK_KERNEL_WIDTH(_kernel_width) \
+    if (!(((_kernel_width) > 0) && ((_kernel_width) <= MAX_KERNEL_WIDTH))) \
+    { \
+        PYFI_ERROR("kernel_width has to be greater than 0 and at most MAX_KERNEL_WIDTH (8)"); \
+    }
+
 PYFI_FUNC(grid)
 {
     PYFI_START(); /* This must be the first line */
@@ -52,10 +61,14 @@ PYFI_FUNC(grid)
     PYFI_POSARG(Array<int64_t>, outdim);
     PYFI_POSARG(double, dx);
     PYFI_POSARG(double, dy);
+    PYFI_KWARG(long, nthreads, 1);
+    PYFI_KWARG(long, separable, 0);
+    PYFI_KWARG(double, kernel_width, KERNEL_WIDTH); /* of the kernel table */
+    CHECK_KERNEL_WIDTH(*kernel_width);
 
     PYFI_SETOUTPUT_ALLOC_DIMS(Array<complex<float> >, outdata, outdim->size(), outdim->as_ULONG());
 
-    _grid2(*data, *crds, *weights, *outdata, *kernel, (float)*dx, (float)*dy);
+    _grid2(*data, *crds, *weights, *outdata, *kernel, (float)*dx, (float)*dy, (int)*nthreads, (int)*separable, (float)*kernel_width);
 
     PYFI_END(); /* This must be the last line */
 } /* grid */
@@ -69,10 +82,12 @@ PYFI_FUNC(rolloff)
     PYFI_POSARG(Array<float>, kernel);
     PYFI_POSARG(Array<int64_t>, outdim);
     PYFI_POSARG(long, isofov);
+    PYFI_KWARG(double, kernel_width, KERNEL_WIDTH); /* of the kernel table */
+    CHECK_KERNEL_WIDTH(*kernel_width);
 
     PYFI_SETOUTPUT_ALLOC_DIMS(Array<complex<float> >, outdata, outdim->size(), outdim->as_ULONG());
 
-    _rolloff2(*data, *outdata, *kernel, (int32_t) *isofov);
+    _rolloff2(*data, *outdata, *kernel, (int32_t) *isofov, (float)*kernel_width);
 
     PYFI_END(); /* This must be the last line */
 } /* rolloff */
@@ -85,17 +100,118 @@ PYFI_FUNC(degrid)
     PYFI_POSARG(Array<float>, crds);
     PYFI_POSARG(Array<complex<float> >, data);
     PYFI_POSARG(Array<float>, kernel);
+    PYFI_KWARG(long, nthreads, 1);
+    PYFI_KWARG(long, separable, 0);
+    PYFI_KWARG(double, kernel_width, KERNEL_WIDTH); /* of the kernel table */
+    PYFI_KWARG(double, dx, 0.); /* pixel shift of the gridding */
+    PYFI_KWARG(double, dy, 0.);
+    CHECK_KERNEL_WIDTH(*kernel_width);
 
     std::vector<uint64_t> outdim = crds->dimensions_vector();
     outdim.erase(outdim.begin());
 
     PYFI_SETOUTPUT_ALLOC(Array<complex<float> >, outdata, outdim);
 
-    _degrid2(*data, *crds, *outdata, *kernel);
+    _degrid2(*data, *crds, *outdata, *kernel, (float)*dx, (float)*dy, (int)*nthreads, (int)*separable, (float)*kernel_width);
 
     PYFI_END(); /* This must be the last line */
 } /* grid */
 
+PYFI_FUNC(grid_batch)
+{
+    PYFI_START(); /* This must be the first line */
+
+    /* input */
+    PYFI_POSARG(Array<float>, crds);
+    PYFI_POSARG(Array<complex<float> >, data);
+    PYFI_POSARG(Array<float>, weights);
+    PYFI_POSARG(Array<float>, kernel);
+    PYFI_POSARG(Array<complex<float> >, outdata); /* written in place */
+    PYFI_POSARG(double, dx);
+    PYFI_POSARG(double, dy);
+    PYFI_POSARG(Array<int64_t>, order); /* from grid_sort, or [-1] */
+    PYFI_KWARG(long, nthreads, 1);
+    PYFI_KWARG(long, separable, 0);
+    PYFI_KWARG(double, kernel_width, KERNEL_WIDTH); /* of the kernel table */
+    CHECK_KERNEL_WIDTH(*kernel_width);
+
+    /* a negative order means the samples are visited in acquisition order */
+    Array<int64_t> *sample_order = ((*order)(0) < 0) ? NULL : order;
+
+    _grid2_batch(*data, *crds, *weights, *outdata, *kernel, (float)*dx, (float)*dy, (int)*nthreads, (int)*separable, sample_order, (float)*kernel_width);
+
+    PYFI_END(); /* This must be the last line */
+} /* grid_batch */
+
+PYFI_FUNC(degrid_batch)
+{
+    PYFI_START(); /* This must be the first line */
+
+    /* input */
+    PYFI_POSARG(Array<float>, crds);
+    PYFI_POSARG(Array<complex<float> >, data);
+    PYFI_POSARG(Array<float>, kernel);
+    PYFI_POSARG(Array<complex<float> >, outdata); /* written in place */
+    PYFI_POSARG(Array<int64_t>, order); /* from grid_sort, or [-1] */
+    PYFI_KWARG(long, nthreads, 1);
+    PYFI_KWARG(long, separable, 0);
+    PYFI_KWARG(double, kernel_width, KERNEL_WIDTH); /* of the kernel table */
+    PYFI_KWARG(double, dx, 0.); /* pixel shift of the gridding */
+    PYFI_KWARG(double, dy, 0.);
+    CHECK_KERNEL_WIDTH(*kernel_width);
+
+    /* a negative order means the samples are visited in acquisition order */
+    Array<int64_t> *sample_order = ((*order)(0) < 0) ? NULL : order;
+
+    _degrid2_batch(*data, *crds, *outdata, *kernel, (float)*dx, (float)*dy, (int)*nthreads, (int)*separable, sample_order, (float)*kernel_width);
+
+    PYFI_END(); /* This must be the last line */
+} /* degrid_batch */
+
+PYFI_FUNC(grid_plan)
+{
+    PYFI_START(); /* This must be the first line */
+
+    /* input */
+    PYFI_POSARG(Array<float>, crds);
+    PYFI_POSARG(Array<float>, kernel);
+    PYFI_POSARG(Array<int64_t>, outdim);
+    PYFI_KWARG(long, separable, 0);
+    PYFI_KWARG(double, kernel_width, KERNEL_WIDTH); /* of the kernel table */
+    CHECK_KERNEL_WIDTH(*kernel_width);
+
+    /* one vector of neighbors per coordinate */
+    std::vector<uint64_t> plandim = crds->dimensions_vector();
+    plandim[0] = window_width(*kernel_width) * window_width(*kernel_width);
+
+    PYFI_SETOUTPUT_ALLOC(Array<int64_t>, indices, plandim);
+    PYFI_SETOUTPUT_ALLOC(Array<float>, values, plandim);
+
+    _grid2_plan(*crds, (int) (*outdim)(0), *indices, *values, *kernel, (int)*separable, (float)*kernel_width);
+
+    PYFI_END(); /* This must be the last line */
+} /* grid_plan */
+
+PYFI_FUNC(grid_sort)
+{
+    PYFI_START(); /* This must be the first line */
+
+    /* input */
+    PYFI_POSARG(Array<float>, crds);
+    PYFI_POSARG(Array<int64_t>, outdim);
+    PYFI_KWARG(long, tile_width, 8);
+
+    /* one index per coordinate */
+    std::vector<uint64_t> orderdim = crds->dimensions_vector();
+    orderdim.erase(orderdim.begin());
+
+    PYFI_SETOUTPUT_ALLOC(Array<int64_t>, order, orderdim);
+
+    _grid2_sort(*crds, (int) (*outdim)(0), *order, (int)*tile_width);
+
+    PYFI_END(); /* This must be the last line */
+} /* grid_sort */
+
 PYFI_FUNC(kaiserbessel_kernel)
 {
     PYFI_START(); /* This must be the first line */
@@ -103,9 +219,11 @@ PYFI_FUNC(kaiserbessel_kernel)
     /* input */
     PYFI_POSARG(Array<int64_t>, outdim);
     PYFI_POSARG(double, oversampling_ratio);
+    PYFI_KWARG(double, kernel_width, KERNEL_WIDTH); /* in k-space pixels */
+    CHECK_KERNEL_WIDTH(*kernel_width);
     
     PYFI_SETOUTPUT_ALLOC_DIMS(Array<float>, outdata, outdim->size(), outdim->as_ULONG());
-    _kaiserbessel(*outdata, *oversampling_ratio);
+    _kaiserbessel(*outdata, *oversampling_ratio, *kernel_width);
     
     PYFI_END(); /* This must be the last line */
 }
@@ -113,6 +231,10 @@ PYFI_FUNC(kaiserbessel_kernel)
 PYFI_LIST_START_
     PYFI_DESC(grid, "Convolve points to a Cartesian grid.")
     PYFI_DESC(degrid, "Convolve points from a Cartesian grid to non-Cartesian coordinates.")
+    PYFI_DESC(grid_batch, "Convolve a stack of datasets to Cartesian grids, writing into the given output array.")
+    PYFI_DESC(degrid_batch, "Convolve a stack of Cartesian grids to non-Cartesian coordinates, writing into the given output array.")
+    PYFI_DESC(grid_plan, "Tabulate the sparse interpolation matrix for a fixed set of coordinates.")
+    PYFI_DESC(grid_sort, "Order the samples by k-space tile for cache-friendly gridding and degridding.")
     PYFI_DESC(rolloff, "Rolloff Correction for the standard gridding calculation")
     PYFI_DESC(kaiserbessel_kernel, "Generate a Kaiser-Bessel kernel function")
 PYFI_LIST_END_
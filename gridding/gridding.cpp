@@ -34,6 +34,10 @@
 #ifndef GRIDDING_CPP_GUARD
 #define GRIDDING_CPP_GUARD
 
+#include <algorithm>
+#include <thread>
+#include <vector>
+
 #include "bni/gridding/kaiserbessel.cpp"
 
 #define _sqr(__se) ((__se)*(__se))
@@ -51,6 +55,413 @@ void set_minmax(T x, int *min, int *max, int maximum, T radius)
         *max = maximum-1;
 }
 
+/* KERNEL WINDOW
+ *  Holds the kernel weights for the neighborhood of cartesian points that a
+ *  single sample is convolved onto (or from).  Weights are stored row-major,
+ *  i.e. ker[(j-jmin)*(imax-imin+1) + (i-imin)].  A kernel of width w (in
+ *  grid points) touches at most window_width(w) points per dimension.
+ */
+#define MAX_WINDOW_WIDTH ((int)(MAX_KERNEL_WIDTH) + 1)
+
+template<class T>
+inline int window_width(T kernel_width)
+{
+    return (int) kernel_width + 1;
+}
+
+template<class T>
+struct KernelWindow
+{
+    int imin, imax, jmin, jmax;
+    T ker[MAX_WINDOW_WIDTH * MAX_WINDOW_WIDTH];
+};
+
+/* GRID KERNEL
+ *  Evaluates the Kaiser-Bessel kernel table for a given grid width.  The
+ *  constants are computed once so the per-sample work is limited to the
+ *  neighbor loop.
+ *  separable: if non-zero the kernel is the product of a 1D kernel in x and
+ *             one in y instead of the radial kernel.  The same table (which
+ *             is indexed by the squared, normalized distance) is used for
+ *             both.
+ *  kernel_width: in grid points (at most MAX_KERNEL_WIDTH, the size of the
+ *                KernelWindow), the width the table was made for.  Wider
+ *                kernels are rejected by the PyFI entry points.
+ */
+template<class T>
+class GridKernel
+{
+  public:
+    GridKernel(Array<T> &kernel_table, int width, int separable=0, T kernel_width=KERNEL_WIDTH)
+        : table(kernel_table), width(width), separable(separable)
+    {
+        width_div2 = width / 2;
+        width_inv = 1.0 / width;
+        assert(kernel_width <= MAX_KERNEL_WIDTH);
+        radius_fov = kernel_width / 2;
+        T radius = radius_fov / width;
+        radius_sqr = radius * radius;
+        dist_multiplier = (kernel_table.dimensions(0) - 1) / radius_sqr;
+    }
+
+    /* set the boundaries of the grid neighborhood for coordinate x, y 
+     * (these vary between -.5 -- +.5) */
+    inline void bounds(T x, T y, KernelWindow<T> &win)
+    {
+        set_minmax(x * width + width_div2, &win.imin, &win.imax, width, radius_fov);
+        set_minmax(y * width + width_div2, &win.jmin, &win.jmax, width, radius_fov);
+    }
+
+    /* 1D kernel weight for a squared distance */
+    inline T weight1(T dist_sqr)
+    {
+        return (dist_sqr < radius_sqr) ? get1(table, (int) rint(dist_sqr * dist_multiplier)) : (T) 0.;
+    }
+
+    /* kernel weights for all neighbors, points outside the radius are 0 */
+    inline void weights(T x, T y, KernelWindow<T> &win)
+    {
+        int i, j, k = 0;
+        T ix, jy;
+        bounds(x, y, win);
+
+        if (separable)
+        {
+            /* 2 x width table lookups, then a branch-free outer product */
+            T wx[MAX_WINDOW_WIDTH], wy[MAX_WINDOW_WIDTH];
+            int ni = win.imax - win.imin + 1;
+            int nj = win.jmax - win.jmin + 1;
+            for (i=0; i<ni; ++i)
+                wx[i] = weight1(_sqr((win.imin + i - width_div2) * width_inv - x));
+            for (j=0; j<nj; ++j)
+                wy[j] = weight1(_sqr((win.jmin + j - width_div2) * width_inv - y));
+            for (j=0; j<nj; ++j)
+                for (i=0; i<ni; ++i)
+                    win.ker[k++] = wy[j] * wx[i];
+            return;
+        }
+
+        for (j=win.jmin; j<=win.jmax; ++j)
+        {
+            jy = (j - width_div2) * width_inv;
+            for (i=win.imin; i<=win.imax; ++i)
+            {
+                ix = (i - width_div2) * width_inv;
+                T dist_sqr = dist2(ix - x, jy - y);
+                if (dist_sqr < radius_sqr)
+                    win.ker[k++] = get1(table, (int) rint(dist_sqr * dist_multiplier));
+                else
+                    win.ker[k++] = 0.;
+            }
+        }
+    }
+
+    Array<T> &table;
+    int width;
+    int separable;
+    int width_div2;
+    T width_inv;
+    T radius_fov;
+    T radius_sqr;
+    T dist_multiplier;
+};
+
+/* SAMPLE INDEX
+ *  Index of the p-th visited sample of coordinate set s.  A single order
+ *  may be shared by all coordinate sets.
+ */
+inline uint64_t sample_index(Array<int64_t> *order, uint64_t s, uint64_t p, uint64_t nr_samples)
+{
+    if (order == NULL)
+        return p;
+    if (order->size() == nr_samples)
+        return (uint64_t) (*order)(p);
+    return (uint64_t) (*order)(s*nr_samples + p);
+}
+
+/* MORTON KEY
+ *  Interleaves the bits of the tile indices so that tiles which are close
+ *  on the grid are close in the key.
+ */
+inline uint64_t morton_key(uint32_t ti, uint32_t tj)
+{
+    uint64_t key = 0;
+    for (int bit=0; bit<32; bit++)
+    {
+        key |= (uint64_t) ((ti >> bit) & 1) << (2*bit);
+        key |= (uint64_t) ((tj >> bit) & 1) << (2*bit + 1);
+    }
+    return key;
+}
+
+/* GRID SORT
+ *  Computes a traversal order of the samples that visits them tile by tile
+ *  (tiles of tile_width x tile_width grid points, in Morton order) so that
+ *  consecutive samples scatter to (or gather from) the same part of the
+ *  grid.  Within a tile the acquisition order is kept.  The order only
+ *  depends on the trajectory and the grid size, so it can be computed once
+ *  and passed to every _grid2_batch / _degrid2_batch call.
+ *  coords: 3D array [nr_sets, nr_samples, 2]
+ *  width: grid matrix size (m == n).
+ *  order: 2D array [nr_sets, nr_samples], sample indices in traversal order
+ *  tile_width: tile size in grid points
+ */
+template<class T>
+void _grid2_sort(Array<T> &coords, int width, Array<int64_t> &order, int tile_width=8)
+{
+    uint64_t p, s;
+    uint64_t nr_samples = coords.dimensions(1);
+    uint64_t nr_sets = coords.size() / (2 * nr_samples);
+    int width_div2 = width / 2;
+    std::vector<uint64_t> keys(nr_samples);
+    std::vector<int64_t> index(nr_samples);
+
+    for (s=0; s<nr_sets; s++)
+    {
+        for (p=0; p<nr_samples; p++)
+        {
+            /* tile of the grid point closest to the sample */
+            T x = coords(2*(s*nr_samples + p)) * width + width_div2;
+            T y = coords(2*(s*nr_samples + p) + 1) * width + width_div2;
+            int i = (int) rint(x);
+            int j = (int) rint(y);
+            if (i < 0) i = 0;
+            if (j < 0) j = 0;
+            if (i >= width) i = width-1;
+            if (j >= width) j = width-1;
+            keys[p] = morton_key(i / tile_width, j / tile_width);
+            index[p] = (int64_t) p;
+        }
+
+        std::stable_sort(index.begin(), index.end(),
+                         [&keys](int64_t a, int64_t b) { return keys[a] < keys[b]; });
+
+        for (p=0; p<nr_samples; p++)
+            order(s*nr_samples + p) = index[p];
+    }
+}
+
+/* GRID ROWS
+ *  Grids a stack of datasets, only accumulating onto the grid rows
+ *  jlo <= j < jhi.  Each thread of the parallel gridder owns a slab of rows
+ *  so the scatter is free of write conflicts, and only visits the samples
+ *  that _grid2_slab_samples assigned to its slab (samples whose kernel
+ *  overlaps a slab boundary are listed for both neighboring slabs).  The
+ *  points of a slab are summed in the same sample order as the serial loop.
+ *  data: [nr_batch, extra_dim1, nr_samples] (numpy order)
+ *  coords: [nr_sets, nr_samples, 2], nr_sets is 1 or extra_dim1
+ *  weights: [nr_sets, nr_samples]
+ *  out: [nr_batch, extra_dim1, m, n] with m == n
+ *  samples: [nr_sets] sample indices of this slab (NULL: all samples)
+ */
+template<class T>
+void _grid2_rows(Array<complex<T> > &data, Array<T> &coords, Array<T> &weight, Array<complex<T> > &out, Array<T> &kernel_table, T dx, T dy, uint64_t nr_samples, uint64_t extra_dim1, int jlo, int jhi, int separable, T kernel_width, const std::vector<std::vector<uint64_t> > *samples)
+{
+    int i, j, k;
+    int width = out.dimensions(0); // assume isotropic dims
+    uint64_t grid_size = (uint64_t) width * width;
+    uint64_t nr_batch = data.size() / (nr_samples * extra_dim1);
+    uint64_t nr_sets = coords.size() / (2 * nr_samples);
+    uint64_t p, q, s, e, b, slice;
+    T x, y;
+    bool shifted = (dx != 0) || (dy != 0);
+    GridKernel<T> kern(kernel_table, width, separable, kernel_width);
+    KernelWindow<T> win;
+
+    for (s=0; s<nr_sets; s++)
+    {
+        /* a single coordinate set is shared by all of extra_dim1 */
+        uint64_t e_first = (nr_sets == 1) ? 0 : s;
+        uint64_t e_last = (nr_sets == 1) ? extra_dim1 : s+1;
+        uint64_t nr_visited = (samples == NULL) ? nr_samples : (*samples)[s].size();
+
+        for (q=0; q<nr_visited; q++)
+        {
+            p = (samples == NULL) ? q : (*samples)[s][q];
+
+            /* get the coordinates of the datapoint to grid
+             *  these vary between -.5 -- +.5               */
+            x = coords(2*(s*nr_samples + p));
+            y = coords(2*(s*nr_samples + p) + 1);
+
+            /* skip samples that don't touch this slab (or the grid) */
+            kern.bounds(x, y, win);
+            if ((win.jmax < jlo) || (win.jmin >= jhi))
+                continue;
+
+            /* density weight and shift phase */
+            complex<T> w = weight(s*nr_samples + p);
+            if (shifted)
+                w *= exp( complex<T>(0, -2.*M_PI*(x*dx+y*dy)) );
+
+            kern.weights(x, y, win);
+            int row_len = win.imax - win.imin + 1;
+            int jstart = (win.jmin > jlo) ? win.jmin : jlo;
+            int jstop = (win.jmax < jhi-1) ? win.jmax : jhi-1;
+
+            for (e=e_first; e<e_last; e++)
+            {
+                for (b=0; b<nr_batch; b++)
+                {
+                    slice = b*extra_dim1 + e;
+                    complex<T> d = data(slice*nr_samples + p) * w;
+                    for (j=jstart; j<=jstop; ++j)
+                    {
+                        k = (j - win.jmin) * row_len;
+                        for (i=win.imin; i<=win.imax; ++i)
+                            out(slice*grid_size + (uint64_t) j*width + i) += win.ker[k++] * d;
+                    }
+                }
+            }
+        }
+    }
+}
+
+/* SLAB SAMPLES
+ *  Splits the samples among the row slabs of the parallel gridder in one
+ *  pass over the coordinates, so that each thread only visits its own
+ *  samples.  A sample is listed for every slab its kernel overlaps, in
+ *  acquisition (or traversal) order; samples off the grid are left out.
+ *  coords: [nr_sets, nr_samples, 2]
+ *  slab_samples: [nr_slabs][nr_sets] sample indices, slab t holds the rows
+ *                width*t/nr_slabs <= j < width*(t+1)/nr_slabs
+ */
+template<class T>
+void _grid2_slab_samples(Array<T> &coords, Array<T> &kernel_table, int width, uint64_t nr_samples, int nr_slabs, int separable, T kernel_width, std::vector<std::vector<std::vector<uint64_t> > > &slab_samples)
+{
+    int j, t;
+    uint64_t p, s;
+    uint64_t nr_sets = coords.size() / (2 * nr_samples);
+    GridKernel<T> kern(kernel_table, width, separable, kernel_width);
+    KernelWindow<T> win;
+
+    std::vector<int> slab_of_row(width);
+    for (t=0; t<nr_slabs; t++)
+        for (j=(int) ((int64_t) width * t / nr_slabs); j<(int) ((int64_t) width * (t+1) / nr_slabs); j++)
+            slab_of_row[j] = t;
+
+    slab_samples.assign(nr_slabs, std::vector<std::vector<uint64_t> >(nr_sets));
+    for (s=0; s<nr_sets; s++)
+    {
+        for (p=0; p<nr_samples; p++)
+        {
+            kern.bounds(coords(2*(s*nr_samples + p)), coords(2*(s*nr_samples + p) + 1), win);
+            if (win.jmin > win.jmax)
+                continue;
+            for (t=slab_of_row[win.jmin]; t<=slab_of_row[win.jmax]; t++)
+                slab_samples[t][s].push_back(p);
+        }
+    }
+}
+
+/* SORT COORDINATES
+ *  Gathers the coordinates (and optionally the weights) into traversal
+ *  order.
+ *  coords: [nr_sets, nr_samples, 2]
+ *  weights: [nr_sets, nr_samples] or NULL
+ */
+template<class T>
+void _sort_coords(Array<T> &coords, Array<T> *weight, Array<T> &coords_sorted, Array<T> *weight_sorted, uint64_t nr_samples, Array<int64_t> *order)
+{
+    uint64_t nr_sets = coords.size() / (2 * nr_samples);
+    uint64_t p, q, s;
+
+    for (s=0; s<nr_sets; s++)
+    {
+        for (p=0; p<nr_samples; p++)
+        {
+            q = sample_index(order, s, p, nr_samples);
+            coords_sorted(2*(s*nr_samples + p)) = coords(2*(s*nr_samples + q));
+            coords_sorted(2*(s*nr_samples + p) + 1) = coords(2*(s*nr_samples + q) + 1);
+            if (weight != NULL)
+                (*weight_sorted)(s*nr_samples + p) = (*weight)(s*nr_samples + q);
+        }
+    }
+}
+
+/* PERMUTE SAMPLES
+ *  Gathers a stack of sample data into traversal order (unsort == 0) or
+ *  scatters it back into acquisition order (unsort != 0).
+ *  in, out: [nr_batch, extra_dim1, nr_samples]
+ */
+template<class T>
+void _permute_samples(Array<complex<T> > &in, Array<complex<T> > &out, uint64_t nr_samples, uint64_t extra_dim1, uint64_t nr_sets, Array<int64_t> *order, int unsort)
+{
+    uint64_t nr_batch = in.size() / (nr_samples * extra_dim1);
+    uint64_t p, q, s, e, b, slice;
+
+    for (s=0; s<nr_sets; s++)
+    {
+        /* a single coordinate set is shared by all of extra_dim1 */
+        uint64_t e_first = (nr_sets == 1) ? 0 : s;
+        uint64_t e_last = (nr_sets == 1) ? extra_dim1 : s+1;
+
+        for (e=e_first; e<e_last; e++)
+        {
+            for (b=0; b<nr_batch; b++)
+            {
+                slice = b*extra_dim1 + e;
+                for (p=0; p<nr_samples; p++)
+                {
+                    q = sample_index(order, s, p, nr_samples);
+                    if (unsort)
+                        out(slice*nr_samples + q) = in(slice*nr_samples + p);
+                    else
+                        out(slice*nr_samples + p) = in(slice*nr_samples + q);
+                }
+            }
+        }
+    }
+}
+
+/* GRID THREADED
+ *  Zeros the output and splits the grid rows into one slab per thread,
+ *  each with the samples that touch it (_grid2_slab_samples).
+ *  If a sample order is given, sorted copies of the samples are gridded:
+ *  an indirect traversal of the unsorted arrays would turn every sample
+ *  read into a cache miss.
+ */
+template<class T>
+void _grid2_threaded(Array<complex<T> > &data, Array<T> &coords, Array<T> &weight, Array<complex<T> > &out, Array<T> &kernel_table, T dx, T dy, uint64_t nr_samples, uint64_t extra_dim1, int nthreads, int separable, Array<int64_t> *order, T kernel_width)
+{
+    int t;
+    int width = out.dimensions(0);
+
+    if (order != NULL)
+    {
+        Array<complex<T> > data_sorted(data.dimensions_vector());
+        Array<T> coords_sorted(coords.dimensions_vector());
+        Array<T> weight_sorted(weight.dimensions_vector());
+        _sort_coords(coords, &weight, coords_sorted, &weight_sorted, nr_samples, order);
+        _permute_samples(data, data_sorted, nr_samples, extra_dim1, coords.size() / (2 * nr_samples), order, 0);
+        _grid2_threaded(data_sorted, coords_sorted, weight_sorted, out, kernel_table, dx, dy, nr_samples, extra_dim1, nthreads, separable, (Array<int64_t> *) NULL, kernel_width);
+        return;
+    }
+
+    out = complex<T>(0.0);
+
+    if (nthreads > width) nthreads = width;
+    if (nthreads <= 1)
+    {
+        _grid2_rows(data, coords, weight, out, kernel_table, dx, dy, nr_samples, extra_dim1, 0, width, separable, kernel_width, (const std::vector<std::vector<uint64_t> > *) NULL);
+        return;
+    }
+
+    std::vector<std::vector<std::vector<uint64_t> > > slab_samples;
+    _grid2_slab_samples(coords, kernel_table, width, nr_samples, nthreads, separable, kernel_width, slab_samples);
+
+    std::vector<std::thread> threads;
+    for (t=0; t<nthreads; t++)
+    {
+        int jlo = (int) ((int64_t) width * t / nthreads);
+        int jhi = (int) ((int64_t) width * (t+1) / nthreads);
+        const std::vector<std::vector<uint64_t> > *samples = &slab_samples[t];
+        threads.push_back(std::thread(_grid2_rows<T>, std::ref(data), std::ref(coords), std::ref(weight), std::ref(out), std::ref(kernel_table), dx, dy, nr_samples, extra_dim1, jlo, jhi, separable, kernel_width, samples));
+    }
+    for (t=0; t<nthreads; t++)
+        threads[t].join();
+}
+
 /* GRID
  *  data: nD array with 1-vec dimensions equal to coords array.
  *  coords: nD array with 2-vec.
@@ -59,115 +470,213 @@ void set_minmax(T x, int *min, int *max, int maximum, T radius)
  *  kernel_table: 1D array with Kaiser-Bessel kernel table
  *  out: 2D array with equal dimensions (m == n).
  *  dx, dy: scaler pixel shift in
+ *  nthreads: number of threads (row slabs) to grid with
+ *  separable: use the separable instead of the radial kernel
+ *  kernel_width: kernel width in grid points the kernel table was made for
  */
 template<class T>
-void _grid2(Array<complex<T> > &data, Array<T> &coords, Array<T> &weight, Array<complex<T> > &out, Array<T> &kernel_table, T dx, T dy)
+void _grid2(Array<complex<T> > &data, Array<T> &coords, Array<T> &weight, Array<complex<T> > &out, Array<T> &kernel_table, T dx, T dy, int nthreads=1, int separable=0, T kernel_width=KERNEL_WIDTH)
 {
-    int imin, imax, jmin, jmax, i, j;
-    int width = out.dimensions(0); // assume isotropic dims
-    int width_div2 = width / 2;
-    uint64_t p;
-    T x, y, ix, jy;
-    T kernelRadius = DEFAULT_RADIUS_FOV_PRODUCT / width;
-    T kernelRadius_sqr = kernelRadius * kernelRadius;
-    T width_inv = 1.0 / width;
-
-    T dist_multiplier = (kernel_table.dimensions(0) - 1)/kernelRadius_sqr;
+    _grid2_threaded(data, coords, weight, out, kernel_table, dx, dy, data.size(), 1, nthreads, separable, (Array<int64_t> *) NULL, kernel_width);
+}
 
-    out = complex<T>(0.0);
+/* DEGRID RANGE
+ *  Degrids the samples plo <= p < phi of a stack of datasets.  Each output
+ *  sample is an independent gather, so the parallel degridder simply splits
+ *  the sample range between threads.
+ *  data: [nr_batch, extra_dim1, m, n] with m == n (numpy order)
+ *  coords: [nr_sets, nr_samples, 2], nr_sets is 1 or extra_dim1
+ *  out: [nr_batch, extra_dim1, nr_samples]
+ */
+template<class T>
+void _degrid2_range(Array<complex<T> > &data, Array<T> &coords, Array<complex<T> > &out, Array<T> &kernel_table, T dx, T dy, uint64_t nr_samples, uint64_t extra_dim1, uint64_t plo, uint64_t phi, int separable, T kernel_width)
+{
+    int i, j, k;
+    int width = data.dimensions(0); // assume isotropic dims
+    uint64_t grid_size = (uint64_t) width * width;
+    uint64_t nr_batch = out.size() / (nr_samples * extra_dim1);
+    uint64_t nr_sets = coords.size() / (2 * nr_samples);
+    uint64_t p, s, e, b, slice;
+    bool shifted = (dx != 0) || (dy != 0);
+    GridKernel<T> kern(kernel_table, width, separable, kernel_width);
+    KernelWindow<T> win;
 
-    for (p=0; p<data.size(); p++)
+    for (s=0; s<nr_sets; s++)
     {
-        complex<T> d = data(p) * weight(p);
+        /* a single coordinate set is shared by all of extra_dim1 */
+        uint64_t e_first = (nr_sets == 1) ? 0 : s;
+        uint64_t e_last = (nr_sets == 1) ? extra_dim1 : s+1;
 
-        /* get the coordinates of the datapoint to grid
-         *  these vary between -.5 -- +.5               */
-        x = coords.get1v(p, 0);  
-        y = coords.get1v(p, 1);  
-
-        /* add shift phase */
-        d *= exp( complex<T>(0, -2.*M_PI*(x*dx+y*dy)) );
+        /* loop over output data points */
+        for (p=plo; p<phi; p++)
+        {
+            /* get the coordinates of the datapoint to degrid
+             *  these vary between -.5 -- +.5               */
+            T x = coords(2*(s*nr_samples + p));
+            T y = coords(2*(s*nr_samples + p) + 1);
+            kern.weights(x, y, win);
 
-        /* set the boundaries of final dataset for gridding this point */
-        ix = x * width + width_div2;
-        set_minmax(ix, &imin, &imax, width, (T) DEFAULT_RADIUS_FOV_PRODUCT);
-        jy = y * width + width_div2;
-        set_minmax(jy, &jmin, &jmax, width, (T) DEFAULT_RADIUS_FOV_PRODUCT);
+            /* undo the pixel shift of the gridding (adjoint phase) */
+            complex<T> shift = 1.;
+            if (shifted)
+                shift = exp( complex<T>(0, 2.*M_PI*(x*dx+y*dy)) );
 
-        /* grid this point onto the neighboring cartesian points */
-        for (j=jmin; j<=jmax; ++j)
-        {
-            jy = (j - width_div2) * width_inv;
-            for (i=imin; i<=imax; ++i)
+            for (e=e_first; e<e_last; e++)
             {
-                ix = (i - width_div2) * width_inv;
-                T dist_sqr = dist2(ix - x, jy - y);
-                if (dist_sqr < kernelRadius_sqr)
+                for (b=0; b<nr_batch; b++)
                 {
-                    T ker = get1(kernel_table, (int) rint(dist_sqr * dist_multiplier));
-                    get2(out, i, j) += ker * d;
+                    /* Convolve the kernel at the coordinate location to get a
+                     * non-cartesian sample */
+                    slice = b*extra_dim1 + e;
+                    complex<T> d = 0.;
+                    k = 0;
+                    for (j=win.jmin; j<=win.jmax; ++j)
+                        for (i=win.imin; i<=win.imax; ++i)
+                            d += data(slice*grid_size + (uint64_t) j*width + i) * win.ker[k++]; // convolution sum
+                    out(slice*nr_samples + p) = d * shift; // store the sum for this coordinate point
                 }
             }
         }
     }
 }
 
+/* DEGRID THREADED
+ *  Splits the samples into one contiguous range per thread.  If a sample
+ *  order is given, the samples are degridded in sorted order and then
+ *  scattered back into acquisition order.
+ */
+template<class T>
+void _degrid2_threaded(Array<complex<T> > &data, Array<T> &coords, Array<complex<T> > &out, Array<T> &kernel_table, T dx, T dy, uint64_t nr_samples, uint64_t extra_dim1, int nthreads, int separable, Array<int64_t> *order, T kernel_width)
+{
+    int t;
+
+    if (order != NULL)
+    {
+        Array<T> coords_sorted(coords.dimensions_vector());
+        Array<complex<T> > out_sorted(out.dimensions_vector());
+        _sort_coords(coords, (Array<T> *) NULL, coords_sorted, (Array<T> *) NULL, nr_samples, order);
+        _degrid2_threaded(data, coords_sorted, out_sorted, kernel_table, dx, dy, nr_samples, extra_dim1, nthreads, separable, (Array<int64_t> *) NULL, kernel_width);
+        _permute_samples(out_sorted, out, nr_samples, extra_dim1, coords.size() / (2 * nr_samples), order, 1);
+        return;
+    }
+
+    if ((uint64_t) nthreads > nr_samples) nthreads = (int) nr_samples;
+    if (nthreads <= 1)
+    {
+        _degrid2_range(data, coords, out, kernel_table, dx, dy, nr_samples, extra_dim1, 0, nr_samples, separable, kernel_width);
+        return;
+    }
+
+    std::vector<std::thread> threads;
+    for (t=0; t<nthreads; t++)
+    {
+        uint64_t plo = nr_samples * t / nthreads;
+        uint64_t phi = nr_samples * (t+1) / nthreads;
+        threads.push_back(std::thread(_degrid2_range<T>, std::ref(data), std::ref(coords), std::ref(out), std::ref(kernel_table), dx, dy, nr_samples, extra_dim1, plo, phi, separable, kernel_width));
+    }
+    for (t=0; t<nthreads; t++)
+        threads[t].join();
+}
+
 /* DEGRID
  *  data: 2D array with equal dimensions (m == n).
  *  coords: nD array with 2-vec.
  *  out: nD array with 1-vec dimensions equal to coords array.
  *  kernel_table: 1D array with Kaiser-Bessel kernel table
+ *  dx, dy: scaler pixel shift of the gridding, undone on the samples
+ *  nthreads: number of threads (sample ranges) to degrid with
+ *  separable: use the separable instead of the radial kernel
+ *  kernel_width: kernel width in grid points the kernel table was made for
  */
 template<class T>
-void _degrid2(Array<complex<T> > &data, Array<T> &coords, Array<complex<T> > &out, Array<T> &kernel_table)
+void _degrid2(Array<complex<T> > &data, Array<T> &coords, Array<complex<T> > &out, Array<T> &kernel_table, T dx, T dy, int nthreads=1, int separable=0, T kernel_width=KERNEL_WIDTH)
 {
-    int imin, imax, jmin, jmax, i, j;
-    int width = data.dimensions(0); // assume isotropic dims
-    int width_div2 = width / 2;
-    uint64_t p;
-    T x, y, ix, jy;
-    T kernelRadius = DEFAULT_RADIUS_FOV_PRODUCT / width;
-    T kernelRadius_sqr = kernelRadius * kernelRadius;
-    T width_inv = 1.0 / width;
-
-    T dist_multiplier = (kernel_table.dimensions(0) - 1)/kernelRadius_sqr;
+    _degrid2_threaded(data, coords, out, kernel_table, dx, dy, out.size(), 1, nthreads, separable, (Array<int64_t> *) NULL, kernel_width);
+}
 
-    out = complex<T>(0.0);
+/* GRID BATCH
+ *  Grids a stack of datasets in one pass over the coordinates.  The kernel
+ *  weights of each sample are computed once and applied to every dataset
+ *  (coil, slice, dynamic) that shares the coordinate set.
+ *  data: 3D array [nr_batch, extra_dim1, nr_samples] (numpy order)
+ *  coords: 3D array [nr_sets, nr_samples, 2], nr_sets is 1 or extra_dim1
+ *  weights: 2D array [nr_sets, nr_samples]
+ *  out: 4D array [nr_batch, extra_dim1, m, n] with m == n, overwritten
+ *  kernel_table: 1D array with Kaiser-Bessel kernel table
+ *  dx, dy: scaler pixel shift in
+ *  nthreads: number of threads (row slabs) to grid with
+ *  separable: use the separable instead of the radial kernel
+ *  order: 2D array [1 or nr_sets, nr_samples], sample traversal order from
+ *         _grid2_sort (NULL for the acquisition order)
+ *  kernel_width: kernel width in grid points the kernel table was made for
+ */
+template<class T>
+void _grid2_batch(Array<complex<T> > &data, Array<T> &coords, Array<T> &weight, Array<complex<T> > &out, Array<T> &kernel_table, T dx, T dy, int nthreads=1, int separable=0, Array<int64_t> *order=NULL, T kernel_width=KERNEL_WIDTH)
+{
+    _grid2_threaded(data, coords, weight, out, kernel_table, dx, dy, data.dimensions(0), data.dimensions(1), nthreads, separable, order, kernel_width);
+}
 
-    /* loop over output data points */
-    for (p=0; p<out.size(); p++)
-    {
-        complex<T> d = 0.;
+/* DEGRID BATCH
+ *  Degrids a stack of datasets (e.g. all coil images) in one pass over the
+ *  coordinates, sharing the kernel weights of each sample among all
+ *  datasets.
+ *  data: 4D array [nr_batch, extra_dim1, m, n] with m == n (numpy order)
+ *  coords: 3D array [nr_sets, nr_samples, 2], nr_sets is 1 or extra_dim1
+ *  out: 3D array [nr_batch, extra_dim1, nr_samples], overwritten
+ *  kernel_table: 1D array with Kaiser-Bessel kernel table
+ *  dx, dy: scaler pixel shift of the gridding, undone on the samples
+ *  nthreads: number of threads (sample ranges) to degrid with
+ *  separable: use the separable instead of the radial kernel
+ *  order: 2D array [1 or nr_sets, nr_samples], sample traversal order from
+ *         _grid2_sort (NULL for the acquisition order)
+ *  kernel_width: kernel width in grid points the kernel table was made for
+ */
+template<class T>
+void _degrid2_batch(Array<complex<T> > &data, Array<T> &coords, Array<complex<T> > &out, Array<T> &kernel_table, T dx, T dy, int nthreads=1, int separable=0, Array<int64_t> *order=NULL, T kernel_width=KERNEL_WIDTH)
+{
+    _degrid2_threaded(data, coords, out, kernel_table, dx, dy, out.dimensions(0), out.dimensions(1), nthreads, separable, order, kernel_width);
+}
 
-        /* get the coordinates of the datapoint to grid
-         *  these vary between -.5 -- +.5               */
-        x = coords.get1v(p, 0);  
-        y = coords.get1v(p, 1);  
+/* GRID PLAN
+ *  Tabulates the sparse interpolation matrix between the samples and the
+ *  cartesian grid so that it can be reused for every coil, slice and
+ *  iteration that shares the same trajectory.
+ *  coords: nD array with 2-vec.
+ *  width: grid matrix size (m == n).
+ *  indices: nD array with window_width(kernel_width)^2-vec, flat grid index
+ *           (j*width+i) of each neighbor.
+ *  values: nD array with window_width(kernel_width)^2-vec, kernel weight of
+ *          each neighbor.  Unused entries are 0.
+ *  kernel_table: 1D array with Kaiser-Bessel kernel table
+ *  separable: use the separable instead of the radial kernel
+ *  kernel_width: kernel width in grid points the kernel table was made for
+ */
+template<class T>
+void _grid2_plan(Array<T> &coords, int width, Array<int64_t> &indices, Array<T> &values, Array<T> &kernel_table, int separable=0, T kernel_width=KERNEL_WIDTH)
+{
+    int i, j, k;
+    uint64_t p;
+    uint64_t nr_points = coords.size() / 2;
+    int nr_neighbors = window_width(kernel_width) * window_width(kernel_width);
+    GridKernel<T> kern(kernel_table, width, separable, kernel_width);
+    KernelWindow<T> win;
 
-        /* set the boundaries of final dataset for gridding this point */
-        ix = x * width + width_div2;
-        set_minmax(ix, &imin, &imax, width, (T) DEFAULT_RADIUS_FOV_PRODUCT);
-        jy = y * width + width_div2;
-        set_minmax(jy, &jmin, &jmax, width, (T) DEFAULT_RADIUS_FOV_PRODUCT);
+    indices = (int64_t) 0;
+    values = (T) 0.;
 
-        /* Convolve the kernel at the coordinate location to get a
-         * non-cartesian sample */
-        for (j=jmin; j<=jmax; ++j)
+    for (p=0; p<nr_points; p++)
+    {
+        kern.weights(coords.get1v(p, 0), coords.get1v(p, 1), win);
+        k = 0;
+        for (j=win.jmin; j<=win.jmax; ++j)
         {
-            jy = (j - width_div2) * width_inv;
-            for (i=imin; i<=imax; ++i)
+            for (i=win.imin; i<=win.imax; ++i)
             {
-                ix = (i - width_div2) * width_inv;
-                T dist_sqr = dist2(ix - x, jy - y);
-                if (dist_sqr < kernelRadius_sqr)
-                {
-                    T ker = get1(kernel_table, (int) rint(dist_sqr * dist_multiplier));
-                    d += get2(data, i, j) * ker; // convolution sum
-                }
+                indices(p*nr_neighbors + k) = (int64_t) j * width + i;
+                values(p*nr_neighbors + k) = win.ker[k];
+                k++;
             }
         }
-
-        get1(out, p) = d; // store the sum for this coordinate point
     }
 }
 
@@ -200,9 +709,10 @@ void crop_circle (Array<complex<T> > &in)
  * in: 2D array (m == n)
  *  kernel_table: 1D array with Kaiser-Bessel kernel table
  * out: 2D array
+ *  kernel_width: kernel width in grid points the kernel table was made for
  */
 template<class T>
-void _rolloff2(Array<complex<T> > &in, Array<complex<T> > &out, Array<T> &kernel_table, int32_t cropfilt)
+void _rolloff2(Array<complex<T> > &in, Array<complex<T> > &out, Array<T> &kernel_table, int32_t cropfilt, T kernel_width=KERNEL_WIDTH)
 {
     /* get grid dimensionality for scaling */
     int64_t gridMtx = in.dimensions(0);
@@ -220,7 +730,7 @@ void _rolloff2(Array<complex<T> > &in, Array<complex<T> > &out, Array<T> &kernel
     /* create another grid the same size as the oversampled grid 
      * to hold the deapodization filter. */
     Array<complex<T> > rolloff(in.dimensions_vector());
-    _grid2(delta_dat, delta_crd, delta_wgt, rolloff, kernel_table, (T) 0., (T) 0.);
+    _grid2(delta_dat, delta_crd, delta_wgt, rolloff, kernel_table, (T) 0., (T) 0., 1, 0, kernel_width);
     fft2(rolloff, rolloff, FFTW_FORWARD);
 
     /* take magnitude of each element and divide */
@@ -37,7 +37,8 @@
  *   Transactions on 24.6 (2005): 799-808.
  */
 
-#define KERNEL_WIDTH               5.0  // in k-space pixels
+#define KERNEL_WIDTH               5.0  // default, in k-space pixels
+#define MAX_KERNEL_WIDTH           8.0  // largest kernel width at runtime
 #define DEFAULT_RADIUS_FOV_PRODUCT ((KERNEL_WIDTH) / 2.0)
 
 #define sqr(__se)          ((__se)*(__se))
@@ -73,11 +74,13 @@ static double kernel(double radius, double beta)
     return (i0 (beta * sqrt (1 - sqr(radius))) / (i0(beta)));
 }
 
-void _kaiserbessel(Array<float> &kernel_table_out, double &oversampling_ratio)
+/* kernel_width: in k-space pixels, the same width has to be passed to the
+ *               gridding functions that use the table */
+void _kaiserbessel(Array<float> &kernel_table_out, double &oversampling_ratio, double kernel_width=KERNEL_WIDTH)
 {
     int i;
     int size = kernel_table_out.dimensions(0);
-    double beta = (M_PI*sqrt(sqr(KERNEL_WIDTH/oversampling_ratio*(oversampling_ratio-0.5))-0.8));
+    double beta = (M_PI*sqrt(sqr(kernel_width/oversampling_ratio*(oversampling_ratio-0.5))-0.8));
     assert(size > 0);
 
     for (i=1; i<size-1; i++)
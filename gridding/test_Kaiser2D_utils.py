@@ -0,0 +1,689 @@
+# Equivalence checks of the gridding and SENSE functions in Kaiser2D_utils:
+# the faster paths (threads, gridding plans, sorted samples, Toeplitz
+# operator, analytic rolloff, fused FOV shift, ...) against the direct
+# computation they replace.  They run on the current compute backend, i.e.
+# the C++ extension inside GPI, otherwise the numba or NumPy backend.
+#
+# usage (with the bni package on the python path): python -m pytest gridding
+
+import numpy as np
+import pytest
+
+kaiser2D = pytest.importorskip('bni.gridding.Kaiser2D_utils')
+
+OVERSAMPLING_RATIO = 1.375
+MTX_ORIGINAL = 48
+
+
+def oversampled_mtx(mtx_original=MTX_ORIGINAL, oversampling_ratio=OVERSAMPLING_RATIO):
+    mtx = int(mtx_original * oversampling_ratio)
+    return mtx + mtx % 2
+
+def spiral(nr_arms=12, nr_points=400, nr_sets=1):
+    # archimedean spiral, coords [nr_sets, nr_arms, nr_points, 2] in
+    # [-0.5, 0.5] (rotated per set) and density weights ~ |k|
+    t = np.linspace(0, 1, nr_points)
+    coords = np.zeros([nr_sets, nr_arms, nr_points, 2], dtype=np.float32)
+    for s in range(nr_sets):
+        for arm in range(nr_arms):
+            phi = 2 * np.pi * ((arm + 0.5 * s) / float(nr_arms) + MTX_ORIGINAL / (2.0 * nr_arms) * t)
+            coords[s, arm, :, 0] = 0.5 * t * np.cos(phi)
+            coords[s, arm, :, 1] = 0.5 * t * np.sin(phi)
+    weights = np.maximum(np.sqrt(np.sum(coords**2, axis=-1)), 0.5 / nr_points).astype(np.float32)
+    return coords, weights
+
+def random_complex(shape, seed=0):
+    rng = np.random.RandomState(seed)
+    return (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(np.complex64)
+
+def relative_error(a, b):
+    return np.linalg.norm(a - b) / np.linalg.norm(b)
+
+def fov_image(mtx, mtx_original=MTX_ORIGINAL, extra_shape=(1, 1), seed=0):
+    # random image that is zero outside the (cropped) field of view
+    image = np.zeros(tuple(extra_shape) + (mtx, mtx), dtype=np.complex64)
+    lo = (mtx - mtx_original) // 2
+    image[..., lo:lo + mtx_original, lo:lo + mtx_original] = random_complex(tuple(extra_shape) + (mtx_original, mtx_original), seed)
+    return image
+
+def smooth_image(mtx, mtx_original=MTX_ORIGINAL):
+    # gaussian blob cut to the field of view: [1, 1, mtx, mtx]
+    u = (np.arange(mtx) - mtx // 2) / float(mtx_original)
+    y, x = np.meshgrid(u, u, indexing='ij')
+    fov = np.abs(fov_image(mtx, mtx_original)[0, 0]) > 0
+    return (np.exp(-(x**2 + y**2) / 0.05) * fov).astype(np.complex64)[np.newaxis, np.newaxis]
+
+def smooth_csm(nr_coils, mtx, extra_shape=(1, 1)):
+    u = (np.arange(mtx) - mtx // 2) / float(mtx)
+    y, x = np.meshgrid(u, u, indexing='ij')
+    csm = np.zeros((nr_coils,) + tuple(extra_shape) + (mtx, mtx), dtype=np.complex64)
+    for coil in range(nr_coils):
+        cx = 0.4 * np.cos(2 * np.pi * coil / nr_coils)
+        cy = 0.4 * np.sin(2 * np.pi * coil / nr_coils)
+        csm[coil] = np.exp(-((x - cx)**2 + (y - cy)**2) / 0.2) * np.exp(1j * np.pi * coil / nr_coils)
+    return csm
+
+def test_map_slices_without_fork_once_threads_run():
+    # a worker forked next to another thread could hang on one of its
+    # locks, so the slices are done in this process: plain lists then see
+    # the results, which the workers couldn't return
+    import threading
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait)
+    thread.start()
+    try:
+        assert kaiser2D.threads_running()
+        done = []
+        kaiser2D.map_slices2D(lambda e2, e1: done.append((e2, e1)), 2, 3, nprocs=4)
+        assert sorted(done) == [(e2, e1) for e2 in range(2) for e1 in range(3)]
+    finally:
+        stop.set()
+        thread.join()
+
+def test_map_slices_workers_write_shared_memory():
+    # (before the gridding tests, which may start the numba thread pool)
+    if kaiser2D.threads_running():
+        pytest.skip("threads are running, map_slices2D() doesn't fork")
+    out = kaiser2D.shared_zeros([2, 3], np.int64)
+
+    def func(e2, e1):
+        out[e2, e1] = 10 * e2 + e1
+    kaiser2D.map_slices2D(func, 2, 3, nprocs=4)
+    assert np.array_equal(out, [[0, 1, 2], [10, 11, 12]])
+
+@pytest.fixture
+def kernel():
+    return kaiser2D.kaiserbessel_kernel(800, OVERSAMPLING_RATIO)
+
+@pytest.mark.parametrize('separable', [False, True])
+def test_grid_threaded_matches_serial(kernel, separable):
+    coords, weights = spiral(nr_sets=2)
+    data = random_complex([3, 1, 2] + list(coords.shape[1:3]))
+    mtx = oversampled_mtx()
+    out_dims = [3, 1, 2, mtx] + list(coords.shape[1:3])
+    serial = kaiser2D.grid2D(data, coords, weights, kernel, out_dims, nthreads=1, separable=separable)
+    threaded = kaiser2D.grid2D(data, coords, weights, kernel, out_dims, nthreads=7, separable=separable)
+    assert relative_error(threaded, serial) < 1e-6
+
+@pytest.mark.parametrize('separable', [False, True])
+def test_degrid_threaded_matches_serial(kernel, separable):
+    coords, weights = spiral(nr_sets=2)
+    mtx = oversampled_mtx()
+    kspace = random_complex([3, 1, 2, mtx, mtx])
+    out_dims = [3, 1, 2] + list(coords.shape[1:3])
+    serial = kaiser2D.degrid2D(kspace, coords, kernel, out_dims, nthreads=1, separable=separable)
+    threaded = kaiser2D.degrid2D(kspace, coords, kernel, out_dims, nthreads=7, separable=separable)
+    assert relative_error(threaded, serial) < 1e-6
+
+@pytest.mark.parametrize('separable', [False, True])
+def test_plan_matches_direct(kernel, separable):
+    coords, weights = spiral(nr_sets=2)
+    mtx = oversampled_mtx()
+    plan = kaiser2D.GriddingPlan(coords, weights, kernel, mtx, separable=separable)
+
+    data = random_complex([3, 1, 2] + list(coords.shape[1:3]))
+    out_dims = [3, 1, 2, mtx] + list(coords.shape[1:3])
+    direct = kaiser2D.grid2D(data, coords, weights, kernel, out_dims, separable=separable)
+    planned = kaiser2D.grid2D(data, coords, weights, kernel, out_dims, plan=plan, nthreads=3)
+    assert relative_error(planned, direct) < 1e-3
+
+    kspace = random_complex([3, 1, 2, mtx, mtx])
+    out_dims = [3, 1, 2] + list(coords.shape[1:3])
+    direct = kaiser2D.degrid2D(kspace, coords, kernel, out_dims, separable=separable)
+    planned = kaiser2D.degrid2D(kspace, coords, kernel, out_dims, plan=plan, nthreads=3)
+    assert relative_error(planned, direct) < 1e-3
+
+def test_sorted_matches_unsorted(kernel):
+    coords, weights = spiral(nr_sets=2)
+    mtx = oversampled_mtx()
+    order = kaiser2D.sample_order2D(coords, mtx)
+    assert np.array_equal(np.sort(order, axis=-1), np.tile(np.arange(order.shape[-1]), (order.shape[0], 1)))
+
+    data = random_complex([3, 1, 2] + list(coords.shape[1:3]))
+    out_dims = [3, 1, 2, mtx] + list(coords.shape[1:3])
+    unsorted = kaiser2D.grid2D(data, coords, weights, kernel, out_dims, nthreads=2)
+    ordered = kaiser2D.grid2D(data, coords, weights, kernel, out_dims, nthreads=2, order=order)
+    assert relative_error(ordered, unsorted) < 1e-6
+
+    kspace = random_complex([3, 1, 2, mtx, mtx])
+    out_dims = [3, 1, 2] + list(coords.shape[1:3])
+    unsorted = kaiser2D.degrid2D(kspace, coords, kernel, out_dims, nthreads=2)
+    ordered = kaiser2D.degrid2D(kspace, coords, kernel, out_dims, nthreads=2, order=order)
+    assert relative_error(ordered, unsorted) < 1e-6
+
+def test_non_contiguous_out_is_rejected(kernel):
+    coords, weights = spiral()
+    mtx = oversampled_mtx()
+    data = random_complex([2, 1, 1] + list(coords.shape[1:3]))
+    out = np.zeros([2, 1, 1, mtx, 2 * mtx], dtype=np.complex64)[..., ::2]
+    with pytest.raises(ValueError):
+        kaiser2D.grid2D(data, coords, weights, kernel, [2, 1, 1, mtx] + list(coords.shape[1:3]), out=out)
+
+@pytest.mark.parametrize('separable', [False, True])
+def test_analytic_rolloff_matches_numeric(kernel, separable):
+    # 1/|fft(gridded delta)|, compared inside the field of view where the
+    # rolloff is applied (the radial one with the clamp of rolloff2D() that
+    # is reached in the corners; the separable clamp is per dimension)
+    mtx = oversampled_mtx()
+    lo = (mtx - MTX_ORIGINAL) // 2
+    fov = (slice(lo, lo + MTX_ORIGINAL), slice(lo, lo + MTX_ORIGINAL))
+    delta = np.ones([1, 1, 1, 1, 1], dtype=np.complex64)
+    coords = np.zeros([1, 1, 1, 2], dtype=np.float32)
+    weights = np.ones([1, 1, 1], dtype=np.float32)
+    gridded = kaiser2D.grid2D(delta, coords, weights, kernel, [1, 1, 1, mtx, 1, 1], separable=separable)
+    ft = np.abs(kaiser2D.fft2D(gridded[0, 0, 0]))
+    if not separable:
+        ft = np.maximum(ft, ft.max() * 0.05)
+    numeric = 1.0 / ft
+
+    analytic = kaiser2D.rolloff2D_analytic(mtx, OVERSAMPLING_RATIO, separable=separable)
+    assert np.abs(analytic[fov] / numeric[fov] - 1).max() < 0.005
+    if separable:
+        broadcast = kaiser2D.rolloff2D_analytic(mtx, OVERSAMPLING_RATIO, separable=True, broadcast=True)
+        assert np.allclose(broadcast[0] * broadcast[1], analytic, rtol=1e-6)
+    else:
+        assert np.abs(analytic[fov] / kaiser2D.rolloff2D(mtx, kernel)[fov] - 1).max() < 0.005
+
+@pytest.mark.parametrize('separable', [False, True])
+def test_toeplitz_matches_direct_normal_operator(kernel, separable):
+    # the direct operator carries the interpolation error of the gridding
+    # kernel, which grows towards the k-space edge, so use a smooth object
+    coords, weights = spiral(nr_arms=24)
+    mtx = oversampled_mtx()
+    csm = smooth_csm(4, mtx)
+    roll = kaiser2D.rolloff2D_analytic(mtx, OVERSAMPLING_RATIO, separable=separable, broadcast=separable)
+    fov_mask = np.abs(fov_image(mtx)[0, 0]) > 0
+    image = smooth_image(mtx)
+
+    direct = kaiser2D.SenseNormalOperator2D(csm, coords, weights, kernel, roll, separable=separable)
+    psf_kernel = kaiser2D.toeplitz_kernel2D(coords, weights, kernel, mtx, OVERSAMPLING_RATIO, separable=separable)
+    toeplitz = kaiser2D.SenseNormalOperator2D(csm, coords, weights, kernel, roll, psf_kernel=psf_kernel,
+                                              fov_mask=fov_mask.astype(np.float32), separable=separable)
+    expected = direct(image, np.zeros_like(image))
+    result = toeplitz(image, np.zeros_like(image))
+    assert relative_error(result[..., fov_mask], expected[..., fov_mask]) < 2e-2
+
+    # Sense2 with and without 'Toeplitz' (gridding plan) for the same kernel
+    plan = kaiser2D.GriddingPlan(coords, weights, kernel, mtx, separable=separable)
+    planned = kaiser2D.SenseNormalOperator2D(csm, coords, weights, kernel, roll, plan=plan, separable=separable)
+    expected = planned(image, np.zeros_like(image))
+    assert relative_error(result[..., fov_mask], expected[..., fov_mask]) < 2e-2
+
+def test_normal_operator_matches_gridding(kernel):
+    # A^H A on the preallocated buffers against the gridding functions
+    coords, weights = spiral()
+    mtx = oversampled_mtx()
+    nr_coils = 3
+    csm = smooth_csm(nr_coils, mtx)
+    roll = kaiser2D.rolloff2D_analytic(mtx, OVERSAMPLING_RATIO)
+    image = fov_image(mtx)
+    [nr_arms, nr_points] = coords.shape[1:3]
+
+    coil_images = kaiser2D.apply_rolloff2D(csm * image, roll)
+    samples = kaiser2D.degrid2D(kaiser2D.fft2D(coil_images, dir=1), coords, kernel, [nr_coils, 1, 1, nr_arms, nr_points])
+    gridded = kaiser2D.grid2D(samples, coords, weights, kernel, [nr_coils, 1, 1, mtx, nr_arms, nr_points])
+    expected = np.sum(np.conj(csm) * kaiser2D.apply_rolloff2D(kaiser2D.fft2D(gridded, dir=0), roll), axis=0)
+
+    operator = kaiser2D.SenseNormalOperator2D(csm, coords, weights, kernel, roll, nthreads=2)
+    out = np.zeros_like(image)
+    for i in range(2):
+        # the second call reuses the buffers
+        operator(image, out)
+        assert relative_error(out, expected) < 1e-5
+
+def test_cg_step_continues_iterations(kernel):
+    # 3 iterations, then one more from the stored x, r and d (a 'step' of
+    # Sense2) equal 4 iterations in one run
+    coords, weights = spiral()
+    mtx = oversampled_mtx()
+    csm = smooth_csm(4, mtx)
+    roll = kaiser2D.rolloff2D_analytic(mtx, OVERSAMPLING_RATIO)
+    plan = kaiser2D.GriddingPlan(coords, weights, kernel, mtx)
+    operator = kaiser2D.SenseNormalOperator2D(csm, coords, weights, kernel, roll, plan=plan)
+    b = operator(fov_image(mtx), np.zeros([1, 1, mtx, mtx], dtype=np.complex64))
+
+    for preconditioner in [None, kaiser2D.csm_preconditioner2D(csm)]:
+        cg = kaiser2D.ConjugateGradient(operator, b.shape, preconditioner=preconditioner)
+        cg.start(b=b)
+        for i in range(4):
+            cg.iterate()
+
+        first = kaiser2D.ConjugateGradient(operator, b.shape, preconditioner=preconditioner)
+        first.start(b=b)
+        for i in range(3):
+            first.iterate()
+        step = kaiser2D.ConjugateGradient(operator, b.shape, preconditioner=preconditioner)
+        step.start(x=first.x, r=first.r, d=first.d, r0_norm=first.r0_norm)
+        step.iterate()
+
+        assert relative_error(step.x, cg.x) < 1e-5
+        assert np.allclose(step.residual_norm(), cg.residual_norm(), rtol=1e-4)
+
+def stacked_diagonal(nr_slices):
+    # A^H A of a diagonal system with a different spectrum per slice,
+    # d and out: [nr_slices, 1, 16, 16]
+    rng = np.random.RandomState(1)
+    diagonal = rng.uniform(0.1, 1.0, [nr_slices, 1, 16, 16]) * np.arange(1, nr_slices + 1)[:, None, None, None]
+    return diagonal.astype(np.float32)
+
+def test_cg_tolerance_zero_is_one_joint_system():
+    # the default tolerance runs plain CG on the whole stack of slices
+    diagonal = stacked_diagonal(3)
+    b = random_complex([3, 1, 16, 16])
+    cg = kaiser2D.ConjugateGradient(lambda d, out: np.multiply(diagonal, d, out=out), b.shape)
+    cg.start(b=b)
+
+    x = np.zeros_like(b)
+    r = b.copy()
+    d = b.copy()
+    for i in range(5):
+        cg.iterate()
+        Ad = diagonal * d
+        rHr = np.vdot(r, r).real
+        alpha = rHr / np.vdot(d, Ad)
+        x += alpha * d
+        r -= alpha * Ad
+        d = r + np.vdot(r, r).real / rHr * d
+        assert relative_error(cg.x, x) < 1e-5
+    assert np.allclose(cg.residual_norm()[:, 0], np.linalg.norm(r.reshape(3, -1), axis=-1), rtol=1e-4)
+
+def test_cg_tolerance_solves_slices_separately():
+    # with a tolerance each slice gets its own step sizes
+    diagonal = stacked_diagonal(3)
+    b = random_complex([3, 1, 16, 16])
+    cg = kaiser2D.ConjugateGradient(lambda d, out: np.multiply(diagonal, d, out=out), b.shape, tolerance=1e-12)
+    cg.start(b=b)
+    for i in range(4):
+        cg.iterate()
+
+    for s in range(3):
+        single = kaiser2D.ConjugateGradient(lambda d, out: np.multiply(diagonal[s:s + 1], d, out=out), b[s:s + 1].shape)
+        single.start(b=b[s:s + 1])
+        for i in range(4):
+            single.iterate()
+        assert relative_error(cg.x[s], single.x[0]) < 1e-5
+
+def test_coil_compression_commutes_with_gridding(kernel):
+    # the compression is linear in the coils, so compressing before the
+    # gridding gives the compressed gridded coils, and all virtual coils
+    # keep the signal energy
+    coords, weights = spiral()
+    mtx = oversampled_mtx()
+    data = random_complex([6, 1, 1] + list(coords.shape[1:3]))
+    data[3:] = 0.5 * data[:3] + 0.1 * data[3:]
+    out_dims = [6, 1, 1, mtx] + list(coords.shape[1:3])
+
+    full = kaiser2D.coil_compression_matrix2D(data)
+    assert full.shape == (6, 6)
+    assert np.isclose(np.linalg.norm(kaiser2D.compress_coils2D(data, full)), np.linalg.norm(data), rtol=1e-4)
+
+    compression = kaiser2D.coil_compression_matrix2D(data, nr_virtual_coils=3)
+    out_dims[0] = 3
+    compressed_first = kaiser2D.grid2D(kaiser2D.compress_coils2D(data, compression), coords, weights, kernel, out_dims)
+    out_dims[0] = 6
+    gridded_first = kaiser2D.compress_coils2D(kaiser2D.grid2D(data, coords, weights, kernel, out_dims), compression)
+    assert relative_error(compressed_first, gridded_first) < 1e-5
+
+def test_averaged_csm_is_an_array_per_dynamic(kernel):
+    # the maps averaged over the dynamics go to the CSM output ports, which
+    # need a writable array for every dynamic (not a broadcast view)
+    coords, weights = spiral()
+    mtx = oversampled_mtx()
+    data = random_complex([4, 1, 3] + list(coords.shape[1:3]))
+    images = kaiser2D.fft2D(kaiser2D.grid2D(data, coords, weights, kernel, [4, 1, 3, mtx] + list(coords.shape[1:3])), dir=0)
+    maps = [kaiser2D.autocalibrationB1Maps2D(images, average_csm=1),
+            kaiser2D.lowres_autocalibrationB1Maps2D(data, coords, weights, kernel, mtx, OVERSAMPLING_RATIO, average_csm=1)]
+    for csm in maps:
+        assert csm.shape == (4, 1, 3, mtx, mtx)
+        assert csm.flags.writeable and csm.flags.c_contiguous
+        assert np.array_equal(csm[:, :, 0], csm[:, :, 2])
+
+def test_lowres_autocalibration_matches_full_resolution(kernel):
+    # the maps from the central samples match the maps of the full
+    # resolution path (grid, FFT, rolloff, autocalibration) inside the object
+    coords, weights = spiral(nr_arms=24, nr_points=800)
+    mtx = oversampled_mtx()
+    roll = kaiser2D.rolloff2D_analytic(mtx, OVERSAMPLING_RATIO)
+    image = smooth_image(mtx)
+    coil_images = smooth_csm(4, mtx) * image
+    kaiser2D.apply_rolloff2D(coil_images, roll)
+    out_dims = [4, 1, 1] + list(coords.shape[1:3])
+    data = kaiser2D.degrid2D(kaiser2D.fft2D(coil_images, dir=1), coords, kernel, out_dims)
+
+    images = kaiser2D.fft2D(kaiser2D.grid2D(data, coords, weights, kernel, [4, 1, 1, mtx] + list(coords.shape[1:3])), dir=0)
+    kaiser2D.apply_rolloff2D(images, roll)
+    full = kaiser2D.autocalibrationB1Maps2D(images)
+    lowres = kaiser2D.lowres_autocalibrationB1Maps2D(data, coords, weights, kernel, mtx, OVERSAMPLING_RATIO)
+    inside = np.abs(image[0, 0]) > 0.1
+    assert relative_error(lowres[..., inside], full[..., inside]) < 1e-4
+
+def test_temporary_history_file(tmp_path):
+    import os
+    filename = kaiser2D.temporary_history_file()
+    assert os.path.exists(filename) and kaiser2D.is_temporary_history_file(filename)
+    history = kaiser2D.IterationHistory2D([1, 1, 4, 4], 0, 4, filename=filename)
+    history.keep(history.iterates, 1, np.ones([1, 1, 4, 4]))
+    assert history.finish(1).shape == (1, 1, 1, 4, 4)
+    kaiser2D.remove_temporary_history_file(filename)
+    assert not os.path.exists(filename)
+
+    # a file the user chose is never removed
+    filename = str(tmp_path / (kaiser2D.HISTORY_FILE_PREFIX + 'user.raw'))
+    open(filename, 'wb').close()
+    kaiser2D.remove_temporary_history_file(filename)
+    assert os.path.exists(filename)
+
+def test_setup_cache_disk_store(kernel, tmp_path):
+    import os
+    import pickle
+    from bni.gridding.Kaiser2D_cache import SetupCache
+    directory = str(tmp_path / 'cache')
+    coords, weights = spiral(nr_sets=2)
+    mtx = oversampled_mtx()
+    plan = kaiser2D.GriddingPlan(coords, weights, kernel, mtx)
+    values = {'plan': plan, 'kernel': kernel, 'parameters': (1.375, 5.0, 800),
+              'rolloff': kaiser2D.rolloff2D_analytic(mtx, OVERSAMPLING_RATIO, separable=True, broadcast=True)}
+    cache = SetupCache(100, directory)
+    for key, value in values.items():
+        cache.get(key, lambda: value)
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+    # a new process reads the values back from the disk store
+    cache = SetupCache(100, directory)
+    assert cache.get('parameters', lambda: None) == (1.375, 5.0, 800)
+    assert np.array_equal(cache.get('kernel', lambda: None), kernel)
+    assert all(np.array_equal(a, b) for a, b in zip(cache.get('rolloff', lambda: None), values['rolloff']))
+    loaded = cache.get('plan', lambda: None)
+    data = random_complex([2, 1, 2] + list(coords.shape[1:3]))
+    out_dims = [2, 1, 2, mtx] + list(coords.shape[1:3])
+    assert np.array_equal(kaiser2D.grid2D(data, coords, weights, kernel, out_dims, plan=loaded),
+                          kaiser2D.grid2D(data, coords, weights, kernel, out_dims, plan=plan))
+    assert cache.stats()['disk hits'] == 4
+
+    # files that aren't arrays (e.g. a pickle) are misses, never unpickled
+    cache = SetupCache(100, directory)
+    with open(cache._path('pickled'), 'wb') as f:
+        pickle.dump(np.zeros(3), f)
+    assert cache.get('pickled', lambda: 'computed') == 'computed'
+
+    # a directory others can write to isn't used
+    os.chmod(directory, 0o777)
+    cache = SetupCache(100, directory)
+    assert cache.get('kernel', lambda: 'computed') == 'computed'
+
+def test_configure_from_environment():
+    try:
+        kaiser2D.configure_from_environment({'BNI_GRIDDING_SETUP_CACHE_MB': '64', 'BNI_GRIDDING_FFT_PLANNING': 'measure'})
+        assert kaiser2D.setup_cache.max_mb == 64
+        assert kaiser2D.fft_plans.effort == 'FFTW_MEASURE'
+        with pytest.raises(ValueError):
+            kaiser2D.configure_from_environment({'BNI_GRIDDING_SETUP_CACHE_MB': 'lots'})
+        with pytest.raises(ValueError):
+            kaiser2D.configure_from_environment({'BNI_GRIDDING_FFT_PLANNING': 'patient'})
+        kaiser2D.configure_from_environment({'BNI_GRIDDING_BACKEND': 'numpy'})
+        assert kaiser2D.backends.current.name == 'numpy'
+        with pytest.raises(ValueError):
+            kaiser2D.configure_from_environment({'BNI_GRIDDING_BACKEND': 'fortran'})
+        kaiser2D.configure_from_environment({'BNI_GRIDDING_PROFILE': 'time', 'BNI_GRIDDING_PROFILE_FILE': 'trace.json'})
+        assert kaiser2D.profiler.enabled and not kaiser2D.profiler.memory
+        assert kaiser2D.profiler.filename == 'trace.json'
+    finally:
+        kaiser2D.configure_from_environment({})
+    assert kaiser2D.setup_cache.max_mb == 0
+    assert kaiser2D.fft_plans.effort is None
+    assert kaiser2D.backends.current.name == kaiser2D.backends.available()[0]
+    assert not kaiser2D.profiler.enabled and (kaiser2D.profiler.filename is None)
+
+@pytest.mark.parametrize('n_in', [5, 6, 8])
+@pytest.mark.parametrize('n_out', [4, 5, 8, 11])
+@pytest.mark.parametrize('roll', [-5, -2, 0, 3])
+def test_resize_roll_slices(n_in, n_out, roll):
+    from bni.gridding.Kaiser2D_fft import _resize_roll_slices
+    x = np.arange(1, n_in + 1)
+    resized = np.zeros(n_out, dtype=x.dtype)
+    if n_out >= n_in:
+        o = n_out // 2 - n_in // 2
+        resized[o:o + n_in] = x
+    else:
+        o = n_in // 2 - n_out // 2
+        resized[:] = x[o:o + n_out]
+    out = np.zeros(n_out, dtype=x.dtype)
+    for src, dst in _resize_roll_slices(n_in, n_out, roll):
+        out[dst] = x[src]
+    assert np.array_equal(out, np.roll(resized, roll))
+
+@pytest.mark.parametrize('effort', ['FFTW_ESTIMATE', 'FFTW_MEASURE'])
+def test_planned_fft_matches_backend_fft(effort):
+    pytest.importorskip('pyfftw')
+    data = random_complex([2, 1, 30, 30])
+    try:
+        for args in [(0, []), (1, []), (0, [2, 1, 40, 40]), (1, [2, 1, 21, 21]), (0, [2, 1, 30, 40])]:
+            kaiser2D.fft_plans.configure(1, None)
+            expected = kaiser2D.fft2D(data, *args)
+            kaiser2D.fft_plans.configure(1, effort)
+            kaiser2D.fft_plans.clear()
+            result = kaiser2D.fft2D(data, *args)
+            assert relative_error(result, expected) < 1e-5
+            # a plan that fails its check falls back to the backend FFT
+            assert kaiser2D.fft_plans.plans and all(kaiser2D.fft_plans.plans.values())
+    finally:
+        kaiser2D.fft_plans.configure(1, None)
+
+def test_numpy_fft_matches_pyfi_fft():
+    # the FFT of the numpy (and numba) backend is scaled like core.math.fft
+    if 'pyfi' not in kaiser2D.backends.available():
+        pytest.skip("PyFI isn't built")
+    data = random_complex([2, 30, 30])
+    for outdims, dir in [([30, 30, 2], 0), ([30, 30, 2], 1), ([40, 40, 2], 0), ([21, 21, 2], 1)]:
+        outdims = np.array(outdims, dtype=np.int64)
+        kwargs = dict(dir=dir, dim1=1, dim2=1, dim3=0, dim4=0, dim5=0)
+        expected = kaiser2D.backends.get('pyfi').fftw(data, outdims, **kwargs)
+        assert relative_error(kaiser2D.backends.get('numpy').fftw(data, outdims, **kwargs), expected) < 1e-5
+
+def test_sparse_dot_threaded_matches_serial():
+    import scipy.sparse
+    A = scipy.sparse.random(500, 300, density=0.05, format='csr', random_state=0, dtype=np.float32)
+    x = random_complex([300, 4])
+    expected = A.dot(x)
+    for nthreads in [2, 3, 7]:
+        assert np.array_equal(kaiser2D.sparse_dot(A, x, nthreads), expected)
+        blocks = kaiser2D.sparse_row_blocks(A, nthreads)
+        assert np.array_equal(kaiser2D.sparse_dot(A, x, nthreads, blocks), expected)
+
+def fov_shift_phase(coords, dx, dy):
+    # the linear phase of the FOVShift node (FOVShift_GPI.py)
+    arg = -2.0 * np.pi * (coords[..., 0] * dx + coords[..., 1] * dy)
+    return (np.cos(arg) + 1j * np.sin(arg)).astype(np.complex64)
+
+def test_fused_fov_shift_matches_fovshift(kernel):
+    coords, weights = spiral(nr_sets=2)
+    mtx = oversampled_mtx()
+    [dx, dy] = [3.25, -1.5]
+    phase = fov_shift_phase(coords, dx, dy)[np.newaxis, np.newaxis]
+
+    data = random_complex([3, 1, 2] + list(coords.shape[1:3]))
+    out_dims = [3, 1, 2, mtx] + list(coords.shape[1:3])
+    fused = kaiser2D.grid2D(data, coords, weights, kernel, out_dims, nthreads=2, dx=dx, dy=dy)
+    shifted = kaiser2D.grid2D(data * phase, coords, weights, kernel, out_dims, nthreads=2)
+    assert relative_error(fused, shifted) < 1e-5
+
+    # degridding applies the adjoint phase
+    kspace = random_complex([3, 1, 2, mtx, mtx])
+    out_dims = [3, 1, 2] + list(coords.shape[1:3])
+    fused = kaiser2D.degrid2D(kspace, coords, kernel, out_dims, nthreads=2, dx=dx, dy=dy)
+    unshifted = kaiser2D.degrid2D(kspace, coords, kernel, out_dims, nthreads=2) * np.conj(phase)
+    assert relative_error(fused, unshifted) < 1e-5
+
+def test_header_fov_shift():
+    # off-centers in mm in pixels of the "true resolution" matrix, with the
+    # half pixel of an even number of distributed spiral partitions
+    params = {'headerType': 'BNIspiral', 'spFOVXY': ['240'], 'spRESXY': ['2.5'], 'spFOVZ': ['64'], 'spRESZ': ['4'],
+              'spSTYPE': ['1'], 'm_offc': ['12000'], 'p_offc': ['-6000'], 's_offc': ['16000']}
+    assert kaiser2D.header_matrix(params) == (120.0, 0.)
+    assert np.allclose(kaiser2D.header_fov_shift(params), (6.0, -3.0, 0.))
+    assert np.allclose(kaiser2D.header_fov_shift(params, stack=True), (6.0, -3.0, 3.5))
+    params['spSTYPE'] = ['2']
+    assert kaiser2D.header_matrix(params, stack=True) == (120.0, 20.0)
+    assert np.allclose(kaiser2D.header_fov_shift(params, stack=True), (6.0, -3.0, 4.5))
+    with pytest.raises(ValueError):
+        kaiser2D.header_fov_shift({'headerType': 'other'})
+
+@pytest.mark.parametrize('max_error', [1e-2, 1e-3])
+def test_kaiserbessel_parameters_reach_the_target(max_error):
+    [oversampling_ratio, kernel_width, size] = kaiser2D.kaiserbessel_parameters(max_error, 128, 10000)
+    assert kaiser2D.kaiserbessel_aliasing_error(oversampling_ratio, kernel_width) <= np.sqrt(0.75) * max_error
+    assert kaiser2D.kaiserbessel_table_error(size, oversampling_ratio, kernel_width) <= 0.5 * max_error
+    # the table size is the smallest one of the bound, which the table error is close to
+    assert kaiser2D.kaiserbessel_table_error(size, oversampling_ratio, kernel_width) > 0.45 * max_error
+
+def test_kaiserbessel_parameters_limits():
+    # MIN_TARGET_ERROR is reachable for any matrix, smaller errors can need
+    # a table larger than MAX_KERNEL_TABLE_SIZE, which is refused without
+    # building it
+    for mtx in [64, 512]:
+        size = kaiser2D.kaiserbessel_parameters(kaiser2D.MIN_TARGET_ERROR, mtx, 100000)[2]
+        assert size <= kaiser2D.MAX_KERNEL_TABLE_SIZE
+    with pytest.raises(ValueError):
+        kaiser2D.kaiserbessel_table_size(1e-9, 2.0, kaiser2D.MAX_KERNEL_WIDTH)
+    with pytest.raises(ValueError):
+        kaiser2D.kaiserbessel_parameters(1e-9, 128, 10000)
+
+@pytest.mark.parametrize('separable', [False, True])
+def test_plan_size_estimate(kernel, separable):
+    # Sense2 only builds a plan whose estimate fits its budget
+    coords, weights = spiral(nr_sets=2)
+    plan = kaiser2D.GriddingPlan(coords, weights, kernel, oversampled_mtx(), separable=separable)
+    estimate = kaiser2D.GriddingPlan.estimate_nbytes(weights.size, separable)
+    assert 0.8 < estimate / float(plan.nbytes) < 1.2
+
+@pytest.mark.parametrize('memory_mb', [0, 0.1])
+def test_grid_images_matches_grid_fft_rolloff_crop(kernel, memory_mb):
+    # streamed in chunks of one image (0.1 MB) or all at once
+    coords, weights = spiral(nr_sets=2)
+    mtx = oversampled_mtx()
+    roll = kaiser2D.rolloff2D_analytic(mtx, OVERSAMPLING_RATIO)
+    data = random_complex([3, 2, 2] + list(coords.shape[1:3]))
+    images = kaiser2D.fft2D(kaiser2D.grid2D(data, coords, weights, kernel, [3, 2, 2, mtx] + list(coords.shape[1:3])), dir=0)
+    kaiser2D.apply_rolloff2D(images, roll)
+    crop = (mtx - MTX_ORIGINAL) // 2
+    reference = images[..., crop:crop + MTX_ORIGINAL, crop:crop + MTX_ORIGINAL]
+    streamed = kaiser2D.grid_images2D(data, coords, weights, kernel, mtx, roll, MTX_ORIGINAL, memory_mb=memory_mb)
+    assert relative_error(streamed, reference) < 1e-5
+
+@pytest.mark.parametrize('dir', [0, 1])
+@pytest.mark.parametrize('mtx_small, mtx_large', [(16, 24), (20, 22), (15, 22)])
+def test_pruned_ffts_match_fft2D(dir, mtx_small, mtx_large):
+    small = random_complex([2, 1, 3, mtx_small, mtx_small])
+    padded = kaiser2D.fft2D(small, dir=dir, out_dims_fft=[2, 1, 3, mtx_large, mtx_large])
+    assert relative_error(kaiser2D.fft2D_zeropad(small, mtx_large, dir=dir), padded) < 1e-5
+
+    # cropped like the nodes crop the oversampled images (mtx_min)
+    large = random_complex([2, 1, 3, mtx_large, mtx_large])
+    lo = (mtx_large - mtx_small) // 2
+    cropped = kaiser2D.fft2D(large, dir=dir)[..., lo:lo + mtx_small, lo:lo + mtx_small]
+    assert relative_error(kaiser2D.fft2D_crop(large, mtx_small, dir=dir), cropped) < 1e-5
+
+def test_stack_of_spirals_matches_kz_dft(kernel):
+    # kz FFT then 2D gridding per z partition against gridding each measured
+    # partition and summing them with the explicit kz DFT (unitary, forward
+    # like fft2D dir 0), with interleaved partitions, kz = 0 first partition
+    # not measured and an off-center dz
+    coords2D, weights2D = spiral(nr_arms=4, nr_points=200)
+    mtx_z = 8
+    measured = np.arange(1, mtx_z)
+    nr_partitions = len(measured)
+    coords = np.zeros([1, 4 * nr_partitions, 200, 3], dtype=np.float32)
+    for i, p in enumerate(measured):
+        coords[0, i::nr_partitions, :, :2] = coords2D[0]
+        coords[0, i::nr_partitions, :, 2] = (p - mtx_z // 2) / float(mtx_z)
+    weights = np.repeat(weights2D, nr_partitions, axis=1)
+    data = random_complex([2, 1, 1, 4 * nr_partitions, 200])
+    dz = 1.5
+
+    [crds, arms, partitions, mtx_z_found] = kaiser2D.stack_partitions3D(coords)
+    assert (mtx_z_found == mtx_z) and np.array_equal(partitions, measured)
+    assert np.array_equal(crds, coords2D)
+    hybrid = kaiser2D.kz_transform3D(data, weights, arms, partitions, mtx_z, dz=dz)
+    mtx = oversampled_mtx()
+    ones = np.ones(crds.shape[:-1], dtype=np.float32)
+    gridded = kaiser2D.grid2D(hybrid, crds, ones, kernel, [2, mtx_z, 1, mtx, 4, 200])
+
+    reference = np.zeros_like(gridded)
+    z = np.arange(mtx_z) - mtx_z // 2
+    for i, p in enumerate(measured):
+        kz = (p - mtx_z // 2) / float(mtx_z)
+        partition = kaiser2D.grid2D(np.ascontiguousarray(data[..., i::nr_partitions, :]), coords2D, weights2D, kernel, [2, 1, 1, mtx, 4, 200])
+        phase = np.exp(-2j * np.pi * kz * (z + dz)) / np.sqrt(mtx_z)
+        reference += partition * phase[np.newaxis, :, np.newaxis, np.newaxis, np.newaxis]
+    assert relative_error(gridded, reference) < 1e-5
+
+    # arms of one partition that aren't in the same kz plane
+    coords[0, 0, 100:, 2] += 1.0 / mtx_z
+    with pytest.raises(ValueError):
+        kaiser2D.stack_partitions3D(coords, mtx_z)
+
+def test_profiler_stages(tmp_path):
+    import json
+    import os
+    from bni.gridding.Kaiser2D_profile import Profiler
+    profiler = Profiler()
+    with profiler.stage('grid'):
+        pass
+    assert profiler.events == []
+
+    # nested stages: the outer one includes the inner one, which holds the
+    # peak of an 8 MB array
+    profiler.configure(True, memory=True)
+    try:
+        with profiler.stage('outer', samples=10):
+            with profiler.stage('inner', samples=4):
+                x = np.ones(2**20)
+                del x
+        summary = profiler.summary()
+        [inner, outer] = profiler.events
+        assert (inner['name'], inner['depth'], outer['depth']) == ('inner', 1, 0)
+        assert outer['seconds'] >= inner['seconds']
+        assert abs(outer['self seconds'] - (outer['seconds'] - inner['seconds'])) < 1e-9
+        assert summary['stages']['inner']['MB'] >= 8
+        assert summary['stages']['outer']['samples'] == 10
+
+        # the events of a worker process come back through a pipe
+        read_fd, write_fd = os.pipe()
+        profiler._send(write_fd, 1)
+        profiler._receive(read_fd)
+        assert [e['name'] for e in profiler.events] == ['inner', 'outer', 'outer']
+
+        filename = str(tmp_path / 'trace.json')
+        profiler.save(filename)
+        with open(filename) as f:
+            trace = json.load(f)
+        assert len(trace['traceEvents']) == 3 and trace['summary']['stages']['outer']['calls'] == 2
+    finally:
+        profiler.configure(False)
+
+def test_auto_backend_selection(tmp_path, monkeypatch):
+    import json
+    from bni.gridding.Kaiser2D_backends import BackendRegistry
+    selection_file = str(tmp_path / 'backend_selection.json')
+    registry = BackendRegistry(kaiser2D.backends.backends)
+
+    # a named backend is used without benchmarking
+    monkeypatch.setattr(registry, 'benchmark', lambda *args: pytest.fail("benchmarked a named backend"))
+    registry.configure('numpy', selection_file)
+    assert registry.select(32, 1000, 2, 1) == 'numpy'
+    monkeypatch.undo()
+
+    # 'auto' benchmarks once per problem size and stores the choice
+    registry.configure('auto', selection_file)
+    name = registry.select(32, 1000, 2, 1)
+    assert name in registry.available() and registry.current.name == name
+    with open(selection_file) as f:
+        assert list(json.load(f).values()) == [name]
+
+    # another process reuses the stored choice, also for a problem size that
+    # is benchmarked the same
+    registry = BackendRegistry(kaiser2D.backends.backends)
+    monkeypatch.setattr(registry, 'benchmark', lambda *args: pytest.fail("benchmarked a stored choice"))
+    registry.configure('auto', selection_file)
+    assert registry.select(32, 1000, 2, 1) == name
+    assert registry.select(32, 1024, 2, 1) == name
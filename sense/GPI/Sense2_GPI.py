@@ -42,13 +42,62 @@ class ExternalNode(gpi.NodeAPI):
     * Shewchuk, Jonathan Richard. "An introduction to the conjugate gradient
       method without the agonizing pain." (1994).
 
+    The setup cache, FFT planning, compute backend and profiling are set for
+    all gridding and SENSE nodes, see
+    Kaiser2D_utils.configure_from_environment().
+
     WIDGETS:
         mtx: the matrix to be used for gridding (this is the size used no
               extra scaling is added)
-        iterations: number of iterations to complete before terminating
+        iterations: maximum number of iterations to complete before terminating
+        iteration history: iterates in the 'x iterations' output
+                 off: not kept
+                 in memory: kept in RAM
+                 memory-mapped: kept in the 'history file' (raw complex64
+                     [iterates, extra_dim2, extra_dim1, mtx, mtx]) that is
+                     memory-mapped, single steps append to it, the output
+                     only has the last kept iterate
+        history interval: keep every k-th iterate
+        history file: file of the memory-mapped history (if empty a
+                 temporary file that is removed when the history is
+                 switched off or GPI exits)
+        residual tolerance: stop iterating a slice once its relative residual
+                 |r|/|r0| is below this value, the node finishes when all
+                 slices have converged and each slice gets its own CG step
+                 sizes (0: always run 'iterations' with joint step sizes
+                 for all slices, as before)
         step: execute an additional iteration (will add to 'iterations')
+        preconditioner: preconditioned CG, the same solution in fewer
+                 iterations, neither helps by default ('none')
+                 coil sensitivity: inverse coil sum-of-squares, only for
+                     un-normalized 'coil sensitivity' input maps (skipped
+                     for the autocalibrated maps)
+                 k-space density: inverse gridded sample density, only for
+                     unit or poor weights (slower with density compensation)
         Autocalibration Width (%): percentage of pixels to use for B1 est.
         Autocalibration Taper (%): han window taper for blurring.
+        low-resolution autocalibration: estimate the B1 maps from the central
+                 k-space samples gridded onto a small matrix that just holds
+                 the autocalibration window, then zero-fill them to the
+                 oversampled matrix (instead of two FFTs of the oversampled
+                 coil images), the averaged maps of dynamic data are shared
+                 by all dynamics without copies
+        threads: number of threads used for gridding and degridding (results
+                 are independent of this)
+        Toeplitz normal operator: replace degrid -> grid in each iteration
+                 by a convolution with the point-spread function of the
+                 trajectory, computed once with zero-padded FFTs.
+        separable kernel: use the product of two 1D Kaiser-Bessel kernels
+                 instead of the radial kernel for gridding and degridding
+        kernel width: Kaiser-Bessel kernel width in oversampled k-space pixels
+        kernel table size: number of entries of the tabulated kernel
+        target error: relative gridding error that sets oversampling ratio
+                 and kernel (0: off)
+        processes: number of worker processes that reconstruct the slices
+                 and dynamics ([extra_dim2, extra_dim1]) in parallel, the
+                 threads are divided among them
+        virtual coils: SVD coil compression to at most this many coils
+        coil compression energy (%): signal energy the virtual coils keep
 
     INPUT:
         data: raw k-space data
@@ -60,19 +109,41 @@ class ExternalNode(gpi.NodeAPI):
         x: solution at the current iteration
         r: residualt at the current iteration
         d: direction at the current iteration
+        residual: residual norm |r| per iteration and slice, the first entry
+                  is |r0| [iterations + 1, extra_dim2, extra_dim1]
         Autocalibration CSM: B1-recv estimated using the central k-space points
+        coil compression: [virtual coils, coils] coil compression matrix
+        profile: per-stage calls, seconds, self seconds, samples/s and MB
+                 (if profiled)
     """
 
     def initUI(self):
+        import bni.gridding.Kaiser2D_utils as kaiser2D
+
         # Widgets
         self.addWidget('SpinBox', 'mtx', val=300, min=1)
         self.addWidget('SpinBox', 'iterations', val=10, min=1)
+        self.addWidget('ExclusivePushButtons', 'iteration history', buttons=['off', 'in memory', 'memory-mapped'], val=1, collapsed=True)
+        self.addWidget('SpinBox', 'history interval', val=1, min=1, collapsed=True)
+        self.addWidget('StringBox', 'history file', val='', collapsed=True)
+        self.addWidget('DoubleSpinBox', 'residual tolerance', val=0., decimals=6, singlestep=0.001, min=0., max=1.)
         self.addWidget('PushButton', 'step')
+        self.addWidget('ExclusivePushButtons', 'preconditioner', buttons=['none', 'coil sensitivity', 'k-space density'], val=0)
         self.addWidget('DoubleSpinBox', 'oversampling ratio', val=1.375, decimals=3, singlestep=0.125, min=1, max=2, collapsed=True)
         self.addWidget('Slider', 'Autocalibration Width (%)', val=10, min=0, max=100)
         self.addWidget('Slider', 'Autocalibration Taper (%)', val=50, min=0, max=100)
         self.addWidget('Slider', 'Mask Floor (% of max mag)', val=1, min=0, max=100)
         self.addWidget('PushButton', 'Dynamic data - average all dynamics for csm', toggle=True, button_title='ON', val=1)
+        self.addWidget('PushButton', 'low-resolution autocalibration', toggle=True, button_title='ON', val=0, collapsed=True)
+        self.addWidget('SpinBox', 'threads', val=1, min=1, collapsed=True)
+        self.addWidget('PushButton', 'Toeplitz normal operator', toggle=True, button_title='ON', val=0)
+        self.addWidget('PushButton', 'separable kernel', toggle=True, button_title='ON', val=0, collapsed=True)
+        self.addWidget('DoubleSpinBox', 'kernel width', val=5.0, decimals=1, singlestep=0.5, min=2., max=8., collapsed=True)
+        self.addWidget('SpinBox', 'kernel table size', val=800, min=64, max=kaiser2D.MAX_KERNEL_TABLE_SIZE, collapsed=True)
+        self.addWidget('DoubleSpinBox', 'target error', val=0., decimals=5, singlestep=0.0001, min=0., max=0.1, collapsed=True)
+        self.addWidget('SpinBox', 'processes', val=1, min=1, collapsed=True)
+        self.addWidget('SpinBox', 'virtual coils', val=0, min=0, collapsed=True)
+        self.addWidget('DoubleSpinBox', 'coil compression energy (%)', val=100., decimals=2, singlestep=0.5, min=50., max=100., collapsed=True)
 
         # IO Ports
         self.addInPort('data', 'NPYarray', dtype=[np.complex64, np.complex128])
@@ -86,6 +157,9 @@ class ExternalNode(gpi.NodeAPI):
         self.addOutPort('oversampled CSM', 'NPYarray', dtype=np.complex64)
         self.addOutPort('cropped CSM', 'NPYarray', dtype=np.complex64)
         self.addOutPort('x iterations', 'NPYarray', dtype=np.complex64)
+        self.addOutPort('residual', 'NPYarray', dtype=np.float32)
+        self.addOutPort('coil compression', 'NPYarray', dtype=np.complex64)
+        self.addOutPort('profile', 'DICT')
 
     def validate(self):
         self.log.debug("validate SENSE2")
@@ -97,6 +171,20 @@ class ExternalNode(gpi.NodeAPI):
             # update the UI with the number of iterations
             self.setAttr('iterations', quietval=iterations + 1)
 
+        # the memory-mapped iteration history defaults to a temporary file
+        # that compute() creates, remove it once it's no longer used or when
+        # GPI exits
+        history_mode = self.getVal('iteration history')
+        self.setAttr('history interval', visible=(history_mode != 0))
+        self.setAttr('history file', visible=(history_mode == 2))
+        history_file = self.getVal('history file')
+        if history_file:
+            import bni.gridding.Kaiser2D_utils as kaiser2D
+            if kaiser2D.is_temporary_history_file(history_file):
+                kaiser2D.remove_temporary_history_file(history_file, at_exit=(history_mode == 2))
+                if history_mode != 2:
+                    self.setAttr('history file', quietval='')
+
         # check size of data vs. coords
         self.log.debug("validate SENSE2 - check size of data vs. coords")
         data = self.getData('data')
@@ -156,16 +244,60 @@ class ExternalNode(gpi.NodeAPI):
 
         mtx_original = self.getVal('mtx')
         iterations = self.getVal('iterations')
+        history_mode = self.getVal('iteration history')
+        history_interval = self.getVal('history interval')
+        history_file = self.getVal('history file')
+        tolerance = self.getVal('residual tolerance')
+        preconditioner_type = self.getVal('preconditioner')
         step = self.getVal('step')
         oversampling_ratio = self.getVal('oversampling ratio')
+        nthreads = self.getVal('threads')
+        toeplitz = self.getVal('Toeplitz normal operator')
+        separable = self.getVal('separable kernel')
+        kernel_width = self.getVal('kernel width')
+        kernel_table_size = self.getVal('kernel table size')
+        target_error = self.getVal('target error')
+        nprocs = self.getVal('processes')
+        nr_virtual_coils = self.getVal('virtual coils')
+        compression_energy = self.getVal('coil compression energy (%)')
+
+        # process-wide settings shared by the gridding and SENSE nodes (setup
+        # cache, FFT planning, compute backend and profiling)
+        try:
+            kaiser2D.configure_from_environment()
+        except ValueError as e:
+            self.log.warn(str(e))
+            return 1
 
         # for a single iteration step use the csm stored in the out port
+        csm_is_compressed = False
         if step and (self.getData('oversampled CSM') is not None):
             csm = self.getData('oversampled CSM')
+            csm_is_compressed = True
         else:
             csm = self.getData('coil sensitivity')
         if csm is not None:
             csm = csm.astype(np.complex64, copy=False)
+        csm_is_autocalibrated = (self.getData('coil sensitivity') is None)
+
+        # setup that only depends on the trajectory and the gridding parameters
+        # is reused from the setup cache (shared with the gridding nodes)
+        cache = kaiser2D.setup_cache
+
+        # accuracy target: the cheapest kernel that reaches it (the chosen
+        # parameters are shown in the widgets), otherwise check the widget values
+        try:
+            if target_error > 0:
+                [oversampling_ratio, kernel_width, kernel_table_size] = cache.get(
+                    ('kernel parameters', target_error, mtx_original, data.shape[-2] * data.shape[-1]),
+                    lambda: kaiser2D.kaiserbessel_parameters(target_error, mtx_original, data.shape[-2] * data.shape[-1]))
+                self.setAttr('oversampling ratio', quietval=oversampling_ratio)
+                self.setAttr('kernel width', quietval=kernel_width)
+                self.setAttr('kernel table size', quietval=kernel_table_size)
+            kaiser2D.kaiserbessel_beta(oversampling_ratio, kernel_width)
+        except ValueError as e:
+            self.log.warn(str(e))
+            return 1
 
         # oversampling: Oversample at the beginning and crop at the end
         mtx = np.int(mtx_original * oversampling_ratio)
@@ -195,8 +327,18 @@ class ExternalNode(gpi.NodeAPI):
             extra_dim2 = data.shape[-4]
         elif data.ndim > 5:
             self.log.warn("Not implemented yet")
+
+        # coil compression, gridding, fft and the csm multiplies scale with
+        # the number of coils
+        if (nr_virtual_coils > 0) or (compression_energy < 100):
+            compression = kaiser2D.coil_compression_matrix2D(data, nr_virtual_coils, compression_energy)
+            self.log.debug("Compress " + str(nr_coils) + " to " + str(compression.shape[0]) + " coils")
+            data = kaiser2D.compress_coils2D(data, compression)
+            nr_coils = data.shape[0]
+            if (csm is not None) and not csm_is_compressed:
+                csm = kaiser2D.compress_coils2D(csm, compression)
+            self.setData('coil compression', compression)
         out_dims_grid = [nr_coils, extra_dim2, extra_dim1, mtx, nr_arms, nr_points]
-        out_dims_degrid = [nr_coils, extra_dim2, extra_dim1, nr_arms, nr_points]
         out_dims_fft = [nr_coils, extra_dim2, extra_dim1, mtx, mtx]
         iterations_shape = [extra_dim2, extra_dim1, mtx, mtx]
 
@@ -205,20 +347,82 @@ class ExternalNode(gpi.NodeAPI):
             coords.shape = [1, nr_arms, nr_points, 2]
             weights.shape = [1, nr_arms, nr_points]
 
-        # output including all iterations
-        x_iterations = np.zeros([iterations, extra_dim2, extra_dim1, mtx_original, mtx_original], dtype=np.complex64)
-        if step and (iterations > 1):
-            previous_iterations = self.getData('x iterations')
-            previous_iterations.shape = [iterations - 1, extra_dim2, extra_dim1, mtx_original, mtx_original]
-            x_iterations[:-1, :, :, :, :] = previous_iterations
+        # output including the residual norms of all iterations (and the
+        # iteration history), a single step continues the previous iterations
+        if step and (self.getData('d') is not None):
+            previous_residual = self.getData('residual').reshape([-1, extra_dim2, extra_dim1])
+            nr_previous = previous_residual.shape[0] - 1
+            nr_new = 1
+        else:
+            nr_previous = 0
+            nr_new = iterations
+        residual = np.zeros([nr_previous + nr_new + 1, extra_dim2, extra_dim1], dtype=np.float32)
+        if nr_previous:
+            residual[:nr_previous + 1, ...] = previous_residual
+        parallel = (nprocs > 1) and (extra_dim2 * extra_dim1 > 1)
+        if history_mode == 0:
+            history = None
+        else:
+            if (history_mode == 2) and not history_file:
+                history_file = kaiser2D.temporary_history_file()
+                self.setAttr('history file', quietval=history_file)
+            previous_iterations = None
+            if nr_previous and (history_mode == 1) and (self.getData('x iterations') is not None):
+                previous_iterations = self.getData('x iterations').reshape([-1, extra_dim2, extra_dim1, mtx_original, mtx_original])
+            history = kaiser2D.IterationHistory2D([extra_dim2, extra_dim1, mtx_original, mtx_original], nr_previous, nr_new,
+                                                  interval=history_interval, previous=previous_iterations,
+                                                  filename=history_file if (history_mode == 2) else None, shared=parallel)
+
+        # before forking the workers this process must not start the FFTW
+        # thread pool, map_slices2D() would fall back to serial
+        kaiser2D.fft_plans.nthreads = 1 if parallel else nthreads
+
+        # compute backend: the configured one, or the fastest available one
+        # for this problem size
+        with kaiser2D.profiler.stage('backend selection'):
+            backend = kaiser2D.backends.select(mtx, nr_arms * nr_points, nr_coils, nthreads)
+        self.log.debug("compute backend: " + backend)
+
+        trajectory = kaiser2D.trajectory_hash(coords, weights)
 
         # pre-calculate Kaiser-Bessel kernel
         self.log.debug("Calculate kernel")
-        kernel_table_size = 800
-        kernel = kaiser2D.kaiserbessel_kernel(kernel_table_size, oversampling_ratio)
+        kernel = cache.get(('kernel', kernel_table_size, oversampling_ratio, kernel_width),
+                           lambda: kaiser2D.kaiserbessel_kernel(kernel_table_size, oversampling_ratio, kernel_width))
 
         # pre-calculate the rolloff for the spatial domain
-        roll = kaiser2D.rolloff2D(mtx, kernel)
+        # (the separable one as a pair of vectors)
+        broadcast = separable
+        roll = cache.get(('rolloff', mtx, oversampling_ratio, kernel_width, separable, broadcast),
+                         lambda: kaiser2D.rolloff2D_analytic(mtx, oversampling_ratio, separable=separable, broadcast=broadcast,
+                                                             kernel_width=kernel_width))
+
+        # the trajectory is the same for all coils and iterations, so
+        # either tabulate the point-spread function of degrid -> grid or the
+        # interpolation matrix only once
+        if toeplitz:
+            self.log.debug("Calculate Toeplitz kernel")
+            psf_kernel = cache.get(('toeplitz kernel', mtx, oversampling_ratio, kernel_table_size, kernel_width, separable, trajectory, backend),
+                                   lambda: kaiser2D.toeplitz_kernel2D(coords, weights, kernel, mtx, oversampling_ratio, nthreads=nthreads, separable=separable,
+                                                                      kernel_width=kernel_width))
+            plan = None
+            # the convolution is exact over the whole oversampled matrix, but
+            # the gridded data are only accurate inside the field of view, so
+            # keep the solution there
+            fov_mask = np.zeros([mtx, mtx], dtype=np.float32)
+            fov_mask[mtx_min:mtx_max, mtx_min:mtx_max] = 1.
+        else:
+            psf_kernel = fov_mask = None
+            # the interpolation matrix and its transpose take about 40x the
+            # memory of the samples, so they are only built if they fit into
+            # the setup cache that keeps them, otherwise each iteration grids
+            # and degrids with the (threaded) kernels of the compute backend
+            plan = None
+            plan_nbytes = kaiser2D.GriddingPlan.estimate_nbytes(coords.shape[0] * nr_arms * nr_points, separable, kernel_width)
+            if plan_nbytes <= cache.max_mb * 2**20:
+                self.log.debug("Calculate gridding plan")
+                plan = cache.get(('plan', mtx, oversampling_ratio, kernel_table_size, kernel_width, separable, trajectory),
+                                 lambda: kaiser2D.GriddingPlan(coords, weights, kernel, mtx, separable=separable, kernel_width=kernel_width))
 
         # for a single iteration step use the oversampled csm and intermediate results stored in outports
         if step and (self.getData('d') is not None):
@@ -228,11 +432,13 @@ class ExternalNode(gpi.NodeAPI):
             # aliasing due to undersampling.  If the k-space data have an
             # auto-calibration region, then this can be used to generate B1 maps.
             self.log.debug("Grid undersampled data")
-            gridded_kspace = kaiser2D.grid2D(data, coords, weights, kernel, out_dims_grid)
+            gridded_kspace = kaiser2D.grid2D(data, coords, weights, kernel, out_dims_grid, plan=plan, nthreads=nthreads, separable=separable,
+                                            kernel_width=kernel_width)
             # FFT
             image_domain = kaiser2D.fft2D(gridded_kspace, dir=0, out_dims_fft=out_dims_fft)
+            del gridded_kspace
             # rolloff
-            image_domain *= roll
+            kaiser2D.apply_rolloff2D(image_domain, roll)
 
             # calculate auto-calibration B1 maps
             if csm is None:
@@ -242,7 +448,12 @@ class ExternalNode(gpi.NodeAPI):
                 UI_taper = self.getVal('Autocalibration Taper (%)')
                 UI_mask_floor = self.getVal('Mask Floor (% of max mag)')
                 UI_average_csm = self.getVal('Dynamic data - average all dynamics for csm')
-                csm = kaiser2D.autocalibrationB1Maps2D(image_domain, taper=UI_taper, width=UI_width, mask_floor=UI_mask_floor, average_csm=UI_average_csm)
+                if self.getVal('low-resolution autocalibration'):
+                    csm = kaiser2D.lowres_autocalibrationB1Maps2D(data, coords, weights, kernel, mtx, oversampling_ratio, taper=UI_taper,
+                                                                  width=UI_width, mask_floor=UI_mask_floor, average_csm=UI_average_csm,
+                                                                  nthreads=nthreads, separable=separable, kernel_width=kernel_width)
+                else:
+                    csm = kaiser2D.autocalibrationB1Maps2D(image_domain, taper=UI_taper, width=UI_width, mask_floor=UI_mask_floor, average_csm=UI_average_csm)
             else:
                 # make sure input csm and data are the same mtx size.
                 # Assuming the FOV was the same: zero-fill in k-space
@@ -260,131 +471,136 @@ class ExternalNode(gpi.NodeAPI):
             self.setData('oversampled CSM', csm)
             self.setData('cropped CSM', csm[..., mtx_min:mtx_max, mtx_min:mtx_max])
 
-        # keep a conjugate csm set on hand
-        csm_conj = np.conj(csm)
+        def reconstruct(csm, coords, weights, plan, psf_kernel, b, state, x_iterations, residual, nthreads):
+            # CG SENSE for csm [nr_coils, extra_dim2, extra_dim1, mtx, mtx], fills
+            # x_iterations (the history iterates, optional) and residual,
+            # returns the CG and the number of iterations done
+            kaiser2D.fft_plans.nthreads = nthreads
+            # A^H A with preallocated coil buffers, and CG on preallocated vectors
+            normal_operator = kaiser2D.SenseNormalOperator2D(csm, coords, weights, kernel, roll, plan=plan,
+                                                             psf_kernel=psf_kernel, fov_mask=fov_mask,
+                                                             nthreads=nthreads, separable=separable, kernel_width=kernel_width)
+            if (preconditioner_type == 1) and csm_is_autocalibrated:
+                # the autocalibrated maps have a unit sum-of-squares inside the
+                # mask (and are zero outside), so this would be the identity
+                self.log.debug("Skip the coil sensitivity preconditioner for autocalibrated maps")
+                preconditioner = None
+            elif preconditioner_type == 1:
+                self.log.debug("Calculate coil sensitivity preconditioner")
+                preconditioner = kaiser2D.csm_preconditioner2D(csm)
+            elif preconditioner_type == 2:
+                self.log.debug("Calculate k-space density preconditioner")
+                preconditioner = kaiser2D.density_preconditioner2D(coords, weights, kernel, mtx, nthreads=nthreads, separable=separable,
+                                                                   kernel_width=kernel_width)
+            else:
+                preconditioner = None
+            if toeplitz and (preconditioner is not None):
+                # keep the preconditioned residual inside the field of view
+                precondition = preconditioner
+                def preconditioner(r, out):
+                    precondition(r, out)
+                    out *= fov_mask
+                    return out
+            cg = kaiser2D.ConjugateGradient(normal_operator, csm.shape[1:], tolerance=tolerance, preconditioner=preconditioner)
+
+            if state is not None:
+                # Get the data from the last execution of this node for an
+                # additional single iteration.
+                cg.start(x=state[0], r=state[1], d=state[2], r0_norm=residual[0])
+            else:
+                cg.start(b=b)
+                residual[0, ...] = cg.residual_norm()
+
+            # CG, until all slices have converged or the number of iterations is reached
+            nr_done = nr_previous
+            for i in range(nr_new):
+                if cg.converged():
+                    self.log.debug("\tSENSE converged after " + str(nr_done) + " iterations")
+                    break
+                self.log.debug("\tSENSE Iteration: " + str(nr_done + 1))
+                x = cg.iterate()
+                nr_done += 1
+                if x_iterations is not None:
+                    history.keep(x_iterations, nr_done, x[..., mtx_min:mtx_max, mtx_min:mtx_max])
+                residual[nr_done, ...] = cg.residual_norm()
+
+            # slices that converged early keep their solution, as if they
+            # had been iterated along with slower ones
+            if x_iterations is not None:
+                x_iterations[history.kept(nr_done):, ...] = cg.x[..., mtx_min:mtx_max, mtx_min:mtx_max]
+            residual[nr_done + 1:, ...] = residual[nr_done]
+            return cg, nr_done
 
-        # Iteration 1:
         if step and (self.getData('d') is not None):
-            self.log.debug("\tSENSE Iteration: " + str(iterations))
-            # make sure the loop doesn't start if only one step is needed
-            iterations = 0
-
-            # Get the data from the last execution of this node for an
-            # additional single iteration.
-            d = self.getData('d').copy()
-            r = self.getData('r').copy()
-            x = self.getData('x').copy()
-
-            # A
-            Ad = csm * d  # add coil phase
-            Ad *= roll  # pre-rolloff for degrid convolution
-            Ad = kaiser2D.fft2D(Ad, dir=1)
-            Ad = kaiser2D.degrid2D(Ad, coords, kernel, out_dims_degrid)
-            Ad = kaiser2D.grid2D(Ad, coords, weights, kernel, out_dims_grid)
-            Ad = kaiser2D.fft2D(Ad, dir=0)
-            Ad *= roll
-            Ad = csm_conj * Ad  # broadcast multiply to remove coil phase
-            Ad = Ad.sum(axis=0)  # assume the coil dim is the first
+            state = [self.getData('x'), self.getData('r'), self.getData('d')]
+            b = None
         else:
-            self.log.debug("\tSENSE Iteration: 1")
+            state = None
             # calculate initial conditions
             # d_0
-            d_0 = csm_conj * image_domain  # broadcast multiply to remove coil phase
-            d_0 = d_0.sum(axis=0)  # assume the coil dim is the first
-
-            # Ad_0:
-            #   degrid -> grid (loop over coils)
-            Ad_0 = csm * d_0  # add coil phase
-            Ad_0 *= roll  # pre-rolloff for degrid convolution
-            Ad_0 = kaiser2D.fft2D(Ad_0, dir=1)
-            Ad_0 = kaiser2D.degrid2D(Ad_0, coords, kernel, out_dims_degrid)
-            Ad_0 = kaiser2D.grid2D(Ad_0, coords, weights, kernel, out_dims_grid)
-            Ad_0 = kaiser2D.fft2D(Ad_0, dir=0)
-            Ad_0 *= roll
-            Ad_0 = csm_conj * Ad_0  # broadcast multiply to remove coil phase
-            Ad_0 = Ad_0.sum(axis=0)  # assume the coil dim is the first
-
-            # use the initial conditions for the first iter
-            r = d = d_0
-            x = np.zeros_like(d)
-            Ad = Ad_0
-
-        # CG - iter 1 or step
-        d_last, r_last, x_last = self.do_cg(d, r, x, Ad)
-
-        current_iteration = x_last.copy()
-        current_iteration.shape = iterations_shape
-        if step:
-            x_iterations[-1, :, :, :, :] = current_iteration[..., mtx_min:mtx_max, mtx_min:mtx_max]
+            image_domain *= np.conj(csm)  # broadcast multiply to remove coil phase
+            b = image_domain.sum(axis=0)  # assume the coil dim is the first
+            if toeplitz:
+                b *= fov_mask
+            del image_domain
+
+        x_iterations = None if history is None else history.iterates
+        if parallel:
+            # each slice / dynamic is an independent problem, reconstruct
+            # them on worker processes into shared memory
+            if kaiser2D.threads_running():
+                self.log.warn("CG SENSE: threads are already running in this process, reconstructing the slices serially")
+            else:
+                self.log.debug("CG SENSE on " + str(nprocs) + " processes")
+            residual_shared = kaiser2D.shared_zeros(residual.shape, residual.dtype)
+            residual_shared[...] = residual
+            residual = residual_shared
+            cg_state = [kaiser2D.shared_zeros(iterations_shape, np.complex64) for i in range(3)]
+            nr_done_slices = kaiser2D.shared_zeros([extra_dim2, extra_dim1], np.int64)
+            nthreads_per_proc = max(1, nthreads // nprocs)
+
+            def reconstruct_slice(e2, e1):
+                sl = (slice(e2, e2 + 1), slice(e1, e1 + 1))
+                crd_set = e1 if (coords.shape[0] > 1) else 0
+                crds = slice(crd_set, crd_set + 1)
+                cg, nr_done_slices[e2, e1] = reconstruct(
+                    csm[:, sl[0], sl[1]], coords[crds], weights[crds],
+                    None if plan is None else plan.subset(crd_set),
+                    None if psf_kernel is None else psf_kernel[:, :, crds],
+                    None if b is None else b[sl],
+                    None if state is None else [v[sl] for v in state],
+                    None if x_iterations is None else x_iterations[:, sl[0], sl[1]],
+                    residual[:, sl[0], sl[1]], nthreads_per_proc)
+                for v, cg_v in zip(cg_state, [cg.x, cg.r, cg.d]):
+                    v[sl] = cg_v
+            kaiser2D.map_slices2D(reconstruct_slice, extra_dim2, extra_dim1, nprocs)
+            [x, r, d] = cg_state
+            nr_done = int(nr_done_slices.max())
         else:
-            x_iterations[0, :, :, :, :] = current_iteration[..., mtx_min:mtx_max, mtx_min:mtx_max]
-
-        # Iterations >1:
-        for i in range(iterations - 1):
-            self.log.debug("\tSENSE Iteration: " + str(i + 2))
-
-            # input the result of the last iter
-            d = d_last
-            r = r_last
-            x = x_last
-
-            # A
-            Ad = csm * d  # add coil phase
-            Ad *= roll  # pre-rolloff for degrid convolution
-            Ad = kaiser2D.fft2D(Ad, dir=1)
-            Ad = kaiser2D.degrid2D(Ad, coords, kernel, out_dims_degrid)
-            Ad = kaiser2D.grid2D(Ad, coords, weights, kernel, out_dims_grid)
-            Ad = kaiser2D.fft2D(Ad, dir=0)
-            Ad *= roll
-            Ad = csm_conj * Ad  # broadcast multiply to remove coil phase
-            Ad = Ad.sum(axis=0)  # assume the coil dim is the first
-            # CG
-            d_last, r_last, x_last = self.do_cg(d, r, x, Ad)
-
-            current_iteration = x_last.copy()
-            current_iteration.shape = iterations_shape
-            x_iterations[i + 1, :, :, :, :] = current_iteration[..., mtx_min:mtx_max, mtx_min:mtx_max]
+            cg, nr_done = reconstruct(csm, coords, weights, plan, psf_kernel, b, state, x_iterations, residual, nthreads)
+            [x, r, d] = [cg.x, cg.r, cg.d]
 
         # return the final image
-        self.setData('d', d_last)
-        self.setData('r', r_last)
-        self.setData('x', x_last)
-        self.setData('out', np.squeeze(current_iteration[..., mtx_min:mtx_max, mtx_min:mtx_max]))
-        self.setData('x iterations', np.squeeze(x_iterations))
+        self.setData('d', d)
+        self.setData('r', r)
+        self.setData('x', x)
+        self.setData('out', np.squeeze(x[..., mtx_min:mtx_max, mtx_min:mtx_max]))
+        if history is not None:
+            iterates = history.finish(nr_done)
+            if history_mode == 2:
+                # the history stays in the file, pass on only the last kept
+                # iterate instead of the mapping of the whole file
+                iterates = np.array(iterates[-1:])
+            self.setData('x iterations', np.squeeze(iterates))
+        self.setData('residual', np.squeeze(residual[:nr_done + 1]))
+        self.log.debug("setup cache: " + str(cache.stats()))
+        if kaiser2D.profiler.enabled:
+            self.setData('profile', kaiser2D.profiler.summary())
+            if kaiser2D.profiler.filename:
+                kaiser2D.profiler.save(kaiser2D.profiler.filename)
 
         return 0
 
-    def do_cg(self, d_in, r_in, x_in, Ad_in):
-
-        d_out = np.zeros_like(d_in)
-        r_out = np.zeros_like(r_in)
-        x_out = np.zeros_like(x_in)
-
-        # Calculate alpha
-        # r^H r / (d^H Ad)
-        rHr = np.dot(np.conj(r_in.flatten()), r_in.flatten())
-        dHAd = np.dot(np.conj(d_in.flatten()), Ad_in.flatten())
-        alpha = rHr / dHAd
-
-        # Calculate x(i+1)
-        # x(i) + alpha d(i)
-        x_out = x_in + alpha * d_in
-
-        # Calculate r(i+1)
-        # r(i) - alpha Ad(i)
-        r_out = r_in - alpha * Ad_in
-
-        # Calculate beta
-        # r(i+1)^H r(i+1) / (r(i)^H r(i))
-        r1Hr1 = np.dot(np.conj(r_out.flatten()), r_out.flatten())
-        beta = r1Hr1 / rHr
-
-        # Calculate d(i+1)
-        # r(i+1) + beta d(i)
-        d_out = r_out + beta * d_in
-
-        return (d_out, r_out, x_out)
-
     def execType(self):
         # numpy linalg fails if this isn't a thread :(
         # return gpi.GPI_THREAD